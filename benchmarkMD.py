@@ -0,0 +1,217 @@
+#!/usr/bin/env python2.7
+"""
+benchmarkMD.py: time the MD tag checks smartSam2Fastq.py uses to decide if an
+alt alignment has a corrupted central base.
+
+Compares building the full mismatch dict with parse_MD_tag() against the
+single-pass md_has_mismatch() and the batch central_mismatches(), on a synthetic
+alt-heavy SAM (or a SAM file you give it), and makes sure they all agree.
+
+"""
+
+import argparse, sys, os, os.path, random, re, timeit, itertools
+
+import smartSam2Fastq
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    Borrows heavily from the argparse documentation examples:
+    <http://docs.python.org/library/argparse.html>
+    """
+
+    # Construct the parser (which is stored in parser)
+    # Module docstring lives in __doc__
+    # See http://python-forum.com/pythonforum/viewtopic.php?f=3&t=36847
+    # And a formatter class so our examples in the docstring look good. Isn't it
+    # convenient how we already wrapped it to 80 characters?
+    # See http://docs.python.org/library/argparse.html#formatter-class
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # General options
+    parser.add_argument("--input_sam", type=argparse.FileType("r"),
+        default=None,
+        help="SAM file to take MD tags from, instead of making them up")
+    parser.add_argument("--reads", type=int, default=200000,
+        help="number of synthetic alignments to make")
+    parser.add_argument("--read_length", type=int, default=100,
+        help="length of synthetic reads")
+    parser.add_argument("--alt_fraction", type=float, default=0.8,
+        help="fraction of synthetic alignments that are on alts")
+    parser.add_argument("--mismatch_rate", type=float, default=0.02,
+        help="chance of a mismatch at each synthetic aligned base")
+    parser.add_argument("--deletion_rate", type=float, default=0.002,
+        help="chance of a deletion after each synthetic aligned base")
+    parser.add_argument("--clip_fraction", type=float, default=0.2,
+        help="fraction of synthetic alignments that are soft clipped")
+    parser.add_argument("--repeats", type=int, default=3,
+        help="number of times to time each check, keeping the best")
+    parser.add_argument("--seed", type=int, default=0,
+        help="random seed for the synthetic alignments")
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+def synthetic_sam(options):
+    """
+    Yield synthetic SAM lines with CIGARs and MD tags, according to the given
+    options.
+
+    """
+
+    bases = "ACGT"
+
+    for i in xrange(options.reads):
+        if random.random() < options.alt_fraction:
+            contig = "chr6_GL000251v2_alt"
+        else:
+            contig = "chr6"
+
+        if random.random() < options.clip_fraction:
+            # Clip off some of the start
+            clip = random.randint(1, options.read_length / 4)
+            cigar = "{}S{}M".format(clip, options.read_length - clip)
+        else:
+            clip = 0
+            cigar = "{}M".format(options.read_length)
+
+        # Build the MD tag for the aligned part
+        md_parts = []
+        matches = 0
+        for j in xrange(options.read_length - clip):
+            if random.random() < options.mismatch_rate:
+                md_parts.append("{}{}".format(matches, random.choice(bases)))
+                matches = 0
+            else:
+                matches += 1
+
+            if random.random() < options.deletion_rate:
+                md_parts.append("{}^{}".format(matches, "".join(
+                    random.choice(bases) for k in xrange(random.randint(1,
+                    3)))))
+                matches = 0
+        md_parts.append(str(matches))
+
+        sequence = "".join(random.choice(bases)
+            for j in xrange(options.read_length))
+
+        yield "\t".join(["read{}".format(i), "0", contig, "1000", "60", cigar,
+            "*", "0", "0", sequence, "I" * options.read_length,
+            "MD:Z:{}".format("".join(md_parts))]) + "\n"
+
+def md_inputs(sam_line):
+    """
+    Get the MD tag string, the read offset where it starts, and the input read
+    length from the given SAM line, or None if it isn't an alt alignment with
+    an MD tag.
+
+    """
+
+    parts = sam_line.rstrip("\n").split("\t")
+
+    if not parts[2].endswith("_alt") or parts[5] == "*":
+        return None
+
+    md_tags = [tag[5:] for tag in parts[11:] if tag.startswith("MD:Z:")]
+    if len(md_tags) == 0:
+        return None
+
+    # Work out the input length and clipping from the CIGAR
+    cigar = [(int(count), op) for count, op in re.findall("([0-9]+)([A-Z=])",
+        parts[5])]
+    length = sum(count for count, op in cigar if op not in "DNP")
+    offset = cigar[0][0] if cigar[0][1] in "SH" else 0
+
+    return md_tags[0], offset, length
+
+def check_with_dict(md_string, offset, length):
+    """
+    Do the central mismatch check the old way, by building the dict of all the
+    mismatches.
+
+    """
+
+    if length % 2 != 0:
+        return False
+
+    status_per_base = smartSam2Fastq.parse_MD_tag(md_string, offset, length)
+    return (status_per_base.has_key(length / 2) or
+        status_per_base.has_key(length / 2 + 1))
+
+def check_with_scan(md_string, offset, length):
+    """
+    Do the central mismatch check with the single-pass scan.
+
+    """
+
+    return length % 2 == 0 and smartSam2Fastq.md_has_mismatch(md_string,
+        offset, length / 2, length / 2 + 1)
+
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    options = parse_args(args) # This holds the nicely-parsed options object
+
+    random.seed(options.seed)
+
+    if options.input_sam is not None:
+        sam_lines = (line for line in options.input_sam
+            if not line.startswith("@"))
+    else:
+        sam_lines = synthetic_sam(options)
+
+    # Pull out everything we need to check, before timing anything
+    inputs = [found for found in itertools.imap(md_inputs, sam_lines)
+        if found is not None]
+    md_strings, offsets, lengths = zip(*inputs) if len(inputs) > 0 else (
+        [], [], [])
+
+    sys.stderr.write("Checking {} alt alignments\n".format(len(inputs)))
+
+    # Make sure everything agrees
+    old_results = [check_with_dict(*found) for found in inputs]
+    if [check_with_scan(*found) for found in inputs] != old_results:
+        raise RuntimeError("Scan disagrees with parse_MD_tag")
+    if smartSam2Fastq.central_mismatches(md_strings, offsets,
+        lengths) != old_results:
+        raise RuntimeError("Batch check disagrees with parse_MD_tag")
+
+    # Time everything
+    checks = [
+        ("parse_MD_tag", lambda: [check_with_dict(*found)
+            for found in inputs]),
+        ("md_has_mismatch", lambda: [check_with_scan(*found)
+            for found in inputs]),
+        ("central_mismatches", lambda: smartSam2Fastq.central_mismatches(
+            md_strings, offsets, lengths))
+    ]
+
+    # Remember the old time to compare against
+    baseline = None
+
+    for name, check in checks:
+        seconds = min(timeit.repeat(check, repeat=options.repeats, number=1))
+        if baseline is None:
+            baseline = seconds
+
+        print "{}\t{:.3f} s\t{:.0f} reads/s\t{:.1f}x".format(name, seconds,
+            len(inputs) / seconds if seconds > 0 else float("inf"),
+            baseline / seconds if seconds > 0 else float("inf"))
+
+    print "{} of {} have central mismatches".format(sum(old_results),
+        len(inputs))
+
+    return 0
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python2.7
+"""
+benchmarkReadExtraction.py: time the read extraction stages of getAltReads.py on
+synthetic alignments from simulateReads.py, without touching EBI.
+
+Each stage runs in its own process, and is reported with its wall-clock time,
+input alignments per second, and the peak resident memory of its biggest
+process. Stages that need samtools are skipped if it isn't installed.
+
+"""
+
+import argparse, sys, os, os.path, random, subprocess, shutil, tempfile, time
+import distutils.spawn
+
+import simulateReads
+import smartSam2Fastq
+
+# These are all the stages we know, in the order we run them
+STAGE_NAMES = ["dedup", "dedup_unsorted", "fastq", "fastq_bgzf",
+    "concat_sort_convert", "concat_unsorted_convert"]
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    Borrows heavily from the argparse documentation examples:
+    <http://docs.python.org/library/argparse.html>
+    """
+
+    # Construct the parser (which is stored in parser)
+    # Module docstring lives in __doc__
+    # See http://python-forum.com/pythonforum/viewtopic.php?f=3&t=36847
+    # And a formatter class so our examples in the docstring look good. Isn't it
+    # convenient how we already wrapped it to 80 characters?
+    # See http://docs.python.org/library/argparse.html#formatter-class
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # General options
+    parser.add_argument("--stages", nargs="+", choices=STAGE_NAMES,
+        default=STAGE_NAMES,
+        help="stages to run (default: all of them)")
+    parser.add_argument("--work_dir", default=None,
+        help="directory to keep inputs and outputs in (default: a temporary "
+        "directory that is deleted afterward)")
+    parser.add_argument("--depth", type=float, default=30,
+        help="read depth to simulate")
+    parser.add_argument("--contig_length", type=int, default=1000000,
+        help="length of the simulated primary contig")
+    parser.add_argument("--alt_fraction", type=float, default=0.3,
+        help="fraction of simulated reads that also align to an alt")
+    parser.add_argument("--secondary_rate", type=float, default=0.1,
+        help="mean number of simulated secondary alignments per read")
+    parser.add_argument("--supplementary_rate", type=float, default=0.05,
+        help="mean number of simulated supplementary alignments per read")
+    parser.add_argument("--read_lengths", type=int, nargs="+",
+        default=[100, 101],
+        help="simulated read lengths to pick from")
+    parser.add_argument("--parts", type=int, default=4,
+        help="number of BAM parts to concatenate, like downloaded ranges")
+    parser.add_argument("--threads", type=int, default=2,
+        help="threads for compression and decompression")
+    parser.add_argument("--max_pending", type=int, default=100000,
+        help="reads to hold in memory in unsorted mode before spilling")
+    parser.add_argument("--seed", type=int, default=0,
+        help="random seed")
+    parser.add_argument("--run_stage", default=None,
+        help=argparse.SUPPRESS)
+    parser.add_argument("--stage_input", default=None,
+        help=argparse.SUPPRESS)
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+def simulation_options(options, out_file, order):
+    """
+    Make simulateReads.py options for simulating into the given file in the
+    given order.
+
+    """
+
+    return simulateReads.parse_args(["simulateReads.py", out_file,
+        "--order", order, "--depth", str(options.depth),
+        "--contig_length", str(options.contig_length),
+        "--alt_fraction", str(options.alt_fraction),
+        "--secondary_rate", str(options.secondary_rate),
+        "--supplementary_rate", str(options.supplementary_rate),
+        "--seed", str(options.seed), "--read_lengths"] +
+        [str(length) for length in options.read_lengths])
+
+def make_inputs(options, work_dir, have_samtools):
+    """
+    Simulate all the inputs the stages use into the given directory, and return
+    the number of alignments in each.
+
+    """
+
+    count = None
+
+    for order in ["name", "random", "coordinate"]:
+        sam_filename = os.path.join(work_dir, "{}.sam".format(order))
+        with open(sam_filename, "w") as sam_file:
+            count = simulateReads.simulate(simulation_options(options,
+                sam_filename, order), sam_file)
+
+    if have_samtools:
+        # Make coordinate-sorted BAM parts, like samtools view gives us for
+        # each range
+        sam_filename = os.path.join(work_dir, "coordinate.sam")
+        header = []
+        parts = [[] for i in xrange(options.parts)]
+        with open(sam_filename) as sam_file:
+            for line in sam_file:
+                if line.startswith("@"):
+                    header.append(line)
+                else:
+                    parts[random.randrange(options.parts)].append(line)
+
+        for i, lines in enumerate(parts):
+            samtools = subprocess.Popen(["samtools", "view", "-b", "-o",
+                os.path.join(work_dir, "part{}.bam".format(i)), "-"],
+                stdin=subprocess.PIPE)
+            samtools.stdin.writelines(header + lines)
+            samtools.stdin.close()
+            if samtools.wait() != 0:
+                raise RuntimeError("Could not make BAM part {}".format(i))
+
+    return count
+
+def run_dedup(options, input_filename):
+    """
+    Parse and deduplicate name-sorted SAM, without writing anything.
+
+    """
+
+    with open(input_filename) as sam_file:
+        for reads_by_end in smartSam2Fastq.parse_and_deduplicate_sam(sam_file):
+            pass
+
+def run_dedup_unsorted(options, input_filename):
+    """
+    Parse and deduplicate SAM in random order, spilling to disk if needed.
+
+    """
+
+    with open(input_filename) as sam_file:
+        for reads_by_end in smartSam2Fastq.deduplicate_unsorted(
+            smartSam2Fastq.parse_sam_reads(sam_file),
+            max_pending=options.max_pending,
+            spill_dir=os.path.dirname(input_filename)):
+            pass
+
+# These are the stages that run in a copy of this script, by name
+IN_PROCESS_STAGES = {
+    "dedup": run_dedup,
+    "dedup_unsorted": run_dedup_unsorted
+}
+
+def stage_commands(options, work_dir):
+    """
+    Return a dict from stage name to (shell command, whether it needs samtools)
+    for every stage.
+
+    """
+
+    python = sys.executable
+    here = os.path.dirname(os.path.abspath(__file__))
+    benchmark = [python, os.path.abspath(__file__)]
+    converter = "{} {}".format(python, os.path.join(here, "smartSam2Fastq.py"))
+    parts = " ".join(os.path.join(work_dir, "part{}.bam".format(i))
+        for i in xrange(options.parts))
+    output = os.path.join(work_dir, "out.fq")
+
+    def path(name):
+        return os.path.join(work_dir, name)
+
+    commands = {}
+
+    for stage, input_name in [("dedup", "name.sam"),
+        ("dedup_unsorted", "random.sam")]:
+        commands[stage] = (" ".join(benchmark + ["--run_stage", stage,
+            "--stage_input", path(input_name), "--max_pending",
+            str(options.max_pending)]), False)
+
+    commands["fastq"] = ("{} --input_sam {} --interleaved --fq1 {}".format(
+        converter, path("name.sam"), output), False)
+    commands["fastq_bgzf"] = ("{} --input_sam {} --interleaved --fq1 {}.gz "
+        "--compress bgzf --compress_threads {}".format(converter,
+        path("name.sam"), output, options.threads), False)
+    commands["concat_sort_convert"] = ("samtools cat {} | samtools sort -n "
+        "-T {} -o - - | {} --input_bam - --threads {} --interleaved "
+        "--fq1 {}".format(parts, path("sort"), converter, options.threads,
+        output), True)
+    commands["concat_unsorted_convert"] = ("samtools cat {} | {} --input_bam - "
+        "--threads {} --unsorted --max_pending {} --spill_dir {} --interleaved "
+        "--fq1 {}".format(parts, converter, options.threads,
+        options.max_pending, work_dir, output), True)
+
+    return commands
+
+def time_command(command):
+    """
+    Run the given shell command, and return its wall clock time in seconds and
+    the peak resident memory of its biggest process in kilobytes.
+
+    Raises RuntimeError if it fails.
+
+    """
+
+    start_time = time.time()
+    process = subprocess.Popen(command, shell=True)
+
+    # Get the resource usage for just this process tree. Linux counts the
+    # biggest descendant the shell waited for in its maximum RSS.
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start_time
+
+    if status != 0:
+        raise RuntimeError("Stage command failed: {}".format(command))
+
+    return elapsed, usage.ru_maxrss
+
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    options = parse_args(args) # This holds the nicely-parsed options object
+
+    if options.run_stage is not None:
+        # We are running a stage for our parent
+        IN_PROCESS_STAGES[options.run_stage](options, options.stage_input)
+        return 0
+
+    random.seed(options.seed)
+
+    have_samtools = distutils.spawn.find_executable("samtools") is not None
+
+    if options.work_dir is None:
+        work_dir = tempfile.mkdtemp()
+    else:
+        work_dir = options.work_dir
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+
+    try:
+        sys.stderr.write("Simulating inputs in {}\n".format(work_dir))
+        count = make_inputs(options, work_dir, have_samtools)
+
+        commands = stage_commands(options, work_dir)
+
+        print "stage\tseconds\talignments/s\tpeak_rss_mb"
+
+        for stage in options.stages:
+            command, needs_samtools = commands[stage]
+
+            if needs_samtools and not have_samtools:
+                sys.stderr.write("Skipping {}: no samtools\n".format(stage))
+                continue
+
+            elapsed, peak_rss = time_command(command)
+
+            print "{}\t{:.2f}\t{:.0f}\t{:.1f}".format(stage, elapsed,
+                count / elapsed if elapsed > 0 else float("inf"),
+                peak_rss / 1024.0)
+            sys.stdout.flush()
+
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    return 0
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
@@ -25,6 +25,7 @@ import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
 import doctest, re, json, collections, time, timeit, string
 from toil.job import Job
 from toillib import RealTimeLogger, robust_makedirs
+from regionlib import load_catalog, DEFAULT_REGION_NAMES
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description=__doc__, 
@@ -55,6 +56,10 @@ def parse_args(args):
     parser.add_argument("--skip", type=str, default="",
                         help="comma-separated list of keywords that "
                         "will cause input gam to be skipped if found in path")
+    parser.add_argument("--region_catalog", type=str, default=None,
+                        help="region catalog .json (or alt scaffold placement "
+                        "file) to check region names against, instead of the "
+                        "built-in list")
     
     args = args[1:]
         
@@ -112,9 +117,22 @@ def alignment_region_tag(alignment_path, options):
     """ say alignment is bla/gcsa/real/camel-brca1.gam, then return brca1
     """
     region = alignment_path.split("/")[-3]
-    assert region in ["brca1", "brca2", "cenx", "lrc_kir", "sma", "mhc"]
+    # Scripts that don't load a catalog check against the built-in list
+    assert region.upper() in getattr(options, "region_names",
+                                     DEFAULT_REGION_NAMES)
     return region
 
+def load_region_names(options):
+    """ set options.region_names from the --region_catalog option, or to the
+    built-in list if there isn't one
+    """
+    if options.region_catalog is not None:
+        # Only the names go to the jobs
+        options.region_names = load_catalog(
+            options.region_catalog).region_names()
+    else:
+        options.region_names = DEFAULT_REGION_NAMES
+
 def alignment_graph_tag(gam_path, options):
     """ extract the graph method name from gam path
     """
@@ -298,6 +316,8 @@ def main(args):
     
     options = parse_args(args) 
     
+    load_region_names(options)
+    
     RealTimeLogger.start_master()
 
     filtered_gams = []
@@ -11,7 +11,7 @@ from toil.job import Job
 from toillib import RealTimeLogger, robust_makedirs
 from callVariants import sample_vg_path, augmented_vg_path, alignment_region_tag, alignment_graph_tag
 from callVariants import graph_path, index_path, augmented_vg_path, linear_vg_path, linear_vcf_path, sample_vg_path
-from callVariants import alignment_region_tag
+from callVariants import load_region_names
 from clusterGraphs import comp_path
 
 def parse_args(args):
@@ -53,6 +53,10 @@ def parse_args(args):
     parser.add_argument("--only_summary", action="store_true", default=False,
                         help="Only generate summary output.  Do not do any"
                         " compute")    
+    parser.add_argument("--region_catalog", type=str, default=None,
+                        help="region catalog .json (or alt scaffold placement "
+                        "file) to check region names against, instead of the "
+                        "built-in list")
                             
     args = args[1:]
         
@@ -459,6 +463,8 @@ def main(args):
     
     options = parse_args(args) 
     
+    load_region_names(options)
+    
     RealTimeLogger.start_master()
 
     for gam in options.in_gams:
@@ -8,10 +8,17 @@ server in parallel, using Toil.
 import argparse, sys, os, os.path, random, collections, shutil, itertools, glob
 import urllib2, urlparse, ftplib, fnmatch, subprocess
 import json, logging, logging.handlers, SocketServer, struct, socket, threading
-import time, select
+import time, Queue, hashlib, tempfile, httplib, zlib, bisect, re, fcntl, gzip
+import heapq, doctest
+import stat
+
+from multiprocessing.pool import ThreadPool
 
 from toil.job import Job
-import tsv
+
+from toillib import robust_makedirs, coalesce_ranges, IOStore
+from retrylib import RetryPolicy
+from regionlib import load_catalog
 
 def parse_args(args):
     """
@@ -40,7 +47,8 @@ def parse_args(args):
         "GCA_000001405.17_GRCh38.p2/"
         "GCA_000001405.17_GRCh38.p2_assembly_structure/"
         "all_alt_scaffold_placement.txt",
-        help="URL to download the reference metadata from")
+        help="URL or path to get the alt scaffold placement file from, or a "
+        "saved region catalog .json")
     parser.add_argument("--regions", nargs="*", 
         default=["BRCA1", "BRCA2", "CENX", "MHC", "SMA", "LRC_KIR"],
         help="region names to download reads for")
@@ -60,10 +68,52 @@ def parse_args(args):
         help="reject samples with indexes not covering this many contigs")
     parser.add_argument("--sample_limit", type=int, default=float("inf"), 
         help="number of matching samples to download")
-    parser.add_argument("--ftp_retry", type=int, default=float("inf"), 
-        help="number of times to retry sample downloads")
-    parser.add_argument("out_dir",
-        help="output directory to create and fill with per-region BAM files")
+    parser.add_argument("--ftp_retry", type=int, default=10, 
+        help="number of times to retry sample downloads; servers that keep "
+        "failing are also paused by the circuit breaker")
+    parser.add_argument("--retry_base_delay", type=float, default=2,
+        help="seconds to wait before the first retry of a failed download")
+    parser.add_argument("--retry_max_delay", type=float, default=300,
+        help="longest time to wait between retries")
+    parser.add_argument("--host_connections", type=int, default=8,
+        help="number of requests in flight to one server per node, across "
+        "all jobs (idle pooled connections don't count)")
+    parser.add_argument("--breaker_failures", type=int, default=5,
+        help="consecutive failures before pausing requests to a server")
+    parser.add_argument("--breaker_cooldown", type=float, default=60,
+        help="seconds to pause requests to a failing server for")
+    parser.add_argument("--ftp_connections", type=int, default=8,
+        help="number of FTP connections to use when looking for samples")
+    parser.add_argument("--index_threads", type=int, default=16,
+        help="number of sample indexes to check at once")
+    parser.add_argument("--sample_major", action="store_true",
+        help="download each sample's file once for all regions")
+    parser.add_argument("--empty_retries", type=int, default=2,
+        help="times to retry downloads that come back empty when the index "
+        "says they shouldn't")
+    parser.add_argument("--unsorted", action="store_true",
+        help="don't sort reads by name; deduplicate them in any order instead, "
+        "and save unsorted BAMs")
+    parser.add_argument("--compress_fastq", action="store_true",
+        help="save BGZF-compressed .fq.gz FASTQs instead of plain .fq")
+    parser.add_argument("--coalesce_gap", type=int, default=256 * 1024,
+        help="download CRAM containers this close together in one request")
+    parser.add_argument("--cache_dir", default=None,
+        help="directory to cache FTP listings, index contig counts, and "
+        "region catalogs in")
+    parser.add_argument("--cache_ttl", type=float, default=7 * 24 * 60 * 60,
+        help="seconds to trust cached listings the server can't vouch for")
+    parser.add_argument("--offline", action="store_true",
+        help="use only cached listings and contig counts, even if stale")
+    parser.add_argument("--reference_fasta", default=None,
+        help="local (optionally gzipped) FASTA of the reference the CRAMs use, "
+        "so they can be decoded without the EBI reference server")
+    parser.add_argument("--reference_cache",
+        default=os.path.join(tempfile.gettempdir(), "getAltReads-ref-cache"),
+        help="node-local directory to build the MD5-keyed reference cache in")
+    parser.add_argument("out_store",
+        help="IOStore to fill with per-region BAM and FASTQ files, like "
+        "./directory or azure:account:container/prefix")
     
     # The command line arguments start with the program name, which we don't
     # want to treat as an argument for argparse. So we remove it.
@@ -182,52 +232,43 @@ class RealTimeLogger(object):
         
         return cls.logger
 
-def backoff_times(retries=float("inf"), base_delay=300):
+# This holds the RetryPolicy for this process, once we make it
+_retry_policy = None
+
+def retry_policy(options):
     """
-    A generator that yields times for exponential back-off. Always yields 0
-    first, and then if you have nonzero retries it yields exponentially but
-    randomly increasing times in seconds to wait before trying again, stopping
-    at the specified number of retries (and continuing forever by default).
-    
-    You have to do the error catching and sleeping yourself.
+    Get the RetryPolicy for this process, set up from the given options. All
+    the jobs and threads in a process share it, so its metrics cover them all.
     
-    Raises an exception if you use up all your backoff times.
     """
     
-    # Don't wait at all before the first try
-    yield 0
+    global _retry_policy
     
-    # What retry are we on?
-    try_number = 1
-    
-    # Make a delay that increases
-    delay = float(base_delay) * 2
-    
-    while try_number <= retries:
-        # Wait a random amount between 0 and 2^try_number * base_delay
-        yield random.uniform(base_delay, delay)
-        delay *= 2
-        try_number += 1
-        
-    raise RuntimeError("Ran out of retries")
+    if _retry_policy is None:
+        _retry_policy = RetryPolicy(retries=options.ftp_retry,
+            base_delay=options.retry_base_delay,
+            max_delay=options.retry_max_delay,
+            host_connections=options.host_connections,
+            failure_threshold=options.breaker_failures,
+            cooldown=options.breaker_cooldown,
+            logger=RealTimeLogger.get())
+            
+    return _retry_policy
 
-def ftp_connect(url, retries=float("inf")):
+def ftp_connect(url, policy):
     """
     Connect to an FTP server and go to the specified directory with FTPlib.
     
     Return the ftplib connection and the path.
     
-    On errors like timeouts, retry up to the given number of retries (infinite
-    by default) with exponential back-off.
+    On errors like timeouts, or the server saying it has too many connections,
+    retry according to the given RetryPolicy.
     
     """
     
-    for delay in backoff_times(retries=retries):
-        if delay > 0:
-            # We have to wait before trying again
-            RealTimeLogger.get().info("Retry after {} seconds".format(delay))
-            time.sleep(delay)
-        try:
+    for attempt in policy.attempts(url, (IOError, EOFError, ftplib.error_temp),
+        "FTP setup for {}".format(url)):
+        with attempt:
         
             ftp_info = urlparse.urlparse(url)
             assert(ftp_info.scheme == "ftp")
@@ -243,499 +284,1920 @@ def ftp_connect(url, retries=float("inf")):
             
             return ftp, ftp_info.path
             
-        except IOError as e:
-            # Something went wrong doing the IO
-            RealTimeLogger.get().warning(
-                "Retry after FTP setup IO error: {}".format(e))
-            
-
-def explore_path(ftp, path, pattern):
+def local_path(url):
     """
-    Using the given FTP server connection, explore the given path recursively,
-    looking for all files that match the given fnmatch pattern. Yields the paths
-    of those files.
+    If the given URL refers to a local file (because it is a file:// URL or
+    just a plain path), return the local path. Otherwise, return None.
     
     """
     
-    try:
-        ftp.cwd(path)
+    parsed_url = urlparse.urlparse(url)
+    
+    if parsed_url.scheme == "file":
+        return parsed_url.path
+    elif parsed_url.scheme == "":
+        return url
+    else:
+        return None
+        
+def build_reference_cache(fasta_filename, cache_dir):
+    """
+    Make sure the given directory holds an MD5-keyed reference cache for all
+    the sequences in the given FASTA file (which may be gzipped), in the layout
+    samtools' seq_cache_populate.pl makes, so CRAMs can be decoded without going
+    to the network for reference sequences.
+    
+    The cache is only built once per directory and FASTA; other processes on
+    the node wait on a lock file until it is done.
+    
+    Returns the pattern to use for REF_PATH and REF_CACHE.
+    
+    """
+    
+    pattern = os.path.join(cache_dir, "%2s/%2s/%s")
+    
+    # This gets created when we have everything from this FASTA
+    marker = os.path.join(cache_dir, "complete-{}".format(
+        hashlib.sha1(os.path.abspath(fasta_filename)).hexdigest()))
         
-        # List of everything to recurse into
-        to_recurse_on = []
+    if os.path.exists(marker):
+        # Someone already built it
+        return pattern
+        
+    robust_makedirs(cache_dir)
+    
+    with open(os.path.join(cache_dir, "lock"), "w") as lock_file:
+        # Only one process on the node gets to build the cache
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
         
         try:
-            listing = ftp.nlst()
-        except ftplib.error_proto:
-            # For some reason this built-in function sometimes doesn't work. Try
-            # doing it ourselves.
-            
-            RealTimeLogger.get().warning("FTPlib nlst on {} failed. Clearing "
-                "and retrying.".format(path))
-            
-            while True:
-                # Clear out any crap that may be coming over the ftp connection.
-                # Use a 2 second timeout
-                flags = select.select([ftp.sock], [], [], 2)
+            if os.path.exists(marker):
+                # Someone else built it while we were waiting
+                return pattern
                 
-                if not flags[0]:
-                    # Nothing came
-                    break
-                    
-                # Otherwise read some data and select again
-                got = ftp.sock.recv(1024)
-                RealTimeLogger.get().warning("Extra data: {}".format(got))
+            RealTimeLogger.get().info("Building reference cache in {} from "
+                "{}".format(cache_dir, fasta_filename))
             
+            if fasta_filename.endswith(".gz"):
+                fasta = gzip.open(fasta_filename)
+            else:
+                fasta = open(fasta_filename)
+                
+            # This holds the (file, path, MD5 hasher) for the sequence we are
+            # working on
+            current = None
             
-            # Now manually do the listing
-            listing = []
-            ftp.retrlines("NLST", lambda line: listing.append(line))
-        
-        for subitem in listing:
-            # We don't know if these are files or directories.
-            
-            subitem_path = "{}/{}".format(path, subitem)
+            # How many sequences have we done?
+            sequence_count = 0
             
-            print(subitem_path, pattern)
+            for line in itertools.chain(fasta, [">"]):
+                if line.startswith(">"):
+                    if current is not None:
+                        # Finish off the last sequence and put it under its
+                        # MD5, which is what the CRAM header says it wants.
+                        sequence_file, temp_path, hasher = current
+                        sequence_file.close()
+                        
+                        digest = hasher.hexdigest()
+                        final_path = os.path.join(cache_dir, digest[0:2],
+                            digest[2:4], digest[4:])
+                        robust_makedirs(os.path.dirname(final_path))
+                        
+                        if os.path.exists(final_path):
+                            # We already have this sequence
+                            os.unlink(temp_path)
+                        else:
+                            os.rename(temp_path, final_path)
+                            
+                        sequence_count += 1
+                        current = None
+                        
+                    if line != ">":
+                        # Start a new sequence
+                        handle, temp_path = tempfile.mkstemp(dir=cache_dir)
+                        current = (os.fdopen(handle, "w"), temp_path,
+                            hashlib.md5())
+                            
+                elif current is not None:
+                    # The MD5 is over the uppercase sequence without whitespace
+                    bases = "".join(line.split()).upper()
+                    current[0].write(bases)
+                    current[2].update(bases)
+                    
+            fasta.close()
             
-            if fnmatch.fnmatchcase(subitem, pattern):
-                # This is a matching thing!
-                print("Match!")
-                yield subitem_path
-                
-            # Recurse on everything, even things that match the pattern, in case
-            # they are directories.
-            to_recurse_on.append(subitem_path)
+            # Say we're done
+            open(marker, "w").close()
             
-        for item in to_recurse_on:
-            # Recurse down on each thing in turn
-            for found in explore_path(ftp, item, pattern):
-                # Yield anything we find there
-                yield found
-            # Then return to this directory so we're in a known place
-            ftp.cwd(path)
+            RealTimeLogger.get().info("Cached {} reference sequences".format(
+                sequence_count))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
             
-    except ftplib.error_perm as e:
-        error_code = int(e.args[0][:3])
-        if error_code == 550:
-            # We expect to do a lot of CWD-ing to files, raising this
-            pass
-        else:
-            raise e
-        
-def count_indexed_contigs(index_url, retries):
+    return pattern
+    
+def samtools_env(options):
     """
-    Given the URL of a .crai index file, count the number of distinct contigs in
-    the index and return it.
+    Get the environment to run samtools in, so that it decodes CRAMs against the
+    node-local reference cache built from options.reference_fasta (building the
+    cache if needed) instead of fetching reference sequences over the network.
+    
+    Returns None (meaning to inherit our environment) if no reference FASTA was
+    given.
     
-    Basically: curl url | zcat | cut -f1 | uniq | wc -l
     """
     
-    for delay in backoff_times(retries=retries):
-        if delay > 0:
-            # We have to wait before trying again
-            RealTimeLogger.get().info("Retry after {} seconds".format(delay))
-            time.sleep(delay)
-        try:
+    if options.reference_fasta is None:
+        return None
         
-            # Hold all the popen objects we need for this
-            tasks = []
-            
-            # Do the download
-            tasks.append(subprocess.Popen(["curl", "--silent", index_url],
-                stdout=subprocess.PIPE))
-            
-            # Pipe through zcat
-            tasks.append(subprocess.Popen(["zcat"], stdin=tasks[-1].stdout,
-                stdout=subprocess.PIPE))
-            
-            # And cut
-            tasks.append(subprocess.Popen(["cut", "-f1"], stdin=tasks[-1].stdout,
-                stdout=subprocess.PIPE))
-                
-            # And uniq
-            tasks.append(subprocess.Popen(["uniq"], stdin=tasks[-1].stdout,
-                stdout=subprocess.PIPE))
-                
-            # And wc
-            output = subprocess.check_output(["wc", "-l"],
-                stdin=tasks[-1].stdout)
-            
-            # Did we make it through all the tasks OK?
-            success = True
-            for task in tasks:
-                if task.wait() != 0:
-                    RealTimeLogger.get().warning(
-                        "Pipeline failed: {}".format(index_url)) 
-                    success = False
-                    break
-                    
-            if success:
-                # The pipeline worked.
-                # Parse and return the line count
-                return int(output.strip())
-            
-        except subprocess.CalledProcessError as e:
-            # Something went wrong doing the IO
-            RealTimeLogger.get().warning(
-                "Pipeline failed: {}".format(e)) 
+    pattern = build_reference_cache(options.reference_fasta,
+        options.reference_cache)
+        
+    env = dict(os.environ)
+    # Only look in the cache, and don't save anything anywhere else
+    env["REF_PATH"] = pattern
+    env["REF_CACHE"] = pattern
     
-def downloadAllReads(job, options):
+    return env
+
+
+# This holds what an FTP directory listing tells us about an entry. Size and
+# modification time may be None if the server doesn't say.
+FTPEntry = collections.namedtuple("FTPEntry", ["name", "is_directory", "size",
+    "modify"])
+
+# This holds a file found by an FTPCrawler: the sort key giving its position in
+# a serial depth-first scan, the names of the directories it was found under at
+# each patterned level, its path on the server, and the stamp of its index file
+# (or None if no index was asked for).
+FoundFile = collections.namedtuple("FoundFile", ["order", "levels", "path",
+    "index_stamp"])
+
+# This is what an FTPCrawler worker reports when it finishes listing a
+# directory: the directory's order, and the work items for the subdirectories
+# that should be listed next. The crawl generator queues those itself, so it
+# always counts a directory before anyone can list it.
+ListingDone = collections.namedtuple("ListingDone", ["order", "children"])
+
+def entry_stamp(entry):
     """
-    Download all the reads for the regions.
+    Make a string that should change when the given FTPEntry's file or
+    directory changes, from its size and modification time, or None if the
+    server didn't tell us either.
     
     """
     
-    # Initialize logging
-    RealTimeLogger.set_master(options)
+    if entry.size is None and entry.modify is None:
+        return None
+        
+    return "{}:{}".format(entry.size, entry.modify)
     
-    RealTimeLogger.get().info("Starting download")
+class ListingCache(object):
+    """
+    On-disk cache of things we learn from the FTP server, like directory
+    listings and index contig counts, so repeated discovery runs can skip the
+    network for things that haven't changed.
     
-    # First make the output directory
-    if not os.path.exists(options.out_dir):
-        try:
-            # Make it if it doesn't exist
-            os.makedirs(options.out_dir)
-        except OSError:
-            # If you can't make it, maybe someone else did?
-            pass
-            
-    # Whatever happens, it needs to exist here
-    assert(os.path.exists(options.out_dir) and os.path.isdir(options.out_dir))
-    
-    # Holds the chromosome number for each region?
-    region_chromosomes = {}
-    # Holds the minimum start position for each region on its chromosome
-    region_starts = collections.defaultdict(lambda: float("inf"))
-    # Holds the maximum stop position for each region on its chromosome
-    region_stops = collections.defaultdict(lambda: float("-inf"))
-    
-    # Holds the contig:start-end string for each alt in a given region
-    # The reference range gets added in last
-    ranges_by_region = collections.defaultdict(list)
-    
-    # Hard-code some regions that aren't real
-    ranges_by_region["BRCA1"] = ["chr17:43044294-43125482"]
-    ranges_by_region["BRCA2"] = ["chr13:32314861-32399849"]
-    ranges_by_region["CENX"] = ["chrX:58605580-62412542"]
-    
-    # Read the reference database
-    database = tsv.TsvReader(urllib2.urlopen(options.reference_metadata))
-    
-    for parts in database:
-        # Parse out all the info for this alt and its parent chromosome
-        region_name = parts[7]
-        # Grab the chromosome ("1" or "X") that's the parent
-        parent_chromosome = parts[5]
-        parent_start = int(parts[11])
-        parent_stop = int(parts[12])
-        alt_contig = parts[3]
-        alt_start = int(parts[9])
-        alt_stop = int(parts[10])
-        
-        # Note the region start, stop, and parent chromosome number
-        region_chromosomes[region_name] = parent_chromosome
-        region_starts[region_name] = min(region_starts[region_name],
-            parent_start)
-        region_stops[region_name] = max(region_stops[region_name],
-            parent_stop)
-            
-        # Turn the alt name into the proper format (GL000251.2 to
-        # chr6_GL000251v2_alt)
-        name_parts=alt_contig.split(".")
-        fixed_alt_contig = "chr{}_{}v{}_alt".format(parent_chromosome,
-            name_parts[0], name_parts[1])
-            
-        # Add it to the list for its region
-        ranges_by_region[region_name].append("{}:{}-{}".format(
-            fixed_alt_contig, alt_start, alt_stop))
-                
-    for region_name in region_chromosomes.iterkeys():
-        # Add in the reference ranges that all the alts are alternatives to
-        ranges_by_region[region_name].append("chr{}:{}-{}".format(
-            region_chromosomes[region_name], region_starts[region_name], 
-            region_stops[region_name]))
-            
-
-    ftp, root_path = ftp_connect(options.sample_ftp_root)
+    Each entry is a JSON file named for a hash of its kind and URL. Entries can
+    be saved with a stamp (see entry_stamp); they are good for as long as the
+    server reports the same stamp. Entries without stamps are good for the
+    cache's TTL.
     
-    # Calculate the FTP base URL (without directory). We need it later for
-    # turning found index files into URLs.
-    base_url = options.sample_ftp_root[:-len(root_path)]
+    Safe to use from multiple threads or processes at once.
     
-    # Dump the good data files for samples
-    good_samples = open("{}/good.txt".format(options.out_dir), "w")
+    """
     
-    # Grab all the population names that match the population pattern
-    population_names = [n for n in ftp.nlst() if fnmatch.fnmatchcase(n,
-        options.population_pattern)]
+    def __init__(self, cache_dir=None, ttl=7 * 24 * 60 * 60, offline=False):
+        """
+        Make a cache in the given directory, or a cache that never has anything
+        if the directory is None. Unstamped entries expire after the given TTL
+        in seconds.
         
-    # TODO: We'll go through them in this order, so if you want a representative
-    # subsampling, add some shuffle here or something.
-
-    for population_name in population_names:
-    
-        # For each of those, we need to get samples
-        # Go to the population root
-        ftp.cwd("{}/{}".format(root_path, population_name))
+        If offline is set, all entries are used no matter how old they are.
         
-        # Grab all the sample names that match the sample name pattern.
-        # Hopefully there aren't too many.
-        sample_names = [n for n in ftp.nlst() if fnmatch.fnmatchcase(n,
-            options.sample_pattern)]
+        """
         
-        # This holds URLs to data files (BAM/CRAM) with indexes that are on a
-        # sufficient number of contigs, by sample name. We take the first
-        # sufficiently good file for any sample.
-        sample_file_urls = {}
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
         
-        # TODO: handle failures during explore_path?
-        for sample_name in sample_names:
-            # For every sample
-            
-            print("Try {}".format(sample_name))
+        if self.cache_dir is not None:
+            robust_makedirs(self.cache_dir)
             
-            for data_name in explore_path(ftp, "{}/{}/{}".format(root_path,
-                population_name, sample_name), options.file_pattern):
-                # Find its data files (there may be several)
-                
-                # Get the index for each
-                index_name = data_name + options.index_suffix
-                
-                print(index_name)
-                
-                # Count up the contigs it indexes over
-                indexed_contigs = count_indexed_contigs("{}/{}".format(
-                    base_url, index_name), options.ftp_retry)
-                    
-                if indexed_contigs >= options.min_indexed_contigs:
-                    # This file for this sample is good enough
-                    sample_file_urls[sample_name] = "{}/{}".format(base_url,
-                        data_name)
-                    
-                    RealTimeLogger.get().info(
-                        "Sample {} has index of {} contigs".format(sample_name,
-                        indexed_contigs))
-                    # Add the sample to the file we spit out
-                    good_samples.write("{}\n".format(sample_name))
-                    
-                    # Don't finish exploring the path
-                    break
-                    
-                else:
-                    # Complain
-                    RealTimeLogger.get().warning(
-                        "Sample {} has index on too few contigs ({})."
-                        "Skipping!".format(sample_name, indexed_contigs))
-                    
-            if len(sample_file_urls) >= options.sample_limit:
-                # We got enough. Don't finish this population
-                break
-                
-        if len(sample_file_urls) >= options.sample_limit:
-                # We got enough. Don't check more populations
-                break
+    def entry_path(self, kind, url):
+        """
+        Get the file that holds the entry of the given kind for the given URL.
+        
+        """
+        
+        return os.path.join(self.cache_dir, "{}-{}.json".format(kind,
+            hashlib.sha1(url).hexdigest()))
+        
+    def get(self, kind, url, stamp=None):
+        """
+        Get the cached value of the given kind for the given URL, or None if we
+        don't have a good one. If the stamp is not None, it must match the stamp
+        the entry was stored with.
+        
+        """
+        
+        if self.cache_dir is None:
+            return None
             
-    good_samples.close()
+        try:
+            with open(self.entry_path(kind, url)) as entry_file:
+                entry = json.load(entry_file)
+        except (IOError, ValueError):
+            # It isn't there, or someone died writing it
+            return None
             
-    RealTimeLogger.get().info("Got {} sample URLs".format(
-        len(sample_file_urls)))
-    
-    if(options.sample_limit < float("inf")):
-        # Make sure we got as many as we wanted.
-        assert(len(sample_file_urls) == options.sample_limit)
-    
-    for region_name in options.regions:
-        for sample_name, sample_url in sample_file_urls.iteritems():
-        
-            # Make sure the sample directory exists
-            sample_dir = "{}/{}/{}".format(options.out_dir, region_name,
-                sample_name)
+        if entry["url"] != url:
+            # Hash collision
+            return None
             
-            if not os.path.exists(sample_dir):
-                try:
-                    # Make it if it doesn't exist
-                    os.makedirs(sample_dir)
-                except OSError:
-                    # If you can't make it, maybe someone else did?
-                    pass
-                    
-            assert(os.path.exists(sample_dir) and os.path.isdir(sample_dir))
+        if self.offline:
+            # Take whatever we have
+            return entry["value"]
             
-            # Where will this sample's BAM for this region go?
-            bam_filename = "{}/{}.bam".format(sample_dir, sample_name)
+        if stamp is not None:
+            # The server told us what the thing looks like now
+            return entry["value"] if entry["stamp"] == stamp else None
             
-            RealTimeLogger.get().info("Making child for {} x {}: {}".format(
-                region_name, sample_name, sample_url))
+        if time.time() - entry["time"] <= self.ttl:
+            # We can't check it, but it's recent enough
+            return entry["value"]
+        
+        return None
+        
+    def put(self, kind, url, value, stamp=None):
+        """
+        Save the given JSON-able value of the given kind for the given URL,
+        with the given stamp.
+        
+        """
+        
+        if self.cache_dir is None:
+            return
             
-            # Now kick off a job to download all the ranges for the region in
-            # parallel for this sample, and then concatenate them together. Tell
-            # it to save the results to a file on a shared filesystem.
-            job.addChildJobFn(downloadRegion, options, region_name, 
-                sample_url, ranges_by_region[region_name], bam_filename, 
-                cores=1, memory="1G", disk=0)
-                
-    RealTimeLogger.get().info("Done making children")
-   
-def downloadRegion(job, options, region_name, file_url, range_list,
-    bam_filename):
+        entry = {
+            "url": url,
+            "stamp": stamp,
+            "time": time.time(),
+            "value": value
+        }
+        
+        # Write to a temp file and move it into place, so nobody sees half an
+        # entry.
+        handle, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(handle, "w") as temp_file:
+            json.dump(entry, temp_file)
+        os.rename(temp_path, self.entry_path(kind, url))
+
+def parse_mlsd_line(line):
     """
-    Download all the ranges given for the given region from the given sample
-    data file URL, concatenate them, and save them to the given BAM.
+    Parse a line of MLSD output into an FTPEntry, or None for entries for the
+    directory itself and its parent.
     
     """
     
-    RealTimeLogger.set_master(options)
+    # Facts are semicolon-separated, and then there's a space and the name
+    facts_string, name = line.split(" ", 1)
     
-    # TODO: implement
-    RealTimeLogger.get().info("Supposed to download {} ranges {} to {}".format(
-        file_url, range_list, bam_filename))
-        
-    # For each region, we get a promise of a returned file store file ID. This
-    # holds them.
-    part_promises = []
+    facts = {}
+    for fact in facts_string.split(";"):
+        if "=" in fact:
+            key, value = fact.split("=", 1)
+            facts[key.lower()] = value
+            
+    entry_type = facts.get("type", "").lower()
     
-    # We just have the one file
+    if entry_type in ("cdir", "pdir"):
+        # This is . or ..
+        return None
     
-    for range_string in range_list:
-        # For every range we want from it...
-        
-        # Set up a child job to grab it that returns a file store ID for the
-        # BAM file it gets. Right now these are promises, but they get
-        # filled in later.
-        part_promises.append(job.addChildJobFn(downloadRange, options,
-            file_url, range_string, cores=1, memory="1G",
-            disk="50G").rv())
-                
-    # Make a follow-on that concatenates the parts together
-    job.addFollowOnJobFn(concatAndSortBams, options, part_promises,
-        bam_filename, cores=1, memory="4G", disk="50G")
+    size = facts.get("size")
         
+    return FTPEntry(name, entry_type == "dir",
+        int(size) if size is not None else None, facts.get("modify"))
         
-def downloadRange(job, options, file_url, range_string):
+def parse_list_line(line):
     """
-    Download the given range from the given HTSlib file, put the resultiung BAM
-    in the file store, and return its file ID.
+    Parse a line of Unix-style LIST output into an FTPEntry, or None if it
+    isn't a line about a real entry.
+    
+    Symlinks are treated as files.
     
     """
     
-    RealTimeLogger.set_master(options)
+    # Permissions, links, owner, group, size, month, day, time or year, name
+    parts = line.split(None, 8)
     
-    # Where should we save the bam locally?
-    bam_filename = "{}/download.bam".format(job.fileStore.getLocalTempDir())
+    if len(parts) < 9:
+        # This is something like a "total" line
+        return None
+        
+    permissions, size, name = parts[0], parts[4], parts[8]
     
-    for delay in backoff_times(retries=options.ftp_retry):
-        if delay > 0:
-            # We have to wait before trying again
-            RealTimeLogger.get().info("Retry after {} seconds".format(delay))
-            time.sleep(delay)
-        try:
-            # Try running the download
-            RealTimeLogger.get().info("Trying to download {} from {}".format(
-                range_string, file_url))
-            subprocess.check_call(["samtools", "view", "-b", "-o", bam_filename,
-                file_url, range_string])
-                
-            # Make sure there's actually reads in its file.
-            lines = subprocess.check_output(["samtools", "flagstat",
-                bam_filename])
-                
-            # Badly parse the flagstat output for the very first number (QC-
-            # passed reads)
-            reads_found = int(lines.split()[0])
-                
-            if reads_found > 0:
-                
-                # If we get here it worked
-                break
-            else:
-                # Complain we downloaded and there were no reads
-                RealTimeLogger.get().warning(
-                    "No reads! Need to retry download of {}".format(file_url))
-                    
-            # TODO: Catch a partial download somehow
-        except subprocess.CalledProcessError as e:
-                # Complain we need to retry
-                RealTimeLogger.get().warning(
-                    "Need to retry download of {}".format(file_url))
-                # But keep looping
-                    
-    # Put the BAM in the file store with a new ID
-    file_id = job.fileStore.writeGlobalFile(bam_filename, cleanup=False)
-
-    RealTimeLogger.get().info("Wrote file to ID {}".format(file_id))
+    if permissions.startswith("l"):
+        # Drop the link target
+        name = name.split(" -> ", 1)[0]
+        
+    if name in (".", ".."):
+        return None
     
-    return file_id
+    return FTPEntry(name, permissions.startswith("d"),
+        int(size) if size.isdigit() else None, " ".join(parts[5:8]))
     
-def concatAndSortBams(job, options, bam_ids, output_filename):
+def list_ftp_directory(ftp, path, use_mlsd=True):
     """
-    Takes in a list of BAM file IDs in the file store, concatenates and sorts
-    them by template name, and puts the result in the specified shared
-    filesystem file.
+    List the given directory on the given FTP connection, without changing
+    directory. Uses MLSD if use_mlsd is set and the server supports it, and LIST
+    otherwise.
     
-    Also creates an interleaved FASTQ file of the paired reads at
-    <output_filename>.fq
+    Returns a list of FTPEntry objects sorted by name, and whether MLSD worked,
+    so callers can stop trying it on servers that don't have it.
     
     """
     
-    RealTimeLogger.set_master(options)
-    
-    RealTimeLogger.get().info("Building {} from IDs {}".format(output_filename,
-        bam_ids))
+    lines = []
     
-    # Where do we put the concatenated bam?
-    concat_filename = "{}/concat.bam".format(
-        job.fileStore.getLocalTempDir())
+    if use_mlsd:
+        try:
+            ftp.retrlines("MLSD {}".format(path), lines.append)
+            
+            return sorted((entry for entry in (parse_mlsd_line(line)
+                for line in lines) if entry is not None),
+                key=lambda entry: entry.name), True
+        except ftplib.error_perm as e:
+            if not str(e).startswith("50"):
+                # This isn't a command-not-understood error
+                raise
+            
+            # Otherwise fall back to LIST
+            lines = []
+            
+    ftp.retrlines("LIST {}".format(path), lines.append)
     
-    if len(bam_ids) > 1:
-        RealTimeLogger.get().info("Concatenating...")
-        
-        # What input BAMs do we want?
-        input_files = [job.fileStore.readGlobalFile(bam_id)
-            for bam_id in bam_ids]
+    return sorted((entry for entry in (parse_list_line(line)
+        for line in lines) if entry is not None),
+        key=lambda entry: entry.name), False
         
-        # Do the concatenation
-        subprocess.check_call(["samtools", "cat", "-o", concat_filename] +
-            input_files)
-    elif len(bam_ids) == 1:
-        RealTimeLogger.get().info("Skip concatenation...")
-        
-        # Just grab the file for the one BAM
-        job.fileStore.readGlobalFile(bam_ids[0], concat_filename)
-    else:
-        raise RuntimeError("Got no BAM parts!")
-    
-    RealTimeLogger.get().info("Creating {}".format(output_filename))
+def list_local_directory(path):
+    """
+    List the given local directory like list_ftp_directory lists an FTP one.
     
-    # Make up a prefix for sort. It gets .bam appended
-    sort_prefix = "{}/sort".format(job.fileStore.getLocalTempDir())
+    Returns a list of FTPEntry objects sorted by name.
     
-    # Do the sort into the temp file
-    subprocess.check_call(["samtools", "sort", "-n", concat_filename,
-        sort_prefix])
+    """
     
+    entries = []
     
+    try:
+        names = os.listdir(path)
+    except OSError as e:
+        # We can't list this. Skip it.
+        RealTimeLogger.get().warning("Cannot list {}: {}".format(path, e))
+        return entries
     
-    # Convert to FASTQ
-    # Decide on the temp filename
-    fastq_filename = "{}/reads.fq".format(job.fileStore.getLocalTempDir())
-    RealTimeLogger.get().info("Creating {}.fq".format(output_filename))
+    for name in names:
+        try:
+            info = os.stat(os.path.join(path, name))
+        except OSError:
+            # Probably a broken link
+            continue
+            
+        is_directory = stat.S_ISDIR(info.st_mode)
+        entries.append(FTPEntry(name, is_directory,
+            None if is_directory else info.st_size, str(int(info.st_mtime))))
+            
+    return sorted(entries, key=lambda entry: entry.name)
+
+class FTPCrawler(object):
+    """
+    Explore an FTP server with a pool of connections, looking for files that
+    match a pattern. Local directory trees can be crawled too.
     
-    # View the sam and pipe it through the sort of smart converter
-    view = subprocess.Popen(["samtools", "view", "{}.bam".format(sort_prefix)],
-        stdout=subprocess.PIPE)
-    subprocess.check_call(["./smartSam2Fastq.py", "--interleaved", "--fq1",
-        fastq_filename], stdin=view.stdout)
+    The first few levels of directories under the root must match a list of
+    fnmatch patterns (for example, population and then sample names), and
+    directories that don't are never listed. Below those levels, every
+    directory is explored. We tell files from directories from the listings
+    themselves, so we never try to go into files.
     
-    # Wait and detect errors
-    view.wait()
-    assert(view.returncode == 0)
+    """
     
-    # Move it
-    shutil.move("{}.bam".format(sort_prefix), output_filename)
-    shutil.move(fastq_filename, "{}.fq".format(output_filename))
+    def __init__(self, root_url, level_patterns, file_pattern, connections=8,
+        policy=None, index_suffix=None, cache=ListingCache()):
+        """
+        Prepare to crawl the given FTP URL with the given number of connections,
+        using the given list of patterns for the top levels of directories, and
+        the given pattern for files.
         
-def main():
-    options = parse_args(sys.argv) # This holds the nicely-parsed options object
+        Directory listings are retried according to the given RetryPolicy (or a
+        default one), and are saved in and loaded from the given ListingCache.
+        
+        If index_suffix is set, matching files without a file with that suffix
+        next to them are skipped, and the stamps of the index files are reported.
+        
+        """
+        
+        self.root_url = root_url
+        self.root_path = urlparse.urlparse(root_url).path
+        # Are we crawling the local filesystem instead of a server?
+        self.local = local_path(root_url) is not None
+        self.level_patterns = level_patterns
+        self.file_pattern = file_pattern
+        self.connections = connections
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.index_suffix = index_suffix
+        self.cache = cache
+        
+        # This holds (path, depth, levels, order, stamp) tuples for directories
+        # to list, or None to tell a worker to stop.
+        self.work = Queue.Queue()
+        
+        # This holds FoundFiles, ListingDones, and exceptions from workers.
+        self.results = Queue.Queue()
+        
+        # This holds the number of times each directory order has been queued
+        # minus the number of times it has been listed.
+        self.pending = collections.defaultdict(int)
+        # This is a heap of the orders that may have positive counts
+        self.pending_heap = []
+        
+        # This gets set when we're done and workers should stop
+        self.stopped = threading.Event()
+        
+        self.threads = []
+        
+    def list_directory(self, state, path, stamp=None):
+        """
+        List the given directory with retries, using and updating the given
+        worker state dict holding an FTP connection and whether MLSD works.
+        
+        Uses the cached listing if the cache has one that still matches the
+        given stamp.
+        
+        """
+        
+        if self.local:
+            # No need to cache or retry anything
+            return list_local_directory(path)
+        
+        url = urlparse.urljoin(self.root_url, path)
+        
+        cached = self.cache.get("listing", url, stamp)
+        if cached is not None:
+            # We don't need to go to the server
+            return [FTPEntry(*fields) for fields in cached]
+            
+        if self.cache.offline:
+            # We can't go to the server
+            RealTimeLogger.get().warning("No cached listing for {} in offline "
+                "mode".format(url))
+            return []
+        
+        entries = self.list_directory_uncached(state, path)
+        self.cache.put("listing", url, entries, stamp)
+        return entries
+        
+    def list_directory_uncached(self, state, path):
+        """
+        List the given directory from the server, with retries, using and
+        updating the given worker state.
+        
+        """
+        
+        # These are the errors that we can fix by reconnecting
+        retry_on = (ftplib.error_temp, ftplib.error_proto, EOFError, IOError)
+        
+        for attempt in self.policy.attempts(self.root_url, retry_on,
+            "FTP listing of {}".format(path)):
+            with attempt:
+                try:
+                    if state["ftp"] is None:
+                        # We need a new connection
+                        state["ftp"], _ = ftp_connect(self.root_url,
+                            self.policy)
+                    
+                    entries, state["use_mlsd"] = list_ftp_directory(
+                        state["ftp"], path, state["use_mlsd"])
+                    
+                    return entries
+                    
+                except ftplib.error_perm as e:
+                    if str(e).startswith("550"):
+                        # We can't list this. Skip it.
+                        RealTimeLogger.get().warning(
+                            "Cannot list {}: {}".format(path, e))
+                        return []
+                    raise
+                    
+                except retry_on:
+                    # The connection is probably in a bad state, so make a new
+                    # one next time.
+                    if state["ftp"] is not None:
+                        try:
+                            state["ftp"].close()
+                        except Exception:
+                            pass
+                    state["ftp"] = None
+                    raise
+        
+    def worker(self):
+        """
+        Run a worker thread that lists directories until told to stop.
+        
+        """
+        
+        # Each worker has its own connection
+        state = {"ftp": None, "use_mlsd": True}
+        
+        try:
+            while not self.stopped.is_set():
+                item = self.work.get()
+                
+                if item is None:
+                    # We are done
+                    break
+                    
+                path, depth, levels, order, stamp = item
+                
+                # What directories did we find to look in?
+                children = []
+                
+                entries = self.list_directory(state, path, stamp)
+                
+                # Index the entries by name so we can find index files
+                entries_by_name = {entry.name: entry for entry in entries}
+                
+                for index, entry in enumerate(entries):
+                    
+                    entry_path = "{}/{}".format(path.rstrip("/"), entry.name)
+                    
+                    if entry.is_directory:
+                        if depth < len(self.level_patterns):
+                            if not fnmatch.fnmatchcase(entry.name,
+                                self.level_patterns[depth]):
+                                # Prune directories that can't have anything
+                                # we want
+                                continue
+                            
+                            # Remember what we went through at this level
+                            entry_levels = levels + (entry.name,)
+                        else:
+                            entry_levels = levels
+                        
+                        children.append((entry_path, depth + 1, entry_levels,
+                            order + (index,), entry_stamp(entry)))
+                        
+                    elif (depth >= len(self.level_patterns) and
+                        fnmatch.fnmatchcase(entry.name, self.file_pattern)):
+                        # This is a matching file
+                        
+                        index_stamp = None
+                        if self.index_suffix is not None:
+                            index_entry = entries_by_name.get(
+                                entry.name + self.index_suffix)
+                            
+                            if index_entry is None:
+                                # We can't use this without an index
+                                RealTimeLogger.get().warning(
+                                    "No index for {}".format(entry_path))
+                                continue
+                                
+                            index_stamp = entry_stamp(index_entry)
+                        
+                        self.results.put(FoundFile(order + (index,), levels,
+                            entry_path, index_stamp))
+                            
+                # Say this directory is done
+                self.results.put(ListingDone(order, children))
+        except Exception as e:
+            # Send the problem to the main thread
+            self.results.put(e)
+        finally:
+            if state["ftp"] is not None:
+                try:
+                    state["ftp"].quit()
+                except Exception:
+                    pass
+                    
+    def note_pending(self, order, change):
+        """
+        Add the given change to the pending count for the directory with the
+        given order.
+        
+        """
+        
+        self.pending[order] += change
+        
+        if self.pending[order] > 0 and change > 0:
+            heapq.heappush(self.pending_heap, order)
+        elif self.pending[order] == 0:
+            del self.pending[order]
+            
+    def frontier(self):
+        """
+        Get the order of the first directory, in a serial depth-first scan,
+        that hasn't been listed yet, or None if everything has been listed.
+        
+        Every file that crawl() hasn't yielded yet comes after this in a serial
+        scan, so any file found before it is in its final place.
+        
+        """
+        
+        while (len(self.pending_heap) > 0 and
+            self.pending.get(self.pending_heap[0], 0) <= 0):
+            # Drop directories that are done
+            heapq.heappop(self.pending_heap)
+            
+        if len(self.pending_heap) == 0:
+            return None
+            
+        return self.pending_heap[0]
+        
+    def crawl(self):
+        """
+        Crawl the server, yielding FoundFiles as they are found. They will not
+        necessarily come out in order; use frontier() to tell when all the
+        files before a given one have been yielded.
+        
+        Every file is found, however the workers race each other:
+        
+        >>> root = tempfile.mkdtemp()
+        >>> for population, sample in itertools.product(xrange(6), xrange(4)):
+        ...     path = os.path.join(root, "POP{}".format(population),
+        ...         "NA{}".format(sample), "alignment")
+        ...     os.makedirs(path)
+        ...     for i in xrange(5):
+        ...         open(os.path.join(path, "{}.cram".format(i)), "w").close()
+        >>> counts = collections.Counter(len(list(FTPCrawler(root, ["*", "NA*"],
+        ...     "*.cram", connections=8).crawl())) for trial in xrange(200))
+        >>> shutil.rmtree(root)
+        >>> counts
+        Counter({120: 200})
+        
+        """
+        
+        for i in xrange(self.connections):
+            # Start up the workers
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            
+        # Start at the root
+        self.work.put((self.root_path, 0, (), (), None))
+        self.note_pending((), 1)
+        
+        # How many directories are queued or being listed?
+        outstanding = 1
+        
+        try:
+            while outstanding > 0:
+                message = self.results.get()
+                
+                if isinstance(message, FoundFile):
+                    yield message
+                elif isinstance(message, Exception):
+                    raise message
+                else:
+                    # A listing finished and found some more to list. Count
+                    # them before queueing them, so we can't hear about them
+                    # finishing first.
+                    outstanding += len(message.children) - 1
+                    
+                    for child in message.children:
+                        # The order is the fourth thing in the work item
+                        self.note_pending(child[3], 1)
+                        self.work.put(child)
+                    self.note_pending(message.order, -1)
+                    
+            # All the workers are idle now, so wait for them to hang up
+            self.stop(wait=True)
+        finally:
+            self.stop()
+            
+    def stop(self, wait=False):
+        """
+        Stop all the workers, even if the crawl isn't done. If wait is set,
+        wait for them to finish.
+        
+        """
+        
+        if not self.stopped.is_set():
+            self.stopped.set()
+            for thread in self.threads:
+                self.work.put(None)
+            
+        if wait:
+            for thread in self.threads:
+                thread.join()
+            
+class ConnectionPool(object):
+    """
+    Keep open connections to HTTP and FTP servers, so we can make lots of
+    requests without setting up a new connection for each one. Local files and
+    file:// URLs are read directly.
+    
+    Safe to use from multiple threads.
+    
+    """
+    
+    def __init__(self, policy=None):
+        """
+        Make a new empty pool. FTP connections are retried according to the
+        given RetryPolicy (or a default one).
+        
+        """
+        
+        self.policy = policy if policy is not None else RetryPolicy()
+        
+        # This holds lists of idle connections by (scheme, netloc)
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        
+    def take(self, parsed_url):
+        """
+        Get a connection to the server for the given parsed URL, either from the
+        pool or new.
+        
+        """
+        
+        key = (parsed_url.scheme, parsed_url.netloc)
+        
+        with self.lock:
+            if len(self.idle[key]) > 0:
+                return self.idle[key].pop()
+        
+        if parsed_url.scheme == "ftp":
+            ftp, _ = ftp_connect("ftp://{}/".format(parsed_url.netloc),
+                self.policy)
+            return ftp
+        elif parsed_url.scheme == "http":
+            return httplib.HTTPConnection(parsed_url.netloc)
+        elif parsed_url.scheme == "https":
+            return httplib.HTTPSConnection(parsed_url.netloc)
+        else:
+            raise RuntimeError("Unsupported URL scheme: {}".format(
+                parsed_url.scheme))
+            
+    def give_back(self, parsed_url, connection):
+        """
+        Put a connection for the given parsed URL back in the pool, ready for
+        another request.
+        
+        """
+        
+        with self.lock:
+            self.idle[(parsed_url.scheme, parsed_url.netloc)].append(connection)
+            
+    def get_size(self, url):
+        """
+        Get the size in bytes of the file at the given URL.
+        
+        """
+        
+        if local_path(url) is not None:
+            return os.path.getsize(local_path(url))
+        
+        parsed_url = urlparse.urlparse(url)
+        connection = self.take(parsed_url)
+        
+        try:
+            if parsed_url.scheme == "ftp":
+                # Sizes are only meaningful in binary mode
+                connection.voidcmd("TYPE I")
+                size = connection.size(parsed_url.path)
+            else:
+                connection.request("HEAD", parsed_url.path)
+                response = connection.getresponse()
+                response.read()
+                
+                if response.status != 200:
+                    raise IOError("Got HTTP {} {} for {}".format(
+                        response.status, response.reason, url))
+                        
+                size = int(response.getheader("content-length"))
+        except:
+            connection.close()
+            raise
+            
+        self.give_back(parsed_url, connection)
+        return size
+            
+    def stream(self, url, offset=0, length=None, chunk_size=64 * 1024):
+        """
+        Yield the contents of the file at the given URL in chunks, starting at
+        the given byte offset, and stopping after the given number of bytes if
+        length is not None.
+        
+        If you stop iterating early, close the generator, and the connection
+        will be dropped instead of going back in the pool.
+        
+        """
+        
+        # How many more bytes do we want?
+        remaining = length if length is not None else float("inf")
+        
+        if local_path(url) is not None:
+            # Just read the file
+            with open(local_path(url), "rb") as local_file:
+                local_file.seek(offset)
+                while remaining > 0:
+                    chunk = local_file.read(int(min(chunk_size, remaining)))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            return
+        
+        parsed_url = urlparse.urlparse(url)
+        connection = self.take(parsed_url)
+        
+        # Did we read everything and leave the connection ready to reuse?
+        finished = False
+        
+        try:
+            if parsed_url.scheme == "ftp":
+                # Do a binary retrieve over a data connection
+                connection.voidcmd("TYPE I")
+                data = connection.transfercmd("RETR {}".format(
+                    parsed_url.path), rest=offset if offset > 0 else None)
+                    
+                # Did the server run out of data before we stopped it?
+                at_end = False
+                
+                try:
+                    while remaining > 0:
+                        chunk = data.recv(int(min(chunk_size, remaining)))
+                        if not chunk:
+                            at_end = True
+                            break
+                        remaining -= len(chunk)
+                        yield chunk
+                finally:
+                    data.close()
+                    
+                if not at_end and length is not None:
+                    # FTP can't stop a transfer partway through and keep the
+                    # connection in a known state, so just drop it.
+                    return
+                    
+                # Get the transfer complete message
+                connection.voidresp()
+            else:
+                path = parsed_url.path
+                if parsed_url.query:
+                    path += "?" + parsed_url.query
+                    
+                headers = {}
+                if offset > 0 or length is not None:
+                    # Ask for just the part we want
+                    headers["Range"] = "bytes={}-{}".format(offset,
+                        offset + length - 1 if length is not None else "")
+                    
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                
+                if response.status not in (200, 206):
+                    response.read()
+                    raise IOError("Got HTTP {} {} for {}".format(
+                        response.status, response.reason, url))
+                        
+                if response.status == 200 and "Range" in headers:
+                    # The server sent the whole thing, so we have to skip to
+                    # the part we want.
+                    to_skip = offset
+                    while to_skip > 0:
+                        skipped = response.read(min(chunk_size, to_skip))
+                        if not skipped:
+                            break
+                        to_skip -= len(skipped)
+                
+                while remaining > 0:
+                    chunk = response.read(int(min(chunk_size, remaining)))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+                    
+                if response.status == 200 and "Range" in headers:
+                    # We probably left some of the file unread
+                    return
+                        
+            finished = True
+        finally:
+            if finished:
+                self.give_back(parsed_url, connection)
+            else:
+                # We don't know what state this is in
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+def parse_crai(chunks):
+    """
+    Given an iterable of chunks of gzipped CRAI index data, yield the index
+    entries, decompressing as we go.
+    
+    Each entry is a tuple of reference sequence ID, alignment start, alignment
+    span, container byte offset, slice byte offset in the container, and slice
+    size.
+    
+    """
+    
+    # The 16 makes zlib expect a gzip header
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    
+    # This holds the partial line we haven't finished yet
+    leftover = ""
+    
+    try:
+        for chunk in chunks:
+            while chunk:
+                text = decompressor.decompress(chunk)
+                
+                # If we hit the end of a gzip member, there may be another
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    
+                lines = (leftover + text).split("\n")
+                leftover = lines.pop()
+                
+                for line in lines:
+                    if line:
+                        yield tuple(int(field) for field in line.split("\t"))
+                        
+        if leftover.strip():
+            # There was no newline at the end
+            yield tuple(int(field) for field in leftover.split("\t"))
+    finally:
+        if hasattr(chunks, "close"):
+            # Stop downloading if we stopped early
+            chunks.close()
+        
+# These are the special empty containers that end CRAM files, by CRAM major
+# version. See htslib's cram_io.c.
+CRAM_EOF = {
+    2: ("\x0b\x00\x00\x00\xff\xff\xff\xff\x0f\xe0\x45\x4f\x46\x00\x00"
+        "\x00\x00\x01\x00\x00\x01\x00\x06\x06\x01\x00\x01\x00\x01\x00"),
+    3: ("\x0f\x00\x00\x00\xff\xff\xff\xff\x0f\xe0\x45\x4f\x46\x00\x00"
+        "\x00\x00\x01\x00\x05\xbd\xd9\x4f\x00\x01\x00\x06\x06\x01\x00"
+        "\x01\x00\x01\x00\xee\x63\x01\x4b")
+}
+
+def parse_range_string(range_string):
+    """
+    Parse a samtools-style "contig:start-end" range string into a contig name
+    and 1-based inclusive start and end. A bare contig name means the whole
+    contig.
+    
+    """
+    
+    match = re.match("^(.*):([0-9,]+)-([0-9,]+)$", range_string)
+    
+    if match is None:
+        # Contig names can have colons, so this is a whole contig
+        return range_string, 1, float("inf")
+    
+    return (match.group(1), int(match.group(2).replace(",", "")),
+        int(match.group(3).replace(",", "")))
+    
+def coalesce_range_strings(range_strings):
+    """
+    Merge overlapping and adjacent samtools-style range strings on the same
+    contig. Returns a list of range strings, sorted by contig and start.
+    
+    """
+    
+    # This holds lists of [start, end] intervals by contig
+    intervals_by_contig = collections.defaultdict(list)
+    
+    for range_string in range_strings:
+        contig, start, end = parse_range_string(range_string)
+        intervals_by_contig[contig].append([start, end])
+        
+    merged_ranges = []
+    
+    for contig in sorted(intervals_by_contig.iterkeys()):
+        # This holds the merged intervals on this contig
+        merged = []
+        
+        for start, end in sorted(intervals_by_contig[contig]):
+            if merged and start <= merged[-1][1] + 1:
+                # This overlaps or abuts the last interval
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+                
+        for start, end in merged:
+            if end == float("inf"):
+                # This is the whole contig
+                merged_ranges.append(contig)
+            else:
+                merged_ranges.append("{}:{}-{}".format(contig, start, end))
+            
+    return merged_ranges
+
+def load_cram_index(pool, index_url):
+    """
+    Download and parse the CRAI index at the given URL with the given
+    ConnectionPool.
+    
+    Returns a dict from reference sequence ID to a list of index entries, and a
+    sorted list of container offsets.
+    
+    """
+    
+    # Get all the index entries, and organize them by reference sequence
+    entries_by_reference = collections.defaultdict(list)
+    container_offsets = set()
+    for entry in parse_crai(pool.stream(index_url)):
+        entries_by_reference[entry[0]].append(entry)
+        container_offsets.add(entry[3])
+        
+    if len(container_offsets) == 0:
+        raise RuntimeError("No containers in index {}".format(index_url))
+        
+    return entries_by_reference, sorted(container_offsets)
+    
+def fetch_cram_header(pool, cram_url, first_container, scratch_filename,
+    env=None):
+    """
+    Download the header of the CRAM at the given URL, given the offset of its
+    first data container, with the given ConnectionPool.
+    
+    Returns the header bytes (file definition and header container), the EOF
+    container for the file's CRAM version, and a dict from contig name to
+    reference sequence ID. The contig names are read by running samtools in the
+    given environment on an empty CRAM made at scratch_filename.
+    
+    """
+    
+    # Everything before the first data container is the file definition and
+    # the header container.
+    header = "".join(pool.stream(cram_url, 0, first_container))
+    
+    # Find the right EOF container from the major version
+    eof = CRAM_EOF[ord(header[4])]
+    
+    with open(scratch_filename, "w") as scratch_file:
+        # Make a CRAM with no reads, to get the contig names from
+        scratch_file.write(header)
+        scratch_file.write(eof)
+        
+    reference_ids = {}
+    for line in subprocess.check_output(["samtools", "view", "-H",
+        scratch_filename], env=env).split("\n"):
+        
+        if line.startswith("@SQ"):
+            # Contig IDs are assigned in order
+            for tag in line.split("\t"):
+                if tag.startswith("SN:"):
+                    reference_ids[tag[3:]] = len(reference_ids)
+                    
+    return header, eof, reference_ids
+    
+def find_overlapping_entries(entries_by_reference, reference_ids,
+    range_strings, cram_url):
+    """
+    Find the CRAI index entries (slices) that overlap any of the given range
+    strings, given the index entries by reference ID and the reference IDs by
+    contig name for the CRAM at the given URL.
+    
+    Returns a set of index entries.
+    
+    """
+    
+    overlapping = set()
+    
+    for range_string in range_strings:
+        contig, start, end = parse_range_string(range_string)
+        
+        if not reference_ids.has_key(contig):
+            RealTimeLogger.get().warning("Contig {} not in {}".format(contig,
+                cram_url))
+            continue
+        
+        entries = entries_by_reference[reference_ids[contig]]
+        
+        # Entries are sorted by start, so only look at the ones that start
+        # close enough before the range to overlap it.
+        starts = [entry[1] for entry in entries]
+        longest = max([entry[2] for entry in entries] + [0])
+        first = bisect.bisect_left(starts, start - longest)
+        last = bisect.bisect_right(starts, end)
+        
+        for entry in entries[first:last]:
+            if entry[1] <= end and entry[1] + entry[2] > start:
+                overlapping.add(entry)
+                
+    return overlapping
+    
+def count_expected_slices(pool, cram_url, index_url, range_strings,
+    scratch_filename, env=None):
+    """
+    Count the slices that the CRAI index at the given URL says hold reads
+    overlapping any of the given ranges in the CRAM at the given URL. If this
+    is 0, an empty download is legitimate.
+    
+    Uses the given ConnectionPool, and runs samtools in the given environment on
+    an empty CRAM made at scratch_filename.
+    
+    """
+    
+    entries_by_reference, container_offsets = load_cram_index(pool, index_url)
+    
+    _, _, reference_ids = fetch_cram_header(pool, cram_url,
+        container_offsets[0], scratch_filename, env)
+        
+    return len(find_overlapping_entries(entries_by_reference, reference_ids,
+        range_strings, cram_url))
+
+def download_cram_ranges(pool, cram_url, index_url, range_strings, local_filename,
+    max_gap=0, env=None):
+    """
+    Make a local CRAM file at local_filename with all the reads from the remote
+    CRAM at the given URL that fall in any of the given range strings, using
+    connections from the given ConnectionPool.
+    
+    Downloads the index once, and then just the CRAM header and the containers
+    that the index says overlap any of the ranges. Containers closer than
+    max_gap bytes are downloaded with a single request. The local CRAM is all
+    those complete containers in a row, so it may have some reads outside the
+    ranges. The local header is read with samtools in the given environment, if
+    any.
+    
+    """
+    
+    entries_by_reference, container_offsets = load_cram_index(pool, index_url)
+    
+    header, eof, reference_ids = fetch_cram_header(pool, cram_url,
+        container_offsets[0], local_filename, env)
+    
+    # The last container ends at the EOF container, if there is one
+    file_size = pool.get_size(cram_url)
+    if "".join(pool.stream(cram_url, file_size - len(eof))) == eof:
+        data_end = file_size - len(eof)
+    else:
+        data_end = file_size
+        
+    # Work out where each container ends
+    container_ends = dict(zip(container_offsets,
+        container_offsets[1:] + [data_end]))
+    
+    # Collect the offsets of all the containers we need
+    wanted = set(entry[3] for entry in find_overlapping_entries(
+        entries_by_reference, reference_ids, range_strings, cram_url))
+                
+    RealTimeLogger.get().info("Downloading {} of {} containers from {}".format(
+        len(wanted), len(container_offsets), cram_url))
+    
+    with open(local_filename, "w") as local_file:
+        local_file.write(header)
+        
+        for offset, length, _ in coalesce_ranges(((container_offset,
+            container_ends[container_offset] - container_offset)
+            for container_offset in wanted), max_gap):
+            
+            # Grab each run of containers. Anything in a gap is still whole
+            # containers, so it can go in too.
+            for chunk in pool.stream(cram_url, offset, length):
+                local_file.write(chunk)
+                
+        local_file.write(eof)
+
+# This is the empty BGZF block that ends every complete BAM file
+BGZF_EOF = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+    "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+def has_bgzf_eof(filename):
+    """
+    Return True if the given BGZF file (like a BAM) ends with the EOF block,
+    and so was completely written.
+    
+    """
+    
+    with open(filename, "rb") as bgzf_file:
+        bgzf_file.seek(0, os.SEEK_END)
+        if bgzf_file.tell() < len(BGZF_EOF):
+            return False
+        bgzf_file.seek(-len(BGZF_EOF), os.SEEK_END)
+        return bgzf_file.read() == BGZF_EOF
+
+class BAMRecordCounter(object):
+    """
+    Count the records in a BAM stream as it goes by, without keeping it. Meant
+    for uncompressed (compression level 0) BAM data, which is cheap to unpack.
+    
+    """
+    
+    def __init__(self):
+        """
+        Start counting at the start of a BAM stream.
+        
+        """
+        
+        # This holds BGZF data that isn't a whole block yet
+        self.compressed = ""
+        # This holds unpacked BAM data that isn't a whole header or record yet
+        self.data = ""
+        
+        # Have we got past the BAM header?
+        self.header_done = False
+        
+        # How many records have we seen?
+        self.records = 0
+        
+        # Was the last block we saw the empty EOF block?
+        self.saw_eof = False
+        
+    def feed(self, chunk):
+        """
+        Count the records in the next chunk of BAM data.
+        
+        Raises ValueError if the data isn't BGZF.
+        
+        """
+        
+        self.compressed += chunk
+        
+        # BGZF blocks from samtools have their size at a fixed offset, after
+        # 18 bytes of header.
+        while len(self.compressed) >= 18:
+            if self.compressed[0:4] != "\x1f\x8b\x08\x04":
+                raise ValueError("BAM stream is not BGZF")
+                
+            block_size = struct.unpack_from("<H", self.compressed, 16)[0] + 1
+            if len(self.compressed) < block_size:
+                # Wait for the rest of the block
+                break
+                
+            # Unpack the raw deflate data between the header and the CRC and
+            # length trailer
+            payload = zlib.decompress(self.compressed[18:block_size - 8], -15)
+            self.compressed = self.compressed[block_size:]
+            
+            self.saw_eof = (len(payload) == 0)
+            self.data += payload
+            
+            self.count()
+            
+    def count(self):
+        """
+        Count and drop all the whole records in the unpacked data.
+        
+        """
+        
+        # Where does the next record (or the header) start?
+        offset = 0
+        
+        if not self.header_done:
+            if len(self.data) < 12:
+                return
+                
+            # Skip the magic and the text
+            text_length = struct.unpack_from("<i", self.data, 4)[0]
+            offset = 8 + text_length
+            if len(self.data) < offset + 4:
+                return
+            
+            # Skip all the reference sequences
+            reference_count = struct.unpack_from("<i", self.data, offset)[0]
+            offset += 4
+            for i in xrange(reference_count):
+                if len(self.data) < offset + 4:
+                    return
+                name_length = struct.unpack_from("<i", self.data, offset)[0]
+                offset += 4 + name_length + 4
+                
+            if len(self.data) < offset:
+                return
+                
+            self.header_done = True
+            
+        while len(self.data) >= offset + 4:
+            # Each record starts with its size
+            record_size = struct.unpack_from("<i", self.data, offset)[0]
+            if len(self.data) < offset + 4 + record_size:
+                break
+            offset += 4 + record_size
+            self.records += 1
+            
+        self.data = self.data[offset:]
+        
+    def is_complete(self):
+        """
+        Return True if the stream so far is a complete BAM file, ending with an
+        EOF block after whole records.
+        
+        """
+        
+        return (self.header_done and self.saw_eof and
+            len(self.compressed) == 0 and len(self.data) == 0)
+
+def extract_reads(input_url, range_strings, bam_filename, sort_prefix,
+    sort_memory="512M", env=None, name_sort=True):
+    """
+    Pull the reads in the given ranges out of the given HTSlib file or URL, and
+    save them to the given BAM file sorted by template name, which is what
+    smartSam2Fastq.py wants later. The reads go straight from samtools view into
+    samtools sort as uncompressed BAM, so there's never an unsorted copy on
+    disk. Sort temporary files start with the given prefix. Both commands run in
+    the given environment, if any.
+    
+    If name_sort is false, the reads are just compressed and saved in the order
+    they come in, for smartSam2Fastq.py --unsorted to deal with.
+    
+    Records are counted on their way through, so the result never has to be
+    read again. Returns the number of records.
+    
+    Raises CalledProcessError if either samtools command fails, and IOError if
+    the stream from samtools view or the final BAM is truncated.
+
+    """
+
+    view = subprocess.Popen(["samtools", "view", "-u", input_url] +
+        range_strings, stdout=subprocess.PIPE, env=env)
+    if name_sort:
+        sort = subprocess.Popen(["samtools", "sort", "-n", "-m", sort_memory,
+            "-T", sort_prefix, "-o", bam_filename, "-"], stdin=subprocess.PIPE,
+            env=env)
+    else:
+        # Just compress what we get
+        sort = subprocess.Popen(["samtools", "view", "-b", "-o",
+            bam_filename, "-"], stdin=subprocess.PIPE, env=env)
+        
+    counter = BAMRecordCounter()
+
+    try:
+        while True:
+            chunk = view.stdout.read(64 * 1024)
+            if not chunk:
+                break
+            counter.feed(chunk)
+            sort.stdin.write(chunk)
+    finally:
+        # Let each process know we're done with it, and collect them
+        sort.stdin.close()
+        view.stdout.close()
+        view.wait()
+        sort.wait()
+
+    if view.returncode != 0:
+        raise subprocess.CalledProcessError(view.returncode, "samtools view")
+    if sort.returncode != 0:
+        raise subprocess.CalledProcessError(sort.returncode, "samtools sort")
+        
+    if not counter.is_complete():
+        raise IOError("Truncated BAM stream from {}".format(input_url))
+    if not has_bgzf_eof(bam_filename):
+        raise IOError("Sorted BAM {} is truncated".format(bam_filename))
+        
+    return counter.records
+
+def count_indexed_contigs(index_url, policy, pool, stop_at=float("inf")):
+    """
+    Given the URL of a .crai index file, count the number of distinct contigs in
+    the index and return it. Uses connections from the given ConnectionPool.
+    
+    Stops downloading and returns early once stop_at contigs are found.
+    
+    Retries download errors according to the given RetryPolicy.
+    """
+    
+    for attempt in policy.attempts(index_url, ftplib.all_errors +
+        (zlib.error, httplib.HTTPException, ValueError),
+        "index download of {}".format(index_url)):
+        with attempt:
+        
+            # This holds all the contig IDs we have seen
+            contigs = set()
+            
+            entries = parse_crai(pool.stream(index_url))
+            
+            try:
+                for entry in entries:
+                    contigs.add(entry[0])
+                    
+                    if len(contigs) >= stop_at:
+                        # We know enough
+                        break
+                        
+                return len(contigs)
+            finally:
+                entries.close()
+            
+def qualify_index(index_url, index_stamp, cache, pool, options):
+    """
+    Work out how many contigs the index at the given URL covers, or at least
+    whether it covers options.min_indexed_contigs, using the given ListingCache
+    to remember counts between runs and the given ConnectionPool to download
+    the index.
+    
+    Returns the count, or None if we can't get one.
+    
+    """
+    
+    # A cached count is good if it is complete, or big enough anyway
+    cached = cache.get("contigs", index_url, index_stamp)
+    
+    if cached is not None and (cached["complete"] or
+        cached["count"] >= options.min_indexed_contigs):
+        return cached["count"]
+        
+    if options.offline and local_path(index_url) is None:
+        RealTimeLogger.get().warning("No cached contig count for {} "
+            "in offline mode".format(index_url))
+        return None
+        
+    RealTimeLogger.get().info("Counting contigs in {}".format(index_url))
+    
+    indexed_contigs = count_indexed_contigs(index_url, pool.policy, pool,
+        stop_at=options.min_indexed_contigs)
+        
+    cache.put("contigs", index_url, {
+        "count": indexed_contigs,
+        # If we stopped early, we only have a lower bound
+        "complete": indexed_contigs < options.min_indexed_contigs
+    }, index_stamp)
+    
+    return indexed_contigs
+            
+def downloadAllReads(job, options):
+    """
+    Download all the reads for the regions.
+    
+    """
+    
+    # Initialize logging
+    RealTimeLogger.set_master(options)
+    
+    RealTimeLogger.get().info("Starting download")
+    
+    # Connect to the output store
+    out_store = IOStore.get(options.out_store)
+    
+    # Get the regions from the catalog, which only needs downloading and
+    # parsing the first time if we have a cache.
+    catalog = load_catalog(options.reference_metadata,
+        cache_dir=options.cache_dir, offline=options.offline)
+    
+    # Holds the contig:start-end strings for each region
+    ranges_by_region = {}
+    
+    for region_name in options.regions:
+        if not catalog.has_region(region_name):
+            raise RuntimeError("Region {} not in catalog from {}".format(
+                region_name, options.reference_metadata))
+        ranges_by_region[region_name] = catalog.range_strings(region_name)
+            
+    # Calculate the FTP base URL (without directory). We need it later for
+    # turning found index files into URLs.
+    root_path = urlparse.urlparse(options.sample_ftp_root).path
+    base_url = options.sample_ftp_root[:-len(root_path)]
+    
+    # Dump the good data files for samples, to be uploaded at the end
+    good_samples_filename = "{}/good.txt".format(
+        job.fileStore.getLocalTempDir())
+    good_samples = open(good_samples_filename, "w")
+    
+    # This holds URLs to data files (BAM/CRAM) with indexes that are on a
+    # sufficient number of contigs, by sample name. We take the first
+    # sufficiently good file we find for any sample.
+    sample_file_urls = {}
+    
+    # Look through population directories and then sample directories for data
+    # files, with lots of connections at once.
+    # TODO: We get them in whatever order the crawl finds them, so if you want a
+    # representative subsampling, add some shuffle here or something.
+    cache = ListingCache(options.cache_dir, ttl=options.cache_ttl,
+        offline=options.offline)
+    crawler = FTPCrawler(options.sample_ftp_root, [options.population_pattern,
+        options.sample_pattern], options.file_pattern,
+        connections=options.ftp_connections, policy=retry_policy(options),
+        index_suffix=options.index_suffix, cache=cache)
+    
+    # Count contigs in the indexes of lots of candidate files at once
+    pool = ConnectionPool(retry_policy(options))
+    index_workers = ThreadPool(options.index_threads)
+    
+    # This holds (FoundFile, AsyncResult) pairs for candidates we haven't made
+    # a decision on yet, in the order a serial scan would find them.
+    candidates = []
+    
+    # This gets set when we don't need any more indexes counted
+    done_qualifying = threading.Event()
+    
+    def qualify_candidate(found):
+        """
+        Count the contigs in the index for the given FoundFile, unless we know
+        we won't need to by the time a worker gets to it. Runs in the worker
+        pool.
+        
+        """
+        
+        population_name, sample_name = found.levels
+        
+        if done_qualifying.is_set() or sample_file_urls.has_key(sample_name):
+            # An earlier file got this sample in, or we have enough samples
+            return None
+            
+        return qualify_index(base_url + found.path + options.index_suffix,
+            found.index_stamp, cache, pool, options)
+    
+    def settle(wait):
+        """
+        Decide about candidates in the order a serial scan would, as far as we
+        can: until we hit one that a file we haven't found yet might come
+        before, or, unless wait is set, one that hasn't been counted yet.
+        Returns True if we have enough samples.
+        
+        """
+        
+        # Nothing we haven't found yet comes before this
+        frontier = crawler.frontier()
+        
+        while len(candidates) > 0:
+            found, result = candidates[0]
+            
+            if frontier is not None and found.order >= frontier:
+                # We might still find something that comes first
+                return False
+                
+            population_name, sample_name = found.levels
+            
+            if not sample_file_urls.has_key(sample_name):
+                # We need to know about this one
+                
+                if not (wait or result.ready()):
+                    # Come back when it is done
+                    return False
+                    
+                indexed_contigs = result.get()
+                
+                if indexed_contigs is None:
+                    # We couldn't find out about this one
+                    pass
+                elif indexed_contigs >= options.min_indexed_contigs:
+                    # This file for this sample is good enough
+                    sample_file_urls[sample_name] = base_url + found.path
+                    
+                    RealTimeLogger.get().info(
+                        "Sample {} has index of {} contigs".format(sample_name,
+                        indexed_contigs))
+                    # Add the sample to the file we spit out
+                    good_samples.write("{}\n".format(sample_name))
+                    
+                else:
+                    # Complain
+                    RealTimeLogger.get().warning(
+                        "Sample {} has index on too few contigs ({})."
+                        "Skipping!".format(sample_name, indexed_contigs))
+                        
+            # We're done with this candidate
+            candidates.pop(0)
+                    
+            if len(sample_file_urls) >= options.sample_limit:
+                # We got enough.
+                return True
+                
+        return False
+    
+    # Did we get enough samples before looking at everything?
+    have_enough = False
+    
+    for found in crawler.crawl():
+        # Start on each data file as soon as it is found
+        population_name, sample_name = found.levels
+        
+        if not sample_file_urls.has_key(sample_name):
+            # We may still need this file for this sample. Candidates sort by
+            # their order first, and orders are unique.
+            bisect.insort(candidates, (found, index_workers.apply_async(
+                qualify_candidate, (found,))))
+                
+        while True:
+            # Don't let the queue of indexes to count get too long
+            busy = [result for _, result in candidates if not result.ready()]
+            if len(busy) < options.index_threads * 2:
+                break
+            busy[0].wait()
+                
+        if settle(False):
+            # Don't finish the crawl.
+            have_enough = True
+            crawler.stop()
+            break
+            
+    if not have_enough:
+        # Now that the crawl is done, everything can be decided
+        settle(True)
+        
+    # Skip any counting that hasn't started
+    done_qualifying.set()
+        
+    # Don't keep counting indexes we don't need
+    index_workers.terminate()
+    index_workers.join()
+    
+    RealTimeLogger.get().info("Retry metrics: {}".format(pool.policy.metrics))
+            
+    good_samples.close()
+    out_store.write_output_file(good_samples_filename, "good.txt")
+            
+    RealTimeLogger.get().info("Got {} sample URLs".format(
+        len(sample_file_urls)))
+    
+    if(options.sample_limit < float("inf")):
+        # Make sure we got as many as we wanted.
+        assert(len(sample_file_urls) == options.sample_limit)
+    
+    for sample_name, sample_url in sample_file_urls.iteritems():
+    
+        # This holds where this sample's BAM for each region will go in the
+        # output store. This is where parallelMappingEvaluation.py looks for
+        # the FASTQs that go with them.
+        bam_keys = {region_name: "{}/{}/{}.bam".format(region_name,
+            sample_name, sample_name) for region_name in options.regions}
+                
+        if options.sample_major:
+            RealTimeLogger.get().info("Making child for {}: {}".format(
+                sample_name, sample_url))
+                
+            # Kick off one job to get all the regions for this sample from one
+            # pass over its file.
+            job.addChildJobFn(downloadSample, options, sample_url,
+                {region_name: ranges_by_region[region_name]
+                for region_name in options.regions}, bam_keys,
+                cores=1, memory="2G", disk="50G")
+            continue
+                
+        for region_name in options.regions:
+            
+            RealTimeLogger.get().info("Making child for {} x {}: {}".format(
+                region_name, sample_name, sample_url))
+            
+            # Now kick off a job to download all the ranges for the region for
+            # this sample in one go. Tell it where to save the results in the
+            # output store.
+            job.addChildJobFn(downloadRegion, options, region_name, 
+                sample_url, ranges_by_region[region_name],
+                bam_keys[region_name], cores=1, memory="1G", disk=0)
+                
+    RealTimeLogger.get().info("Done making children")
+   
+def downloadSample(job, options, file_url, ranges_by_region, bam_keys):
+    """
+    Download all the ranges for all the given regions from the given sample
+    data file (CRAM) URL in one pass, and split the reads out into a BAM for
+    each region, to be saved under the given output store key for that region.
+    
+    The index is fetched once, and only the parts of the file that overlap any
+    region are downloaded.
+    
+    """
+    
+    RealTimeLogger.set_master(options)
+    
+    # Where should we put the partial CRAM?
+    work_dir = job.fileStore.getLocalTempDir()
+    cram_filename = "{}/sample.cram".format(work_dir)
+    
+    # Pool connections for the index and data requests
+    pool = ConnectionPool(retry_policy(options))
+    
+    # Grab all the ranges at once
+    all_ranges = [range_string for range_list in ranges_by_region.itervalues()
+        for range_string in range_list]
+    
+    for attempt in pool.policy.attempts(file_url, ftplib.all_errors +
+        (zlib.error, httplib.HTTPException, ValueError,
+        subprocess.CalledProcessError), "download of {}".format(file_url)):
+        with attempt:
+            download_cram_ranges(pool, file_url, file_url +
+                options.index_suffix, all_ranges, cram_filename,
+                max_gap=options.coalesce_gap, env=samtools_env(options))
+                
+    RealTimeLogger.get().info("Retry metrics: {}".format(pool.policy.metrics))
+                
+    # Index the partial file so we can pull out each region
+    subprocess.check_call(["samtools", "index", cram_filename],
+        env=samtools_env(options))
+    
+    for region_name, range_list in ranges_by_region.iteritems():
+        # Split out each region's reads
+        region_bam = "{}/{}.bam".format(work_dir, region_name)
+        
+        RealTimeLogger.get().info("Extracting {} from {}".format(region_name,
+            file_url))
+        records = extract_reads(cram_filename,
+            coalesce_range_strings(range_list), region_bam,
+            "{}/{}.sort".format(work_dir, region_name),
+            env=samtools_env(options), name_sort=not options.unsorted)
+            
+        RealTimeLogger.get().info("Got {} records for {}".format(records,
+            region_name))
+            
+        bam_id = job.fileStore.writeGlobalFile(region_bam, cleanup=False)
+        
+        # Save it and its reads where they go
+        job.addFollowOnJobFn(saveBam, options, bam_id,
+            bam_keys[region_name], cores=1, memory="1G", disk="50G")
+
+def downloadRegion(job, options, region_name, file_url, range_list, bam_key):
+    """
+    Download all the ranges given for the given region from the given sample
+    data file URL, and save them to the given BAM key in the output store.
+    
+    Overlapping and adjacent ranges are merged, and then all of them are
+    downloaded together.
+    
+    """
+    
+    RealTimeLogger.set_master(options)
+    
+    # Merge the ranges so we don't fetch anything twice
+    merged_ranges = coalesce_range_strings(range_list)
+    
+    RealTimeLogger.get().info("Downloading {} ranges ({} merged) from {} to "
+        "{}".format(len(range_list), len(merged_ranges), file_url, bam_key))
+        
+    # Set up a child job to grab them all that returns a file store ID for
+    # the BAM file it gets. Right now this is a promise, but it gets filled in
+    # later.
+    part_promise = job.addChildJobFn(downloadRange, options, file_url,
+        merged_ranges, cores=1, memory="1G", disk="50G").rv()
+                
+    # Make a follow-on that saves the name-sorted BAM and its reads
+    job.addFollowOnJobFn(saveBam, options, part_promise,
+        bam_key, cores=1, memory="1G", disk="50G")
+        
+        
+def downloadRange(job, options, file_url, range_strings):
+    """
+    Download the given ranges from the given HTSlib file with one samtools
+    command, put the resulting BAM (sorted by template name) in the file store,
+    and return its file ID.
+    
+    Reads that overlap more than one range may appear more than once;
+    smartSam2Fastq deduplicates them later.
+    
+    """
+    
+    RealTimeLogger.set_master(options)
+    
+    # Where should we save the bam locally?
+    work_dir = job.fileStore.getLocalTempDir()
+    bam_filename = "{}/download.bam".format(work_dir)
+    
+    policy = retry_policy(options)
+    pool = ConnectionPool(policy)
+    
+    # How many slices does the index say should have reads for us? None if we
+    # don't know yet, or can't know because there's no CRAI.
+    expected_slices = None
+    
+    # How many times have we got no reads when we shouldn't have?
+    empty_downloads = 0
+    
+    for attempt in policy.attempts(file_url, ftplib.all_errors +
+        (subprocess.CalledProcessError, zlib.error, httplib.HTTPException,
+        ValueError), "download of {}".format(file_url)):
+        with attempt:
+            if (expected_slices is None and
+                options.index_suffix.endswith(".crai")):
+                # See if we should expect any reads at all
+                expected_slices = count_expected_slices(pool, file_url,
+                    file_url + options.index_suffix, range_strings,
+                    "{}/header.cram".format(work_dir),
+                    env=samtools_env(options))
+                    
+                RealTimeLogger.get().info("Expecting reads from {} slices of "
+                    "{}".format(expected_slices, file_url))
+        
+            # Try running the download
+            RealTimeLogger.get().info("Trying to download {} from {}".format(
+                " ".join(range_strings), file_url))
+            records = extract_reads(file_url, range_strings,
+                bam_filename, "{}/sort".format(work_dir),
+                env=samtools_env(options), name_sort=not options.unsorted)
+                
+            if records == 0 and expected_slices != 0:
+                # Maybe the server gave up on us partway through
+                empty_downloads += 1
+                
+                if empty_downloads <= options.empty_retries:
+                    raise IOError("No reads, but expected {} slices".format(
+                        expected_slices if expected_slices is not None else
+                        "some"))
+                        
+                if expected_slices is not None:
+                    # The index says there are reads here, and we keep not
+                    # getting them. Fail the job rather than save a BAM that
+                    # is missing them. This isn't an error we retry here.
+                    raise RuntimeError("Got no reads from {} after {} tries, "
+                        "but the index has {} slices in range".format(file_url,
+                        empty_downloads, expected_slices))
+                        
+                # Without a CRAI we can't tell an empty region from a failed
+                # fetch, so we have to believe it.
+                RealTimeLogger.get().warning("Accepting empty download of "
+                    "{}".format(file_url))
+                    
+    RealTimeLogger.get().info("Downloaded {} records".format(records))
+            
+    RealTimeLogger.get().info("Retry metrics: {}".format(policy.metrics))
+                    
+    # Put the BAM in the file store with a new ID
+    file_id = job.fileStore.writeGlobalFile(bam_filename, cleanup=False)
+
+    RealTimeLogger.get().info("Wrote file to ID {}".format(file_id))
+    
+    return file_id
+    
+def saveBam(job, options, bam_id, output_key):
+    """
+    Takes in a BAM file ID in the file store, sorted by template name (or not
+    sorted at all, with --unsorted), and saves it in the output store under the
+    given key. Also saves the deduplicated interleaved FASTQ reads under
+    <output_key>.fq (or <output_key>.fq.gz, BGZF-compressed, with
+    --compress_fastq).
+    
+    The FASTQ is uploaded as it is made, and never stored locally.
+    
+    """
+    
+    RealTimeLogger.set_master(options)
+    
+    out_store = IOStore.get(options.out_store)
+    
+    work_dir = job.fileStore.getLocalTempDir()
+    
+    # Where does the FASTQ go?
+    fastq_key = "{}.fq.gz" if options.compress_fastq else "{}.fq"
+    fastq_key = fastq_key.format(output_key)
+    
+    RealTimeLogger.get().info("Creating {} and {}".format(output_key,
+        fastq_key))
+    
+    # Grab the BAM. Each region comes from one samtools command, so it's
+    # already in order, and there's nothing to merge.
+    bam_filename = job.fileStore.readGlobalFile(bam_id,
+        "{}/reads.bam".format(work_dir))
+    
+    # Feed the BAM straight to the smart converter, which decodes it itself
+    # without a round trip through SAM text.
+    converter_command = ["./smartSam2Fastq.py", "--interleaved",
+        "--input_bam", bam_filename, "--threads", "2"]
+    if options.unsorted:
+        # Hold templates in memory until we run out, and then on local disk
+        converter_command += ["--unsorted", "--spill_dir", work_dir]
+    if options.compress_fastq:
+        # Make the FASTQ smaller to store and upload
+        converter_command += ["--compress", "bgzf", "--compress_threads", "2"]
+    converter = subprocess.Popen(converter_command, stdout=subprocess.PIPE)
+        
+    # Upload the FASTQ as it comes out. If the converter fails after this, the
+    # job fails, and the FASTQ gets overwritten when it is retried.
+    out_store.write_output_stream(converter.stdout, fastq_key)
+    converter.stdout.close()
+        
+    if converter.wait() != 0:
+        raise RuntimeError("smartSam2Fastq.py returned {}".format(
+            converter.returncode))
+    
+    # Save the BAM too
+    out_store.write_output_file(bam_filename, output_key)
+        
+def main():
+    
+    if len(sys.argv) == 2 and sys.argv[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE).failed
+    
+    options = parse_args(sys.argv) # This holds the nicely-parsed options object
+    
+    if options.cache_dir is not None:
+        # Jobs may not run where we are, so pin down the cache directory
+        options.cache_dir = os.path.abspath(options.cache_dir)
+    elif options.offline and local_path(options.sample_ftp_root) is None:
+        raise RuntimeError("Offline mode needs a --cache_dir")
+        
+    # Make sure the output store makes sense before we start
+    IOStore.get(options.out_store)
+    
+    if local_path(options.sample_ftp_root) is not None:
+        # Crawl local files by absolute path, so samtools can read them too
+        options.sample_ftp_root = os.path.abspath(local_path(
+            options.sample_ftp_root))
+            
+    if options.reference_fasta is not None:
+        # Every node builds its own cache from this, wherever it runs
+        options.reference_fasta = os.path.abspath(options.reference_fasta)
     
     logging.basicConfig(level=logging.DEBUG)
     
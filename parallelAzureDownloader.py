@@ -6,7 +6,7 @@ parallelAzureDownloader.py: download files from Azure.
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
 import doctest, re, json, collections, time, timeit
-import tempfile
+import string, hashlib, cStringIO
 
 from toil.job import Job
 
@@ -43,7 +43,28 @@ def parse_args(args):
     parser.add_argument("--overwrite", default=False, action="store_true",
         help="overwrite existing files")
     parser.add_argument("--batch_size", type=int, default=1000,
-        help="number of files to copy in a batch")
+        help="maximum number of files to copy in a batch")
+    parser.add_argument("--batch_bytes", type=int, default=10 * 1024 ** 3,
+        help="maximum number of bytes to copy in a batch, unless one file is "
+        "bigger")
+    parser.add_argument("--large_file_size", type=int, default=2 * 1024 ** 3,
+        help="copy files this big in their own jobs, in parallel ranges")
+    parser.add_argument("--range_size", type=int, default=64 * 1024 ** 2,
+        help="bytes to download at once when copying large files in ranges")
+    parser.add_argument("--copy_threads", type=int, default=10,
+        help="number of files or ranges to copy at once in a job")
+    parser.add_argument("--checkpoint_store", default=None,
+        help="IOStore to record finished batches in, so a restarted copy can "
+        "skip them (default: the output store)")
+    parser.add_argument("--checkpoint_prefix", default="copy-checkpoints",
+        help="prefix in the checkpoint store to record finished batches under; "
+        "the records are deleted after a copy with no failures")
+    parser.add_argument("--page_size", type=int, default=5000,
+        help="number of file names to list at a time")
+    parser.add_argument("--shard_prefixes", nargs="*", default=None,
+        help="key prefixes to list in parallel; keys that match none of them "
+        "are found by one more listing of everything (default: one per "
+        "printable ASCII first character)")
     
     # The command line arguments start with the program name, which we don't
     # want to treat as an argument for argparse. So we remove it.
@@ -51,80 +72,477 @@ def parse_args(args):
         
     return parser.parse_args(args)
    
-def group(iterable, max_count):
+# Copies stream through memory, so copy jobs only need this much disk, in
+# bytes, for logs and such
+COPY_DISK = 1024 ** 3
+
+# Stream small files in chunks this big, in bytes
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# And keep this many chunks of each file in flight
+PREFETCH = 4
+
+# These are the things we count about copying
+STAT_FIELDS = ["copied", "skipped", "failed", "copied_bytes", "skipped_bytes",
+    "failed_bytes"]
+
+def plan_batches(entries, max_count, max_bytes, large_size):
+    """
+    Split the given (name, size) entries into batches (lists of entries) of at
+    most max_count files and at most max_bytes bytes. Entries at least
+    large_size bytes, or too big to share a batch, go in batches by
+    themselves.
+    
+    >>> list(plan_batches([("a", 5), ("b", 5), ("c", 100), ("d", 1)], 10, 8,
+    ...     50))
+    [[('a', 5)], [('c', 100)], [('b', 5), ('d', 1)]]
+    
+    """
+    
+    # This holds the batch we are filling
+    batch = []
+    # And this is how big it is
+    batch_bytes = 0
+    
+    for name, size in entries:
+        if size >= large_size or size > max_bytes:
+            # This one goes by itself
+            yield [(name, size)]
+            continue
+        
+        if len(batch) >= max_count or batch_bytes + size > max_bytes:
+            # This one won't fit in the current batch
+            yield batch
+            batch = []
+            batch_bytes = 0
+            
+        batch.append((name, size))
+        batch_bytes += size
+        
+    if len(batch) > 0:
+        yield batch
+        
+def batch_id(batch):
+    """
+    Get an ID for the given batch of (name, size) files, which is the same
+    every time the same files are batched together.
+    
+    """
+    
+    return hashlib.sha1("\n".join("{}\t{}".format(name, size)
+        for name, size in batch)).hexdigest()
+        
+def new_stats():
+    """
+    Make a dict of all-zero copy statistics.
+    
+    """
+    
+    return dict.fromkeys(STAT_FIELDS, 0)
+    
+def merge_stats(job, stats_list):
+    """
+    Add up the given list of copy statistics dicts, and return the total.
+    
+    """
+    
+    total = new_stats()
+    for stats in stats_list:
+        for field in STAT_FIELDS:
+            total[field] += stats[field]
+    return total
+    
+def get_checkpoint_store(options):
+    """
+    Get the IOStore to keep checkpoint records in.
+    
+    """
+    
+    if options.checkpoint_store is not None:
+        return IOStore.get(options.checkpoint_store)
+    return IOStore.get(options.out_store)
+    
+def list_checkpoints(checkpoint_store, checkpoint_prefix):
+    """
+    Get a list of the paths of all the checkpoint records (including partial
+    ones) under the given prefix in the given store.
+    
+    """
+    
+    paths = []
+    marker = None
+    
+    while True:
+        names, marker = checkpoint_store.list_input_page(
+            checkpoint_prefix + "/", marker=marker)
+            
+        paths += names
+        
+        if marker is None:
+            return paths
+    
+def load_checkpoints(checkpoint_store, checkpoint_prefix):
     """
-    Batch up iterable results. Pads with None.
+    Get the set of IDs of the batches that have checkpoint records under the
+    given prefix in the given store.
     
-    See <http://stackoverflow.com/a/8290490/402891>
+    """
+    
+    # The ID is the file name. Partial records don't count.
+    return {path[len(checkpoint_prefix) + 1:-len(".json")]
+        for path in list_checkpoints(checkpoint_store, checkpoint_prefix)
+        if path.endswith(".json")}
+        
+def checkpoint_path(options, batch, partial=False):
+    """
+    Get the path in the checkpoint store for the record for the given batch,
+    or for the partial record saying which of its files are done, if partial
+    is set.
+    
+    """
+    
+    return "{}/{}.{}".format(options.checkpoint_prefix, batch_id(batch),
+        "partial" if partial else "json")
+            
+def save_checkpoint(options, batch, hashes, done=None):
+    """
+    Record that the given batch of (name, size) files has been copied, with
+    the given dict of hex SHA1 hashes by name for the files that went through
+    us.
+    
+    If done is set, only the files with names in it have been copied, and a
+    partial record listing just them is saved instead.
+    
+    """
+    
+    record = {
+        "batch": batch_id(batch),
+        "files": [{"key": name, "size": size, "sha1": hashes.get(name)}
+            for name, size in batch if done is None or name in done]
+    }
+    
+    get_checkpoint_store(options).write_output_stream(
+        cStringIO.StringIO(json.dumps(record)),
+        checkpoint_path(options, batch, partial=done is not None))
+        
+def load_partial_checkpoint(options, batch):
+    """
+    Get a dict from name to hex SHA1 hash (or None) for the files in the given
+    batch that an earlier try at copying it got done, according to its partial
+    record.
+    
+    """
+    
+    checkpoint_store = get_checkpoint_store(options)
+    path = checkpoint_path(options, batch, partial=True)
+    
+    if not checkpoint_store.exists(path):
+        # Nothing was saved, so we're starting fresh
+        return {}
+        
+    record = json.loads(IOStoreFile(checkpoint_store, path).read())
+    
+    return {entry["key"]: entry["sha1"] for entry in record["files"]}
+        
+def remove_checkpoints(options):
+    """
+    Delete all the checkpoint records, so they don't hang around in the output
+    for other things to find. Returns the number deleted.
     
     """
     
-    # Zip a bunch of copies of the iterable.
-    return itertools.izip_longest(*([iter(iterable)] * max_count))
+    checkpoint_store = get_checkpoint_store(options)
+    
+    # List them all before deleting any, so we aren't paging through a listing
+    # that is changing.
+    paths = list_checkpoints(checkpoint_store, options.checkpoint_prefix)
+    
+    for path in paths:
+        checkpoint_store.remove_file(path)
+        
+    return len(paths)
 
 def copy_everything(job, options):
     """
-    Download the file list and copy all the files.
+    Start listing and copying all the files, with a separate chain of listing
+    jobs for each key prefix shard, so the shards are listed in parallel. One
+    more chain lists everything and picks up the keys that are in no shard, so
+    nothing is missed. Batches that a previous run recorded as done are skipped. Reports how it
+    went at the end.
     
     """
     
-    # Set up the IO stores.
-    in_store = IOStore.get(options.in_store)
-    out_store = IOStore.get(options.out_store)
+    # Find out what's already done, all at once
+    done_batches = load_checkpoints(get_checkpoint_store(options),
+        options.checkpoint_prefix)
+        
+    RealTimeLogger.get().info("Found {} finished batches".format(
+        len(done_batches)))
     
-    batch_count = 0;
+    if options.shard_prefixes is not None:
+        shard_prefixes = options.shard_prefixes
+    else:
+        # Split on the first character of the key. Anything printable is fair
+        # game in a blob name.
+        shard_prefixes = [chr(i) for i in xrange(32, 127)]
+        
+    # This holds the promised statistics for each shard
+    shard_stats = []
+        
+    for prefix in shard_prefixes:
+        shard_stats.append(job.addChildJobFn(list_shard, options, prefix,
+            done_batches, cores=1, memory="1G", disk="1G").rv())
+            
+    if "" not in shard_prefixes:
+        # Keys can start with anything (control characters, or non-ASCII
+        # characters we can't enumerate), so look at every key to find the
+        # ones the shards don't cover. This is no more listing than copying
+        # without shards would do, and it runs alongside the shards.
+        shard_stats.append(job.addChildJobFn(list_shard, options, "",
+            done_batches, None, 0, tuple(shard_prefixes), cores=1,
+            memory="1G", disk="1G").rv())
+            
+    RealTimeLogger.get().info("Listing {} shards".format(len(shard_stats)))
+    
+    # Report when everything is done
+    job.addFollowOnJobFn(report_stats, options, shard_stats, cores=1,
+        memory="1G", disk="1G")
+    
+def list_shard(job, options, prefix, done_batches, marker=None,
+    page_number=0, exclude=()):
+    """
+    List one page of the files with keys starting with the given prefix,
+    continuing from the given marker, and queue copies of them, except for
+    batches in the given set of finished batch IDs. Files with keys starting
+    with anything in the given tuple of prefixes to exclude are left for other
+    shards. Queue another job to list the next page, so copying starts while
+    listing is still going.
+    
+    Returns a promise for the copy statistics for this page and all the ones
+    after it.
     
-    for batch in group(in_store.list_input_directory("", recursive=True), options.batch_size):
-        # For every batch, strip out the Nones
-        batch = [x for x in batch if x is not None]
+    """
     
-        # Copy everything in that batch
-        job.addChildJobFn(copy_batch, options, batch, cores=1, memory="1G",
-            disk="10G")
+    # Set up the IO store.
+    in_store = IOStore.get(options.in_store)
+    
+    entries, next_marker = in_store.list_input_page(prefix, marker=marker,
+        page_size=options.page_size, with_sizes=True)
+        
+    if len(exclude) > 0:
+        # Only keep the keys no other shard has
+        entries = [(name, size) for name, size in entries
+            if not name.startswith(exclude)]
+        
+    # This holds the statistics for everything we skipped, and the promised
+    # statistics for everything else
+    skipped = new_stats()
+    stats_list = [skipped]
+        
+    if next_marker is not None:
+        # Get the next page going right away
+        stats_list.append(job.addChildJobFn(list_shard, options, prefix,
+            done_batches, next_marker, page_number + 1, exclude, cores=1,
+            memory="1G", disk="1G").rv())
+            
+    batch_count = 0
+    
+    for batch in plan_batches(entries, options.batch_size, options.batch_bytes,
+        options.large_file_size):
+        
+        if batch_id(batch) in done_batches:
+            # A previous run did this one
+            skipped["skipped"] += len(batch)
+            skipped["skipped_bytes"] += sum(size for name, size in batch)
+            continue
+        
+        if len(batch) == 1 and batch[0][1] >= options.large_file_size:
+            # Copy this big file in parallel ranges in its own job
+            name, size = batch[0]
+            stats_list.append(job.addChildJobFn(copy_large_file, options, name,
+                size, cores=1, memory=2 * options.copy_threads *
+                options.range_size + 1024 ** 3, disk=COPY_DISK).rv())
+        else:
+            # Copy everything in that batch
+            stats_list.append(job.addChildJobFn(copy_batch, options, batch,
+                cores=1, memory="1G", disk=COPY_DISK).rv())
             
         batch_count += 1
         
-        if batch_count % 10 == 0:
+    if batch_count > 0:
+        RealTimeLogger.get().info("Queued {} batches from page {} of "
+            "prefix {!r}".format(batch_count, page_number, prefix))
             
-            RealTimeLogger.get().info("Queued {} batches...".format(batch_count))
+    # Add everything up once it's done
+    return job.addFollowOnJobFn(merge_stats, stats_list, cores=1,
+        memory="1G", disk="1G").rv()
     
 def copy_batch(job, options, batch):
     """
-    Copy a batch of files from input to output.
+    Copy a batch of (name, size) files from input to output, and record that
+    the batch is done if every file made it. If any file fails, records the
+    ones that made it and raises, so Toil can retry the job without copying
+    them again.
+    
+    Returns the copy statistics for the batch.
+    
     """
         
     # Set up the IO stores.
     in_store = IOStore.get(options.in_store)
     out_store = IOStore.get(options.out_store)
+    
+    # If we've been retried, don't redo what we already did
+    done = load_partial_checkpoint(options, batch)
 
     # Start some threads
-    pool = ThreadPool(10)
+    pool = ThreadPool(options.copy_threads)
     
     
-    def download(filename):
+    def copy(entry):
         """
-        Download each file
+        Copy each file. Returns how it went ("copied", "skipped", or "failed"),
+        the file's hash, if we saw its data, and the exception info if it
+        failed.
+        
         """
         
-        if (not options.overwrite) and out_store.exists(filename):
-            # Skip existing file
-            return
+        filename, size = entry
+        
+        if filename in done:
+            # An earlier try got this one
+            return "skipped", done[filename], None
+        
+        try:
+            if (not options.overwrite) and out_store.exists(filename):
+                # Skip existing file
+                return "skipped", None, None
+            
+            # Stream it across, or have the servers do it
+            return "copied", copy_store_file(in_store, filename, out_store,
+                filename, size=size, chunk_size=CHUNK_SIZE, prefetch=PREFETCH,
+                digest=hashlib.sha1()), None
+        except Exception:
+            # Let the other copies finish before we fail
+            return "failed", None, sys.exc_info()
+        
+    # Run all the copies in parallel
+    results = pool.map(copy, batch)
+    pool.close()
+    pool.join()
+    
+    return finish_batch(options, batch, results)
+    
+def copy_large_file(job, options, filename, size):
+    """
+    Copy one big file of the given size from input to output, downloading byte
+    ranges of it in parallel while uploading it. Raises if the copy fails.
+    
+    Returns the copy statistics for the file.
+    
+    """
+    
+    # Set up the IO stores.
+    in_store = IOStore.get(options.in_store)
+    out_store = IOStore.get(options.out_store)
+    
+    if (not options.overwrite) and out_store.exists(filename):
+        # Skip existing file
+        result = ("skipped", None, None)
+    else:
+        RealTimeLogger.get().info("Copying {} ({} bytes) in ranges".format(
+            filename, size))
+            
+        try:
+            # Keep every thread busy, with some ranges to spare
+            result = ("copied", copy_store_file(in_store, filename, out_store,
+                filename, size=size, chunk_size=options.range_size,
+                threads=options.copy_threads, prefetch=2 * options.copy_threads,
+                digest=hashlib.sha1()), None)
+        except Exception:
+            result = ("failed", None, sys.exc_info())
+            
+    return finish_batch(options, [(filename, size)], [result])
+    
+def finish_batch(options, batch, results):
+    """
+    Given a batch of (name, size) files, and a (status, hash, exception info)
+    result for each, save a checkpoint for the batch and return the batch's
+    copy statistics.
+    
+    If anything failed, saves a partial checkpoint for the files that made it
+    instead, and raises the first failure, so Toil retries the job.
+    
+    """
+    
+    stats = new_stats()
+    hashes = {}
+    
+    # This holds the names of the files that are done
+    done = set()
+    # This holds the exception info for each failure
+    failures = []
+    
+    for (name, size), (status, sha1, exc_info) in itertools.izip(batch,
+        results):
+        
+        stats[status] += 1
+        stats[status + "_bytes"] += size
+        if sha1 is not None:
+            hashes[name] = sha1
+        if exc_info is not None:
+            RealTimeLogger.get().error("Could not copy {}: {}".format(name,
+                exc_info[1]))
+            failures.append(exc_info)
+        else:
+            done.add(name)
+            
+    checkpoint_store = get_checkpoint_store(options)
+    partial_path = checkpoint_path(options, batch, partial=True)
+            
+    if len(failures) > 0:
+        RealTimeLogger.get().error("Failed on {failed} files ({failed_bytes} "
+            "bytes) of batch".format(**stats))
+        
+        if len(done) > 0:
+            # Remember what we got, for when we are retried
+            save_checkpoint(options, batch, hashes, done=done)
         
-        # Make a temp file
-        (handle, path) = tempfile.mkstemp(dir=job.fileStore.getLocalTempDir())
-        os.close(handle)        
+        # Fail the job, with the original traceback
+        raise failures[0][0], failures[0][1], failures[0][2]
         
-        # Download
-        in_store.read_input_file(filename, path)
-        # Store
-        out_store.write_output_file(path, filename)
+    # Don't do this batch again
+    save_checkpoint(options, batch, hashes)
+    
+    if checkpoint_store.exists(partial_path):
+        # We don't need to know what an earlier try did any more
+        checkpoint_store.remove_file(partial_path)
+    
+    return stats
+    
+def report_stats(job, options, stats_list):
+    """
+    Log the total copy statistics from the given list of statistics dicts, and
+    return them. If nothing failed, the checkpoint records aren't needed any
+    more, so delete them.
+    
+    """
+    
+    total = merge_stats(job, stats_list)
+    
+    RealTimeLogger.get().info("Copied {copied} files ({copied_bytes} bytes), "
+        "skipped {skipped} files ({skipped_bytes} bytes), and failed on "
+        "{failed} files ({failed_bytes} bytes)".format(**total))
         
-        # Clean up
-        os.unlink(path)
+    if total["failed"] > 0:
+        # Copy jobs should have failed themselves, but never call this done
+        raise RuntimeError("Failed to copy {failed} files ({failed_bytes} "
+            "bytes); run again to retry them".format(**total))
         
-    # Run all the downloads in parallel
-    pool.map(download, batch)
+    RealTimeLogger.get().info("Removed {} checkpoint records".format(
+        remove_checkpoints(options)))
     
+    return total
         
 def main(args):
     """
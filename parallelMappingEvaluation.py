@@ -8,7 +8,7 @@ BAM files with reads must have been already downloaded.
 """
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
-import doctest, re, json, collections, time, timeit
+import doctest, re, json, collections, time, timeit, gzip
 import logging, logging.handlers, SocketServer, struct, socket, threading
 
 from toil.job import Job
@@ -17,6 +17,9 @@ from toil.job import Job
 
 import sys, os, os.path, json, collections, logging, logging.handlers
 import SocketServer, struct, socket, threading, tarfile, shutil
+import zipfile, fnmatch
+
+from multiprocessing.pool import ThreadPool
 
 # We need some stuff in order to have Azure
 try:
@@ -243,6 +246,155 @@ def read_global_directory(file_store, directory_id, path):
             # We need to extract the whole thing into that new directory
             tar.extractall(path)
             
+# These kinds of files are already compressed, so directory archives store them
+# raw. That also means they can be memory-mapped straight out of the archive.
+ARCHIVE_RAW_PATTERNS = ["*.gz", "*.bgz", "*.bam", "*.cram", "*.gam", "*.sst",
+    "*.zip"]
+            
+def write_global_directory_archive(file_store, path, cleanup=False,
+    raw_patterns=ARCHIVE_RAW_PATTERNS):
+    """
+    Write the given directory into the file store as a random-access archive,
+    and return an ID that can be used to retrieve it with
+    read_global_directory_archive.
+    
+    The archive is a zip file, which has a central directory of member offsets,
+    and compresses each member independently. Files with names matching any of
+    the given fnmatch patterns are stored without compression. Unlike the tar
+    files made by write_global_directory, jobs can pull just the members they
+    need out of these archives, without decompressing everything else.
+    
+    Does not preserve the name of the given directory (only of its contents),
+    or any empty directories in it.
+
+    If cleanup is true, directory will be deleted from the file store when this
+    job and its follow-ons finish.
+    
+    """
+    
+    # Zip files need to be seekable while being written, so build it locally
+    archive_path = file_store.getLocalTempFile()
+    
+    with zipfile.ZipFile(archive_path, "w", allowZip64=True) as archive:
+        for dir_path, dir_names, file_names in os.walk(path):
+            # Archive everything in a consistent order
+            dir_names.sort()
+            
+            for file_name in sorted(file_names):
+                # Name each member relative to the directory we are archiving
+                file_path = os.path.join(dir_path, file_name)
+                member_name = os.path.relpath(file_path, path)
+                
+                if any(fnmatch.fnmatchcase(file_name, pattern)
+                    for pattern in raw_patterns):
+                    # Don't bother compressing this
+                    compression = zipfile.ZIP_STORED
+                else:
+                    compression = zipfile.ZIP_DEFLATED
+                    
+                archive.write(file_path, member_name, compression)
+                
+    # Spit back the ID to use to retrieve it
+    return file_store.writeGlobalFile(archive_path, cleanup=cleanup)
+    
+def extract_archive(open_archive, path, members=None, threads=1):
+    """
+    Extract a random-access directory archive to the given path.
+    
+    open_archive is a function that returns a new zipfile.ZipFile for the
+    archive each time it is called, so that each extraction thread can have its
+    own.
+    
+    If members is not None, only members with those names, or under directories
+    with those names, are extracted. Complains if any of them are missing.
+    
+    Permissions of extracted files are restored from the archive.
+    
+    """
+    
+    def matches(member_name, wanted):
+        """
+        Return True if the given archive member is or is under the given wanted
+        name.
+        """
+
+        return (member_name == wanted or
+            member_name.startswith(wanted.rstrip("/") + "/"))
+
+    with open_archive() as archive:
+        # Work out what we need from the central directory
+        to_extract = [info.filename for info in archive.infolist()
+            if members is None or
+            any(matches(info.filename, wanted) for wanted in members)]
+
+    for wanted in (members or []):
+        # Make sure we found everything we were asked for
+        if not any(matches(name, wanted) for name in to_extract):
+            raise RuntimeError("Archive has no member {}".format(wanted))
+    
+    robust_makedirs(path)
+    
+    def extract_some(member_names):
+        """
+        Extract the given members, using a private connection to the archive.
+        """
+        
+        with open_archive() as archive:
+            for member_name in member_names:
+                info = archive.getinfo(member_name)
+                extracted = archive.extract(info, path)
+                
+                # Zip keeps Unix permissions in the high bits
+                mode = (info.external_attr >> 16) & 0o777
+                if mode != 0:
+                    os.chmod(extracted, mode)
+                    
+    # Deal the members out to the threads
+    threads = max(1, min(threads, len(to_extract)))
+    batches = [to_extract[i::threads] for i in xrange(threads)]
+    
+    if threads == 1:
+        # No need for a pool
+        for batch in batches:
+            extract_some(batch)
+    else:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(extract_some, batches)
+        finally:
+            pool.close()
+            pool.join()
+    
+def read_global_directory_archive(file_store, directory_id, path, members=None,
+    threads=1):
+    """
+    Reads a directory archive with the given id from the global file store, and
+    recreates it, or just the given members of it, at the given path. Uses the
+    given number of threads to extract members in parallel.
+    
+    Also accepts tar files made by write_global_directory, for which all members
+    are extracted.
+    
+    Do not use to extract untrusted directories, since they could sneakily plant
+    files anywhere on the filesystem.
+    
+    """
+    
+    # Get a local copy, which the file store may be caching for us anyway
+    archive_path = file_store.readGlobalFile(directory_id)
+    
+    if not zipfile.is_zipfile(archive_path):
+        # This is an old-style tar. We have to unpack all of it.
+        RealTimeLogger.get().debug("Extracting entire tar {}".format(
+            directory_id))
+        robust_makedirs(path)
+        with tarfile.open(archive_path, mode="r:*") as tar:
+            tar.extractall(path)
+        return
+        
+    extract_archive(lambda: zipfile.ZipFile(archive_path, allowZip64=True),
+        path, members=members, threads=threads)
+        
 
 class IOStore(object):
     """
@@ -664,7 +816,8 @@ def parse_args(args):
     parser.add_argument("server_list", type=argparse.FileType("r"),
         help="TSV file continaing <region>\t<url> lines for servers to test")
     parser.add_argument("sample_store",
-        help="sample input IOStore with <region>/<sample>/<sample>.bam.fq")
+        help="sample input IOStore with <region>/<sample>/<sample>.bam.fq or "
+        "<sample>.bam.fq.gz")
     parser.add_argument("out_store",
         help="output IOStore to create and fill with alignments and stats")
     parser.add_argument("--server_version", default="v0.6.g",
@@ -716,8 +869,9 @@ def run_all_alignments(job, options):
     os.chmod("{}/sg2vg".format(bin_dir), 0o744)
     os.chmod("{}/vg".format(bin_dir), 0o744)
     
-    # Upload the bin directory to the file store
-    bin_dir_id = write_global_directory(job.fileStore, bin_dir,
+    # Upload the bin directory to the file store, as an archive so alignment
+    # jobs can pull out just the binaries they use.
+    bin_dir_id = write_global_directory_archive(job.fileStore, bin_dir,
         cleanup=True)
     
     # Make sure we skip the header
@@ -768,7 +922,7 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
     
     # Download the binaries
     bin_dir = "{}/bin".format(job.fileStore.getLocalTempDir())
-    read_global_directory(job.fileStore, bin_dir_id, bin_dir)
+    read_global_directory_archive(job.fileStore, bin_dir_id, bin_dir)
     
     # Get graph basename (last URL component) from URL
     basename = re.match(".*/(.*)/$", url).group(1)
@@ -818,7 +972,15 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
     versioned_url = url + options.server_version
     
     # Where will the indexed graph go in the output
-    index_key = "indexes/{}/{}.tar.gz".format(region, graph_name)
+    index_key = "indexes/{}/{}.zip".format(region, graph_name)
+    
+    # Where might an old-style tarred index be from previous runs?
+    legacy_index_key = "indexes/{}/{}.tar.gz".format(region, graph_name)
+    
+    if (not options.reindex and not out_store.exists(index_key) and
+        out_store.exists(legacy_index_key)):
+        # Use the old tarred index instead
+        index_key = legacy_index_key
     
     if (not options.reindex) and out_store.exists(index_key):
         # See if we have an index already available in the output store from a
@@ -828,12 +990,14 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
             "store".format(basename))
             
         # Download the pre-made index directory
-        tgz_file = "{}/index.tar.gz".format(job.fileStore.getLocalTempDir())
-        out_store.read_input_file(index_key, tgz_file)
+        archive_file = "{}/index.archive".format(
+            job.fileStore.getLocalTempDir())
+        out_store.read_input_file(index_key, archive_file)
         
         # Save it to the global file store and keep around the ID.
-        # Will be compatible with read_global_directory
-        index_dir_id = job.fileStore.writeGlobalFile(tgz_file, cleanup=True)
+        # Will be compatible with read_global_directory_archive
+        index_dir_id = job.fileStore.writeGlobalFile(archive_file,
+            cleanup=True)
         
     else:
         # Download the graph, build the index, and store it in the output store
@@ -888,7 +1052,7 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
             
         # Now save the indexed graph directory to the file store. It can be
         # cleaned up since only our children use it.
-        index_dir_id = write_global_directory(job.fileStore, graph_dir,
+        index_dir_id = write_global_directory_archive(job.fileStore, graph_dir,
             cleanup=True)
             
         # Add a child to actually save the graph to the output. Hack our own job
@@ -902,8 +1066,11 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
     for sample in samples_to_run:
         # Split out over each sample that needs to be run
         
-        # For each sample, know the FQ name
-        sample_fastq = "{}/{}/{}.bam.fq".format(region_dir, sample, sample)
+        # For each sample, know the FQ name. Use the compressed one if there
+        # is one.
+        sample_fastq = "{}/{}/{}.bam.fq.gz".format(region_dir, sample, sample)
+        if not sample_store.exists(sample_fastq):
+            sample_fastq = "{}/{}/{}.bam.fq".format(region_dir, sample, sample)
         
         # And know where we're going to put the output
         alignment_file_key = "{}/{}.gam".format(alignment_dir, sample)
@@ -920,7 +1087,7 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
             
 def save_indexed_graph(job, options, index_dir_id, output_key):
     """
-    Save the index dir tar file in the given output key.
+    Save the index dir archive file in the given output key.
     
     Runs as a child to ensure that the global file store can actually
     produce the file when asked (because within the same job, depending on Toil
@@ -933,7 +1100,7 @@ def save_indexed_graph(job, options, index_dir_id, output_key):
     sample_store = IOStore.get(options.sample_store)
     out_store = IOStore.get(options.out_store)
     
-    # Get the tar.gz file
+    # Get the archive file
     local_path = job.fileStore.readGlobalFile(index_dir_id)
     
     # Save it as output
@@ -954,20 +1121,35 @@ def run_alignment(job, options, bin_dir_id, region, index_dir_id,
     sample_store = IOStore.get(options.sample_store)
     out_store = IOStore.get(options.out_store)
     
-    # Download the binaries
+    # Download the binaries. We only need vg here.
     bin_dir = "{}/bin".format(job.fileStore.getLocalTempDir())
-    read_global_directory(job.fileStore, bin_dir_id, bin_dir)
+    read_global_directory_archive(job.fileStore, bin_dir_id, bin_dir,
+        members=["vg"])
     
-    # Download the indexed graph to a directory we can use
+    # Download the indexed graph to a directory we can use, unpacking the index
+    # files in parallel.
     graph_dir = "{}/graph".format(job.fileStore.getLocalTempDir())
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
+    read_global_directory_archive(job.fileStore, index_dir_id, graph_dir,
+        threads=job.cores)
     
     # We know what the vg file in there will be named
     graph_file = "{}/graph.vg".format(graph_dir)
     
     # Also we need the sample fastq
     fastq_file = "{}/input.fq".format(job.fileStore.getLocalTempDir())
-    sample_store.read_input_file(sample_fastq_key, fastq_file)
+    if sample_fastq_key.endswith(".gz"):
+        # Download it compressed, and unpack it here, since vg wants it plain
+        compressed_file = fastq_file + ".gz"
+        sample_store.read_input_file(sample_fastq_key, compressed_file)
+        
+        compressed_stream = gzip.open(compressed_file, "rb")
+        with open(fastq_file, "w") as fastq_stream:
+            shutil.copyfileobj(compressed_stream, fastq_stream, 1024 * 1024)
+        compressed_stream.close()
+        
+        os.unlink(compressed_file)
+    else:
+        sample_store.read_input_file(sample_fastq_key, fastq_file)
     
     # And temp files for our aligner output and stats
     output_file = "{}/output.gam".format(job.fileStore.getLocalTempDir())
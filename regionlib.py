@@ -0,0 +1,273 @@
+"""
+regionlib.py: catalog of the regions of interest, and where they are in GRCh38.
+
+Regions come from the GRC's alt scaffold placement file: each region is the
+span of the primary assembly that its alts replace, plus the alts themselves.
+A few regions that aren't defined by alts are built in.
+
+Parsing the placement file means downloading it, so parsed catalogs can be
+cached as JSON (for loading again) and BED (for people and other tools).
+
+"""
+
+import os, os.path, json, urllib2, urlparse, collections, hashlib, tempfile
+
+import tsv
+
+# These regions aren't real alt regions, so they have hardcoded ranges
+HARDCODED_RANGES = {
+    "BRCA1": [("chr17", 43044294, 43125482)],
+    "BRCA2": [("chr13", 32314861, 32399849)],
+    "CENX": [("chrX", 58605580, 62412542)]
+}
+
+# These are the regions we know about without a catalog
+DEFAULT_REGION_NAMES = ["BRCA1", "BRCA2", "CENX", "LRC_KIR", "SMA", "MHC"]
+
+def merge_intervals(intervals):
+    """
+    Given an iterable of (contig, start, end) intervals with 1-based inclusive
+    coordinates, merge the overlapping and adjacent ones on each contig.
+
+    Returns a sorted list of merged intervals.
+
+    >>> merge_intervals([("chr1", 10, 20), ("chr2", 1, 5), ("chr1", 21, 30),
+    ...     ("chr1", 15, 18), ("chr1", 40, 50)])
+    [('chr1', 10, 30), ('chr1', 40, 50), ('chr2', 1, 5)]
+
+    """
+
+    merged = []
+
+    for contig, start, end in sorted(intervals):
+        if (len(merged) > 0 and merged[-1][0] == contig and
+            start <= merged[-1][2] + 1):
+            # This extends the last interval
+            merged[-1] = (contig, merged[-1][1], max(merged[-1][2], end))
+        else:
+            merged.append((contig, start, end))
+
+    return merged
+
+class RegionCatalog(object):
+    """
+    Knows the merged intervals that make up each region, by region name.
+    Region names are case-insensitive, and are stored in upper case.
+
+    """
+
+    def __init__(self, intervals_by_region, source=None):
+        """
+        Make a catalog from a dict of lists of (contig, start, end) intervals
+        by region name, noting where the catalog came from.
+
+        """
+
+        self.source = source
+        self.intervals_by_region = {name.upper(): merge_intervals(intervals)
+            for name, intervals in intervals_by_region.iteritems()}
+
+    @classmethod
+    def from_placement(cls, placement_file, source=None):
+        """
+        Make a catalog from an alt scaffold placement file (like
+        all_alt_scaffold_placement.txt) open as the given file object, plus the
+        hardcoded regions.
+
+        """
+
+        intervals_by_region = collections.defaultdict(list)
+
+        for name, intervals in HARDCODED_RANGES.iteritems():
+            intervals_by_region[name] += intervals
+
+        # Holds the chromosome number for each region
+        region_chromosomes = {}
+        # Holds the minimum start position for each region on its chromosome
+        region_starts = collections.defaultdict(lambda: float("inf"))
+        # Holds the maximum stop position for each region on its chromosome
+        region_stops = collections.defaultdict(lambda: float("-inf"))
+
+        for parts in tsv.TsvReader(placement_file):
+            # Parse out all the info for this alt and its parent chromosome
+            region_name = parts[7]
+            # Grab the chromosome ("1" or "X") that's the parent
+            parent_chromosome = parts[5]
+            parent_start = int(parts[11])
+            parent_stop = int(parts[12])
+            alt_contig = parts[3]
+            alt_start = int(parts[9])
+            alt_stop = int(parts[10])
+
+            # Note the region start, stop, and parent chromosome number
+            region_chromosomes[region_name] = parent_chromosome
+            region_starts[region_name] = min(region_starts[region_name],
+                parent_start)
+            region_stops[region_name] = max(region_stops[region_name],
+                parent_stop)
+
+            # Turn the alt name into the proper format (GL000251.2 to
+            # chr6_GL000251v2_alt)
+            name_parts = alt_contig.split(".")
+            fixed_alt_contig = "chr{}_{}v{}_alt".format(parent_chromosome,
+                name_parts[0], name_parts[1])
+
+            intervals_by_region[region_name].append((fixed_alt_contig,
+                alt_start, alt_stop))
+
+        for region_name, parent_chromosome in region_chromosomes.iteritems():
+            # Add in the reference ranges that all the alts are alternatives to
+            intervals_by_region[region_name].append(("chr{}".format(
+                parent_chromosome), region_starts[region_name],
+                region_stops[region_name]))
+
+        return cls(intervals_by_region, source)
+
+    @classmethod
+    def load_json(cls, json_filename):
+        """
+        Load a catalog saved with save().
+
+        """
+
+        with open(json_filename) as json_file:
+            data = json.load(json_file)
+
+        return cls({name: [tuple(interval) for interval in intervals]
+            for name, intervals in data["regions"].iteritems()},
+            data.get("source"))
+
+    def save(self, json_filename, bed_filename=None):
+        """
+        Save the catalog as JSON to the given file, and optionally as BED (with
+        the region names in the name column) to another file. Files are written
+        under temporary names and renamed into place, so readers never see
+        partial catalogs.
+
+        """
+
+        def write_atomically(filename, write_function):
+            handle, temp_filename = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(filename)))
+            with os.fdopen(handle, "w") as stream:
+                write_function(stream)
+            os.rename(temp_filename, filename)
+
+        write_atomically(json_filename, lambda stream: json.dump({
+            "source": self.source,
+            "regions": self.intervals_by_region
+        }, stream, indent=2, sort_keys=True))
+
+        if bed_filename is not None:
+            def write_bed(stream):
+                for contig, start, end, name in sorted(
+                    (contig, start, end, name) for name, intervals in
+                    self.intervals_by_region.iteritems()
+                    for contig, start, end in intervals):
+
+                    # BED is 0-based and half-open
+                    stream.write("{}\t{}\t{}\t{}\n".format(contig, start - 1,
+                        end, name))
+
+            write_atomically(bed_filename, write_bed)
+
+    def region_names(self):
+        """
+        Return a sorted list of all the region names.
+
+        """
+
+        return sorted(self.intervals_by_region.iterkeys())
+
+    def has_region(self, region_name):
+        """
+        Return True if the catalog knows the given region.
+
+        """
+
+        return self.intervals_by_region.has_key(region_name.upper())
+
+    def intervals(self, region_name):
+        """
+        Return the merged (contig, start, end) intervals for the given region,
+        with 1-based inclusive coordinates.
+
+        Raises KeyError if the region isn't in the catalog.
+
+        """
+
+        return list(self.intervals_by_region[region_name.upper()])
+
+    def range_strings(self, region_name):
+        """
+        Return samtools-style "contig:start-end" range strings for the given
+        region.
+
+        """
+
+        return ["{}:{}-{}".format(contig, start, end)
+            for contig, start, end in self.intervals(region_name)]
+
+    def regions_at(self, contig, position):
+        """
+        Return a sorted list of the names of the regions that include the given
+        1-based position on the given contig.
+
+        """
+
+        return sorted(name for name, intervals in
+            self.intervals_by_region.iteritems()
+            if any(interval_contig == contig and start <= position <= end
+            for interval_contig, start, end in intervals))
+
+def load_catalog(source, cache_dir=None, offline=False):
+    """
+    Get a RegionCatalog from the given source, which can be a saved catalog
+    .json file, or a local path or URL for an alt scaffold placement file.
+
+    If cache_dir is set, parsed placement files are saved there as JSON and
+    BED, and loaded from there next time without touching the source. In
+    offline mode, a remote placement file that isn't cached is an error.
+
+    """
+
+    if source.endswith(".json"):
+        # This is already a catalog
+        return RegionCatalog.load_json(source)
+
+    parsed_source = urlparse.urlparse(source)
+    is_local = parsed_source.scheme in ("", "file")
+
+    if cache_dir is not None:
+        # Name the cached catalog after where it came from
+        cache_base = os.path.join(cache_dir, "regions-{}".format(
+            hashlib.sha1(source).hexdigest()))
+
+        if os.path.exists(cache_base + ".json"):
+            return RegionCatalog.load_json(cache_base + ".json")
+
+    if offline and not is_local:
+        raise RuntimeError("No cached region catalog for {} in offline "
+            "mode".format(source))
+
+    if is_local:
+        placement_file = open(parsed_source.path if parsed_source.scheme ==
+            "file" else source)
+    else:
+        placement_file = urllib2.urlopen(source)
+
+    try:
+        catalog = RegionCatalog.from_placement(placement_file, source)
+    finally:
+        placement_file.close()
+
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Someone else probably made it
+                pass
+        catalog.save(cache_base + ".json", cache_base + ".bed")
+
+    return catalog
@@ -0,0 +1,449 @@
+"""
+retrylib.py: shared retry policy for Toil jobs that hammer the same servers.
+
+Includes jittered exponential back-off, a limit on how many jobs on a node can
+talk to a host at once, a circuit breaker that makes everyone on a node lay off
+a host that keeps failing, and counts of how much retrying went on.
+
+The per-host limits and circuit breaker state live in lock and state files in a
+node-local directory, so they are shared between all the jobs on a node, not
+just the threads in one process.
+
+"""
+
+import os, os.path, time, random, fcntl, json, threading, logging, urlparse
+import collections, tempfile, re
+
+
+def backoff_times(retries=float("inf"), base_delay=2, max_delay=300):
+    """
+    A generator that yields times for exponential back-off. Always yields 0
+    first, and then if you have nonzero retries it yields exponentially
+    increasing times in seconds to wait before trying again, stopping at the
+    specified number of retries (and continuing forever by default).
+
+    Delays double from base_delay until they hit max_delay, and each one is
+    randomized between half and all of its nominal value, so lots of clients
+    that failed together don't all come back together.
+
+    You have to do the error catching and sleeping yourself.
+
+    Raises an exception if you use up all your backoff times.
+    """
+
+    # Don't wait at all before the first try
+    yield 0
+
+    # What retry are we on?
+    try_number = 1
+
+    # Make a delay that increases
+    delay = float(base_delay)
+
+    while try_number <= retries:
+        # Wait a random amount between half the delay and the delay
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, max_delay)
+        try_number += 1
+
+    raise RuntimeError("Ran out of retries")
+
+def host_key(url):
+    """
+    Get the name of the host we would talk to for the given URL, for limiting
+    and circuit breaking, or None if the URL is a local file and doesn't need
+    any of that.
+
+    """
+
+    parsed_url = urlparse.urlparse(url)
+
+    if parsed_url.scheme in ("", "file"):
+        return None
+
+    return parsed_url.netloc.lower()
+
+def host_filename(state_dir, host, suffix):
+    """
+    Get the path in the given state directory for the given host's file with
+    the given suffix.
+
+    """
+
+    # Keep port numbers and login info from making weird filenames
+    return os.path.join(state_dir, "{}.{}".format(
+        re.sub("[^A-Za-z0-9.-]", "_", host), suffix))
+
+class RetryMetrics(object):
+    """
+    Thread-safe counts of attempts, failures, and time spent waiting, by host.
+
+    """
+
+    # These are all the things we count
+    FIELDS = ["attempts", "failures", "retries", "breaker_trips",
+        "breaker_wait", "slot_wait"]
+
+    def __init__(self):
+        """
+        Start with nothing counted.
+
+        """
+
+        self.lock = threading.Lock()
+        self.counts = collections.defaultdict(lambda: dict.fromkeys(
+            self.FIELDS, 0))
+
+    def add(self, host, field, amount=1):
+        """
+        Add the given amount to the given field for the given host.
+
+        """
+
+        with self.lock:
+            self.counts[host][field] += amount
+
+    def summary(self):
+        """
+        Return a dict from host to dict of counts, for everything counted so
+        far.
+
+        """
+
+        with self.lock:
+            return {host: dict(counts) for host, counts in
+                self.counts.iteritems()}
+
+    def __str__(self):
+        """
+        Describe the metrics in a line for logging.
+
+        """
+
+        return json.dumps(self.summary(), sort_keys=True)
+
+class HostSlots(object):
+    """
+    Limit how many threads, in any process on the node, can talk to each host
+    at once. Each host gets a fixed number of lock files, and you need to hold
+    an exclusive lock on one of them to talk to the host.
+
+    A slot is held for one attempt, not for as long as a connection is open, so
+    this limits requests in flight. Pooled connections sitting idle between
+    attempts don't hold slots.
+
+    Slots are reentrant within a thread, so a retried operation that retries
+    something else against the same host doesn't deadlock on itself.
+
+    """
+
+    def __init__(self, state_dir, slots, metrics):
+        """
+        Make lock files in the given directory, allow the given number of slots
+        per host, and count time spent waiting for them in the given
+        RetryMetrics.
+
+        """
+
+        self.state_dir = state_dir
+        self.slots = slots
+        self.metrics = metrics
+
+        # This holds a dict from host to [depth, lock file] for each thread
+        self.held = threading.local()
+
+    def acquire(self, host):
+        """
+        Block until we get a slot for the given host.
+
+        """
+
+        if not hasattr(self.held, "slots"):
+            self.held.slots = {}
+
+        if self.held.slots.has_key(host):
+            # We already have one
+            self.held.slots[host][0] += 1
+            return
+
+        start_time = time.time()
+
+        while True:
+            # Try the slots in random order so we don't all pile onto the first
+            for slot in random.sample(xrange(self.slots), self.slots):
+                lock_file = open(host_filename(self.state_dir, host,
+                    "slot{}".format(slot)), "a")
+
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # Someone else has this one
+                    lock_file.close()
+                    continue
+
+                self.held.slots[host] = [1, lock_file]
+                self.metrics.add(host, "slot_wait", time.time() - start_time)
+                return
+
+            # Everything is taken. Wait a bit for someone to finish.
+            time.sleep(random.uniform(0.05, 0.5))
+
+    def release(self, host):
+        """
+        Give up a slot for the given host acquired with acquire().
+
+        """
+
+        self.held.slots[host][0] -= 1
+
+        if self.held.slots[host][0] == 0:
+            # Closing the file drops the lock
+            self.held.slots.pop(host)[1].close()
+
+class CircuitBreaker(object):
+    """
+    Stop everyone on the node from talking to a host for a while after it has
+    failed a bunch of times in a row. Failure counts live in a state file for
+    each host, so every job on the node sees them.
+
+    """
+
+    def __init__(self, state_dir, failure_threshold=5, cooldown=60):
+        """
+        Keep state in the given directory, and trip after the given number of
+        consecutive failures, pausing for the given number of seconds.
+
+        """
+
+        self.state_dir = state_dir
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+    def update(self, host, function):
+        """
+        Call the given function on the state dict for the given host, while
+        holding a lock on the host's state file, and save the state again. The
+        function may modify the state. Returns what the function returns.
+
+        """
+
+        with open(host_filename(self.state_dir, host, "breaker"),
+            "a+") as state_file:
+
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+
+            state_file.seek(0)
+            try:
+                state = json.load(state_file)
+            except ValueError:
+                # Nobody has written anything yet
+                state = {"failures": 0, "open_until": 0}
+
+            result = function(state)
+
+            state_file.seek(0)
+            state_file.truncate()
+            json.dump(state, state_file)
+            state_file.flush()
+
+            # Closing the file drops the lock
+            return result
+
+    def wait(self, host):
+        """
+        Wait for the breaker for the given host to close, if it is open.
+        Returns the number of seconds spent waiting.
+
+        """
+
+        waited = 0
+
+        while True:
+            open_until = self.update(host, lambda state: state["open_until"])
+
+            if open_until <= time.time():
+                return waited
+
+            # Don't come back all at once
+            delay = open_until - time.time() + random.uniform(0,
+                self.cooldown / 10.0)
+            time.sleep(delay)
+            waited += delay
+
+    def record_success(self, host):
+        """
+        Note that talking to the given host worked.
+
+        """
+
+        def reset(state):
+            state["failures"] = 0
+
+        self.update(host, reset)
+
+    def record_failure(self, host):
+        """
+        Note that talking to the given host failed. Returns True if that tripped
+        the breaker.
+
+        """
+
+        def fail(state):
+            state["failures"] += 1
+
+            if (state["failures"] >= self.failure_threshold and
+                state["open_until"] <= time.time()):
+                # Pause everyone. If we fail again right after the pause, we
+                # will trip right away.
+                state["open_until"] = time.time() + self.cooldown
+                return True
+
+            return False
+
+        return self.update(host, fail)
+
+class Attempt(object):
+    """
+    Context manager for one try at doing something against a host. Holds a
+    host slot while active, and swallows retryable errors so the loop over
+    RetryPolicy.attempts() can go around again.
+
+    """
+
+    def __init__(self, policy, host, retry_on, description):
+        """
+        Make an attempt under the given policy, against the given host (or None
+        for no host), retrying the given exception types, described by the
+        given string in log messages.
+
+        """
+
+        self.policy = policy
+        self.host = host
+        self.retry_on = retry_on
+        self.description = description
+
+        # Did we finish without an error?
+        self.succeeded = False
+
+    def __enter__(self):
+        if self.host is not None:
+            self.policy.slots.acquire(self.host)
+        self.policy.metrics.add(self.host, "attempts")
+
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.host is not None:
+            self.policy.slots.release(self.host)
+
+        if exception_type is None:
+            # It worked
+            self.succeeded = True
+            if self.host is not None:
+                self.policy.breaker.record_success(self.host)
+            return False
+
+        if not issubclass(exception_type, self.retry_on):
+            # This isn't something retrying will fix
+            return False
+
+        self.policy.metrics.add(self.host, "failures")
+
+        if (self.host is not None and
+            self.policy.breaker.record_failure(self.host)):
+
+            self.policy.metrics.add(self.host, "breaker_trips")
+            self.policy.logger.warning("Pausing requests to {} for {} "
+                "seconds".format(self.host, self.policy.breaker.cooldown))
+
+        self.policy.logger.warning("Need to retry {}: {}".format(
+            self.description, exception_value))
+
+        # Swallow the error
+        return True
+
+class RetryPolicy(object):
+    """
+    Retry operations against remote hosts with back-off, per-host concurrency
+    limits, and circuit breaking. Use it like this:
+
+        for attempt in policy.attempts(url, (IOError,), "download"):
+            with attempt:
+                do_the_download()
+
+    The loop stops when the body finishes without an error. Retryable errors
+    are logged and retried; anything else propagates. Returning from inside the
+    with block counts as success.
+
+    """
+
+    def __init__(self, retries=10, base_delay=2, max_delay=300,
+        host_connections=8, failure_threshold=5, cooldown=60, state_dir=None,
+        logger=None):
+        """
+        Make a new policy that retries the given number of times, with delays
+        growing from base_delay to max_delay seconds. At most host_connections
+        attempts against a host can run on the node at once, and a host that
+        fails failure_threshold times in a row gets left alone for cooldown
+        seconds.
+
+        Lock and state files go in state_dir, which should be on the local
+        filesystem of the node, and messages go to the given logger.
+
+        """
+
+        if state_dir is None:
+            state_dir = os.path.join(tempfile.gettempdir(), "retrylib")
+
+        try:
+            os.makedirs(state_dir)
+        except OSError:
+            # Someone else probably made it
+            pass
+
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = logger if logger is not None else logging.getLogger(
+            __name__)
+
+        self.metrics = RetryMetrics()
+        self.slots = HostSlots(state_dir, host_connections, self.metrics)
+        self.breaker = CircuitBreaker(state_dir, failure_threshold, cooldown)
+
+    def attempts(self, url, retry_on=(IOError,), description=None):
+        """
+        Yield Attempt context managers for trying something against the host
+        for the given URL, until one succeeds. Exceptions of the types in
+        retry_on are retried. The description is used in log messages, and
+        defaults to the URL.
+
+        Raises RuntimeError if we run out of retries.
+
+        """
+
+        host = host_key(url)
+
+        if description is None:
+            description = url
+
+        for delay in backoff_times(retries=self.retries,
+            base_delay=self.base_delay, max_delay=self.max_delay):
+
+            if delay > 0:
+                # We have to wait before trying again
+                self.metrics.add(host, "retries")
+                self.logger.info("Retry after {} seconds".format(delay))
+                time.sleep(delay)
+
+            if host is not None:
+                # Don't go back while the host is being left alone
+                self.metrics.add(host, "breaker_wait",
+                    self.breaker.wait(host))
+
+            attempt = Attempt(self, host, retry_on, description)
+            yield attempt
+
+            if attempt.succeeded:
+                return
@@ -0,0 +1,309 @@
+#!/usr/bin/env python2.7
+"""
+simulateReads.py: make synthetic paired-end alignments that look like what we
+pull out of the 1000 Genomes CRAMs, for testing and benchmarking read
+extraction without touching EBI.
+
+Every template gets a primary alignment for each end on the primary contig, and
+can also get alignments to alt contigs (with the bwa mem central base bug,
+sometimes), secondary alignments, and hard-clipped supplementary alignments.
+Output is SAM, or BAM (through samtools) if the output file ends in .bam, in
+name-sorted, coordinate-sorted, or random order.
+
+"""
+
+import argparse, sys, os, os.path, random, subprocess, string
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    Borrows heavily from the argparse documentation examples:
+    <http://docs.python.org/library/argparse.html>
+    """
+
+    # Construct the parser (which is stored in parser)
+    # Module docstring lives in __doc__
+    # See http://python-forum.com/pythonforum/viewtopic.php?f=3&t=36847
+    # And a formatter class so our examples in the docstring look good. Isn't it
+    # convenient how we already wrapped it to 80 characters?
+    # See http://docs.python.org/library/argparse.html#formatter-class
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # General options
+    parser.add_argument("out_file",
+        help="SAM or .bam file to write, or - for SAM on standard output")
+    parser.add_argument("--order", choices=["name", "coordinate", "random"],
+        default="name",
+        help="order to put the alignments in")
+    parser.add_argument("--contig", default="chr6",
+        help="name of the primary contig")
+    parser.add_argument("--contig_length", type=int, default=1000000,
+        help="length of the primary contig")
+    parser.add_argument("--alts", type=int, default=2,
+        help="number of alt contigs")
+    parser.add_argument("--alt_length", type=int, default=200000,
+        help="length of each alt contig")
+    parser.add_argument("--depth", type=float, default=10,
+        help="read depth on the primary contig")
+    parser.add_argument("--read_lengths", type=int, nargs="+",
+        default=[100, 101],
+        help="read lengths to pick from")
+    parser.add_argument("--insert_size", type=int, default=400,
+        help="mean distance between the outer ends of a pair")
+    parser.add_argument("--alt_fraction", type=float, default=0.3,
+        help="fraction of reads that also align to an alt")
+    parser.add_argument("--corrupt_fraction", type=float, default=0.5,
+        help="fraction of reverse-strand, even-length alt alignments that get "
+        "a wrong central base")
+    parser.add_argument("--secondary_rate", type=float, default=0.1,
+        help="mean number of secondary alignments per read")
+    parser.add_argument("--supplementary_rate", type=float, default=0.05,
+        help="mean number of supplementary alignments per read")
+    parser.add_argument("--mismatch_rate", type=float, default=0.01,
+        help="chance of a mismatch at each primary aligned base")
+    parser.add_argument("--seed", type=int, default=0,
+        help="random seed")
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+# We need to do reverse complements
+RC_TABLE = string.maketrans("ACGT", "TGCA")
+
+def reverse_complement(dna):
+    return dna.translate(RC_TABLE)[::-1]
+
+def contig_lengths(options):
+    """
+    Return a list of (name, length) for all the contigs, primary first.
+
+    """
+
+    return [(options.contig, options.contig_length)] + [
+        ("{}_KI27{:04d}v1_alt".format(options.contig, i), options.alt_length)
+        for i in xrange(options.alts)]
+
+def sam_header(options, sort_order):
+    """
+    Return the SAM header text for the given options and SAM sort order.
+
+    """
+
+    return "".join(["@HD\tVN:1.6\tSO:{}\n".format(sort_order)] + [
+        "@SQ\tSN:{}\tLN:{}\n".format(name, length)
+        for name, length in contig_lengths(options)])
+
+def count_extra(rate):
+    """
+    Pick how many extra alignments a read gets, when it gets the given number on
+    average. Each extra one is as likely as the one before.
+
+    """
+
+    count = 0
+    while random.random() < rate / (1.0 + rate):
+        count += 1
+    return count
+
+def mismatch_md(length, mismatches):
+    """
+    Make an MD tag for an aligned length with mismatches at the given sorted
+    positions.
+
+    """
+
+    parts = []
+    last = 0
+    for position in mismatches:
+        parts.append("{}{}".format(position - last, random.choice("ACGT")))
+        last = position + 1
+    parts.append(str(length - last))
+    return "".join(parts)
+
+def alignment_line(template, flags, contig, position, sequence, qualities,
+    mismatches, mate_contig, mate_position, clip=0, edits=None):
+    """
+    Make a SAM line for one alignment. The sequence and qualities are given in
+    read orientation, and flipped if the alignment is on the reverse strand.
+    Mismatches are positions along the aligned part. If clip is set, that many
+    bases are hard clipped off the start of the alignment. The NM tag is the
+    number of mismatches, unless edits is set.
+
+    """
+
+    if edits is None:
+        edits = len(mismatches)
+
+    if flags & 16:
+        sequence = reverse_complement(sequence)
+        qualities = qualities[::-1]
+
+    if clip > 0:
+        cigar = "{}H{}M".format(clip, len(sequence) - clip)
+        sequence = sequence[clip:]
+        qualities = qualities[clip:]
+    else:
+        cigar = "{}M".format(len(sequence))
+
+    return "\t".join([template, str(flags), contig, str(position), "60", cigar,
+        "=" if mate_contig == contig else mate_contig, str(mate_position), "0",
+        sequence, qualities, "NM:i:{}".format(edits),
+        "MD:Z:{}".format(mismatch_md(len(sequence), mismatches))]) + "\n"
+
+def simulate_template(options, index, contigs):
+    """
+    Make all the SAM lines for the template with the given number, on the given
+    list of (name, length) contigs.
+
+    """
+
+    template = "sim{:09d}".format(index)
+    primary_name, primary_length = contigs[0]
+
+    # Where do the ends go, and which one is reversed?
+    length = random.choice(options.read_lengths)
+    start = random.randint(1, max(1, primary_length - options.insert_size))
+    positions = {1: start, 2: start + max(0, options.insert_size - length)}
+    reverse_end = random.choice([1, 2])
+
+    lines = []
+
+    for end in (1, 2):
+        other = 3 - end
+        sequence = "".join(random.choice("ACGT") for i in xrange(length))
+        qualities = "".join(random.choice("5?I") for i in xrange(length))
+
+        # Set paired, proper pair, and the end
+        flags = 1 | 2 | (64 if end == 1 else 128)
+        if end == reverse_end:
+            flags |= 16
+        else:
+            flags |= 32
+
+        mismatches = sorted(random.sample(xrange(length), min(length,
+            count_extra(options.mismatch_rate * length))))
+        # Everything else is a worse hit than the primary
+        worse = sorted(set(mismatches + [random.randrange(length)]))
+
+        lines.append(alignment_line(template, flags, primary_name,
+            positions[end], sequence, qualities, mismatches, primary_name,
+            positions[other]))
+
+        if random.random() < options.alt_fraction and len(contigs) > 1:
+            # Also hit an alt, as a supplementary alignment
+            alt_name, alt_length = random.choice(contigs[1:])
+            alt_sequence = sequence
+            if (flags & 16 and length % 2 == 0 and
+                random.random() < options.corrupt_fraction):
+                # Get one of the middle bases wrong, like bwa mem does
+                middle = length / 2 - random.randint(0, 1)
+                alt_sequence = (sequence[:middle] + random.choice(
+                    [base for base in "ACGT" if base != sequence[middle]]) +
+                    sequence[middle + 1:])
+            lines.append(alignment_line(template, flags | 2048, alt_name,
+                random.randint(1, max(1, alt_length - length)), alt_sequence,
+                qualities, worse, primary_name, positions[other]))
+
+        for i in xrange(count_extra(options.secondary_rate)):
+            # Add a secondary hit somewhere else on the primary contig
+            lines.append(alignment_line(template, flags | 256, primary_name,
+                random.randint(1, max(1, primary_length - length)), sequence,
+                qualities, worse, primary_name, positions[other]))
+
+        for i in xrange(count_extra(options.supplementary_rate)):
+            # Add a hard-clipped supplementary hit. Count the clipped bases as
+            # edits so it never looks better than the primary.
+            clip = length - length / 2
+            lines.append(alignment_line(template, flags | 2048, primary_name,
+                random.randint(1, max(1, primary_length - length)), sequence,
+                qualities, [position for position in worse
+                if position < length / 2], primary_name, positions[other],
+                clip=clip, edits=len(worse) + clip))
+
+    return lines
+
+def simulate(options, stream, order=None):
+    """
+    Write simulated SAM for the given options to the given stream, in the given
+    order (defaulting to the order in the options). Returns the number of
+    alignments written.
+
+    Anything other than name order is built in memory, so keep it small.
+
+    """
+
+    if order is None:
+        order = options.order
+
+    random.seed(options.seed)
+
+    contigs = contig_lengths(options)
+    mean_length = sum(options.read_lengths) / float(len(options.read_lengths))
+    templates = int(options.depth * options.contig_length / (2 * mean_length))
+
+    stream.write(sam_header(options, {"name": "queryname",
+        "coordinate": "coordinate", "random": "unsorted"}[order]))
+
+    if order == "name":
+        # Template names sort in the order we make them
+        count = 0
+        for index in xrange(templates):
+            for line in simulate_template(options, index, contigs):
+                stream.write(line)
+                count += 1
+        return count
+
+    lines = [line for index in xrange(templates)
+        for line in simulate_template(options, index, contigs)]
+
+    if order == "coordinate":
+        # Sort by contig number and position
+        contig_order = {name: i for i, (name, length) in enumerate(contigs)}
+        def coordinate_key(line):
+            parts = line.split("\t", 4)
+            return contig_order[parts[2]], int(parts[3])
+        lines.sort(key=coordinate_key)
+    else:
+        random.shuffle(lines)
+
+    for line in lines:
+        stream.write(line)
+
+    return len(lines)
+
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    options = parse_args(args) # This holds the nicely-parsed options object
+
+    if options.out_file == "-":
+        count = simulate(options, sys.stdout)
+    elif options.out_file.endswith(".bam"):
+        # Have samtools compress it
+        samtools = subprocess.Popen(["samtools", "view", "-b", "-o",
+            options.out_file, "-"], stdin=subprocess.PIPE)
+        count = simulate(options, samtools.stdin)
+        samtools.stdin.close()
+        if samtools.wait() != 0:
+            raise RuntimeError("samtools view returned {}".format(
+                samtools.returncode))
+    else:
+        with open(options.out_file, "w") as out_file:
+            count = simulate(options, out_file)
+
+    sys.stderr.write("Wrote {} alignments\n".format(count))
+
+    return 0
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
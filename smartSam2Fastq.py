@@ -1,16 +1,19 @@
 #!/usr/bin/env python2.7
 """
-smartSam2Fastq.py: turn sorted-by-names SAM input into a properly deduplicated
-FASTQ. Also work around the bug in bwa mem where some even-length alignments to
-reverse strands of alts will have incorrect bases for one of the middle two
-bases.
+smartSam2Fastq.py: turn sorted-by-names SAM, BAM, or CRAM input into a properly
+deduplicated FASTQ. With --unsorted, input can be in any order. Also work around
+the bug in bwa mem where some even-length alignments to reverse strands of alts
+will have incorrect bases for one of the middle two bases.
 
 accounts for both secondary and supplementary alignments of the same read
 
 """
 
 import argparse, sys, os, os.path, random, itertools, string, re
-import doctest
+import doctest, collections, multiprocessing, cStringIO, tempfile, zlib
+import struct
+
+from multiprocessing.pool import ThreadPool
 
 import pysam
 
@@ -27,6 +30,27 @@ BAM_FREVERSE=16
 BAM_FREAD1=64
 BAM_FREAD2=128
 
+def end_for_flags(flags):
+    """
+    Work out which end of its template (1, 2, or 0 for unpaired) a read is, from
+    its SAM flags.
+    
+    """
+    
+    if flags & BAM_FREAD1:
+        if flags & BAM_FREAD2:
+            # This shouldn't happen
+            raise RuntimeError("Alignment flagged as both READ1 and READ2")
+        
+        # Otherwise we're READ1
+        return 1
+    elif flags & BAM_FREAD2:
+        # We're READ2
+        return 2
+    else:
+        # We're unpaired
+        return 0
+
 def parse_args(args):
     """
     Takes in the command-line arguments list (args), and returns a nice argparse
@@ -48,7 +72,17 @@ def parse_args(args):
     # General options
     parser.add_argument("--input_sam", type=argparse.FileType("r"),
         default=sys.stdin,
-        help="input SAM in name-sorted order. Cannot be standard input.")
+        help="input SAM in name-sorted order")
+    parser.add_argument("--input_bam", default=None,
+        help="input BAM or CRAM file (or - for standard input) in name-sorted "
+        "order, to read instead of SAM")
+    parser.add_argument("--threads", type=int, default=1,
+        help="number of threads to decompress BAM or CRAM input with")
+    parser.add_argument("--reference", default=None,
+        help="reference FASTA for CRAM input")
+    parser.add_argument("--check_md", action="store_true",
+        help="with BAM or CRAM input, only suspect alt alignments that have "
+        "mismatches in the middle of the read, according to the MD tag")
     parser.add_argument("--fq1", type=argparse.FileType("w"),
         default=sys.stdout,
         help="FASTQ file to save all the READ1 reads in")
@@ -57,6 +91,27 @@ def parse_args(args):
         help="FASTQ file to save all the READ2 reads in")
     parser.add_argument("--interleaved", action="store_true",
         help="write interleaved FASTQ to fq1")
+    parser.add_argument("--compress", choices=["none", "gzip", "bgzf"],
+        default=None,
+        help="compression for the FASTQ output (default: bgzf if fq1 ends in "
+        ".gz, and none otherwise)")
+    parser.add_argument("--compress_threads", type=int, default=1,
+        help="number of threads to compress output blocks with")
+    parser.add_argument("--buffer_size", type=int, default=4 * 1024 * 1024,
+        help="bytes of FASTQ to buffer up and write (or compress) at once")
+    parser.add_argument("--processes", type=int, default=1,
+        help="number of worker processes to deduplicate with")
+    parser.add_argument("--chunk_lines", type=int, default=100000,
+        help="approximate number of SAM lines to give a worker at a time")
+    parser.add_argument("--unsorted", action="store_true",
+        help="accept input in any order, instead of sorted by template name")
+    parser.add_argument("--max_pending", type=int, default=1000000,
+        help="number of reads to hold in memory in --unsorted mode before "
+        "spilling to disk")
+    parser.add_argument("--spill_dir", default=None,
+        help="directory to spill pending reads to in --unsorted mode")
+    parser.add_argument("--partitions", type=int, default=64,
+        help="number of on-disk partitions to spill pending reads into")
     
     # The command line arguments start with the program name, which we don't
     # want to treat as an argument for argparse. So we remove it.
@@ -68,64 +123,204 @@ class Read(object):
     """
     Represent a Read as reconstructed from an alignment.
     
+    Only the fields needed to deduplicate and write reads are kept, and the
+    sequence and qualities are stored as they appear in the alignment. They
+    are only put back in the read's original orientation when someone asks for
+    them (usually when the read is written out), since most alignments we parse
+    are secondary or supplementary copies that get thrown away.
+    
+    >>> read = Read("t1\\t83\\tchr1\\t100\\t60\\t4M\\t=\\t200\\t0\\tAACG\\t"
+    ...     "ABCD\\tNM:i:1")
+    >>> read.get_name()
+    't1/1'
+    >>> read.sequence
+    'CGTT'
+    >>> read.qualities
+    'DCBA'
+    >>> read.edits
+    1
+    
     """
+    
+    __slots__ = ["template", "end", "contig", "edits", "is_reverse",
+        "is_suspect", "raw_sequence", "raw_qualities", "oriented"]
+    
     def __init__(self, sam_line):
         """
         Parse the given SAM line and construct a read.
         
         """
         
-        # Save the line
-        self.line = sam_line
+        # Parse out the fields, leaving the tags together
+        parts = sam_line.split("\t", 11)
         
-        # Parse out the fields
-        parts = sam_line.split("\t")
         # Get the template name
         self.template = parts[0]
         
         # Grab the flags
-        self.flags = int(parts[1])
+        flags = int(parts[1])
         
         # What end are we (1, 2, or 0 for unpaired)
-        if self.flags & BAM_FREAD1:
-            if self.flags & BAM_FREAD2:
-                # This shouldn't happen
-                raise RuntimeError("Alignment flagged as both READ1 and READ2")
-            
-            # Otherwise we're READ1
-            self.end = 1
-        elif self.flags & BAM_FREAD2:
-            # We're READ2
-            self.end = 2
-        else:
-            # We're unpaired
-            self.end = 0
+        self.end = end_for_flags(flags)
             
-        # Grab sequence and qualities
-        self.sequence = parts[9]
-        self.qualities = parts[10]
+        # Grab sequence and qualities as aligned
+        self.raw_sequence = parts[9]
+        
+        if len(parts) > 11:
+            self.raw_qualities = parts[10]
+            tags = parts[11]
+        else:
+            # The qualities are last and have the line ending on them
+            self.raw_qualities = parts[10].rstrip("\r\n")
+            tags = ""
         
         # Count edits
         self.edits = float("inf")
-        for tag in parts[11:]:
-            if tag.startswith("NM:i:"):
-                self.edits = int(tag[5:])
-        
+        if tags.startswith("NM:i:"):
+            tag_start = 0
+        else:
+            tag_start = tags.find("\tNM:i:")
+            if tag_start != -1:
+                # Skip the tab
+                tag_start += 1
+        if tag_start != -1:
+            tag_end = tags.find("\t", tag_start)
+            if tag_end == -1:
+                tag_end = len(tags)
+            self.edits = int(tags[tag_start + 5:tag_end])
         
+        # Note whether we need to flip to the other strand to get the read
+        self.is_reverse = bool(flags & BAM_FREVERSE)
         
-        if self.flags & BAM_FREVERSE:
-            # Flip to the other strand by RCing sequence and reversing qualities
-            self.sequence = reverse_complement(self.sequence)
-            self.qualities = self.qualities[::-1]
-            self.is_reverse = True
-        else:
-            self.is_reverse = False
+        # This holds the (sequence, qualities) in read orientation, once we
+        # work them out
+        self.oriented = None
             
         # Grab the contig we mapped to
         self.contig = parts[2]
         
         # Say we are suspect if we're on an alt.
         self.is_suspect = self.contig.endswith("_alt")
+        
+    @classmethod
+    def from_pysam(cls, alignment, contig):
+        """
+        Construct a read straight from the binary fields of the given pysam
+        AlignedSegment, mapped to the given contig name, without going through
+        SAM text.
+        
+        """
+        
+        read = cls.__new__(cls)
+        
+        read.template = alignment.query_name
+        read.end = end_for_flags(alignment.flag)
+        
+        # Records without sequence or qualities look like they do in SAM
+        read.raw_sequence = alignment.query_sequence or "*"
+        if alignment.query_qualities is None:
+            read.raw_qualities = "*"
+        else:
+            read.raw_qualities = pysam.qualities_to_qualitystring(
+                alignment.query_qualities)
+        
+        if alignment.has_tag("NM"):
+            read.edits = alignment.get_tag("NM")
+        else:
+            read.edits = float("inf")
+            
+        read.is_reverse = alignment.is_reverse
+        read.oriented = None
+        
+        read.contig = contig
+        read.is_suspect = contig.endswith("_alt")
+        
+        return read
+        
+    def to_record(self):
+        """
+        Turn this Read into a line of text that from_record() can load again,
+        for spilling to disk.
+        
+        """
+        
+        return "\t".join((self.template, str(self.end), self.contig,
+            str(self.edits), "1" if self.is_reverse else "0",
+            "1" if self.is_suspect else "0", self.raw_sequence,
+            self.raw_qualities)) + "\n"
+            
+    @classmethod
+    def from_record(cls, line):
+        """
+        Load a Read from a line made by to_record().
+        
+        >>> read = Read("t1\\t163\\tchr1_KI270706v1_alt\\t100\\t60\\t4M\\t=\\t"
+        ...     "200\\t0\\tAACG\\tABCD")
+        >>> copy = Read.from_record(read.to_record())
+        >>> copy == read, copy.is_suspect, copy.edits
+        (True, True, inf)
+        
+        """
+        
+        parts = line.rstrip("\n").split("\t")
+        
+        read = cls.__new__(cls)
+        
+        read.template = parts[0]
+        read.end = int(parts[1])
+        read.contig = parts[2]
+        read.edits = float(parts[3]) if parts[3] == "inf" else int(parts[3])
+        read.is_reverse = parts[4] == "1"
+        read.is_suspect = parts[5] == "1"
+        read.raw_sequence = parts[6]
+        read.raw_qualities = parts[7]
+        read.oriented = None
+        
+        return read
+        
+    def orient(self):
+        """
+        Return the sequence and qualities of the read, in its original
+        orientation.
+        
+        """
+        
+        if self.oriented is None:
+            if self.is_reverse:
+                # Flip to the other strand by RCing sequence and reversing
+                # qualities
+                self.oriented = (reverse_complement(self.raw_sequence),
+                    self.raw_qualities[::-1])
+            else:
+                self.oriented = (self.raw_sequence, self.raw_qualities)
+                
+        return self.oriented
+        
+    @property
+    def sequence(self):
+        """
+        The read's sequence, in its original orientation.
+        
+        """
+        
+        return self.orient()[0]
+        
+    @property
+    def qualities(self):
+        """
+        The read's qualities, in its original orientation.
+        
+        """
+        
+        return self.orient()[1]
+        
+    def __len__(self):
+        """
+        Get the length of the read's sequence, without orienting it.
+        
+        """
+        
+        return len(self.raw_sequence)
             
     def get_name(self):
         """
@@ -150,17 +345,18 @@ class Read(object):
         if not isinstance(other, self.__class__):
             return False
         
-        
         if self.template != other.template:
             return False
-        if self.sequence != other.sequence:
-            return False
-        if self.qualities != other.qualities:
-            return Fasle
         if self.end != other.end:
             return False
             
-        return True
+        if self.is_reverse == other.is_reverse:
+            # We can compare the alignments' copies directly
+            return (self.raw_sequence == other.raw_sequence and
+                self.raw_qualities == other.raw_qualities)
+        
+        return (self.sequence == other.sequence and
+            self.qualities == other.qualities)
         
     def __ne__(self, other):
         return not (self.__eq__(other))
@@ -177,8 +373,7 @@ class Read(object):
         # Also just take ones with less edits if they aren't bad-looking
         return (self.template == other.template and self.end == other.end and 
             not (self.is_suspect and not other.is_suspect) and
-            (len(self.sequence) >= len(other.sequence) or 
-            self.edits <= other.edits))
+            (len(self) >= len(other) or self.edits <= other.edits))
             
     def __str__(self):
         """
@@ -230,99 +425,204 @@ def parse_MD_tag(md_string, offset, length):
                 cursor += len(part)
             
     
-    print md_string
-    print parts
-    print to_return
-    
     return to_return
     
 
-def pysam_parse_reads(sam_file):
+def md_has_mismatch(md_string, offset, first, last):
     """
-    Parse and deduplicate with pysam. Takes a filename or File object.
+    Given the string value of an MD tag and the offset into the read at which it
+    starts, return True if there is a mismatch at any read position from first
+    to last, inclusive. Positions count the same way as in parse_MD_tag().
     
-    Yields Reads with their is_suspect flag modified so we only suspect alt
-    alignments which have central mismatches.
+    Scans the tag once, a character at a time, and stops as soon as it gets
+    past last, without building anything.
+    
+    >>> md_has_mismatch("10A5", 0, 10, 11)
+    True
+    >>> md_has_mismatch("10A5", 0, 11, 12)
+    False
+    >>> md_has_mismatch("3^AC0T2", 2, 5, 5)
+    True
+    >>> md_has_mismatch("3^AC0T2", 2, 6, 7)
+    False
     
     """
     
-    sam = pysam.AlignmentFile(sam_file)
+    # Where does the current run of matches start?
+    cursor = offset
+    # How long is it so far?
+    matches = 0
+    # Are we in the reference bases of a deletion?
+    deleting = False
     
-    for read in sam:
+    for char in md_string:
+        if "0" <= char <= "9":
+            # Keep reading the number of matches
+            matches = matches * 10 + ord(char) - 48
+            deleting = False
+        elif char == "^":
+            # The following bases were deleted, and aren't in the read
+            cursor += matches
+            matches = 0
+            deleting = True
+        elif not deleting:
+            # This is a mismatch, at the end of the matches
+            cursor += matches
+            matches = 0
+            
+            if cursor > last:
+                # Everything else is after the positions we care about
+                return False
+            if cursor >= first:
+                return True
+                
+            cursor += 1
+            
+    return False
     
-        print("Handling read on template {}".format(read.query_name))
+def central_mismatches(md_strings, offsets, lengths):
+    """
+    Given parallel sequences of MD tag strings, the read offsets where they
+    start, and the input read lengths, return a list of whether each read is
+    even-length and has a mismatch at one of its middle two bases, like
+    has_central_mismatch().
     
-        is_suspect = False
-        
-        # Calculate the length of the original input read, including bases that
-        # were hard clipped.
-        input_length = 0
+    >>> central_mismatches(["2A1", "1A2", "2A2"], [0, 0, 0], [4, 4, 5])
+    [True, False, False]
+    
+    """
+    
+    return [length % 2 == 0 and md_has_mismatch(md_string, offset,
+        length / 2, length / 2 + 1) for md_string, offset, length in
+        itertools.izip(md_strings, offsets, lengths)]
         
-        if read.cigartuples is None:
-            # Just use the read itself.
-            # TODO: why do we have no CIGAR?
-            input_length = len(read.query_sequence)
+def has_central_mismatch(alignment):
+    """
+    Return True if the given pysam AlignedSegment has a mismatch at one of the
+    middle two bases of the original read, according to its MD tag. Those are
+    the bases that bwa mem can get wrong for even-length reads on alts.
+    
+    Odd-length reads and alignments without CIGARs or MD tags never have
+    central mismatches.
+    
+    """
+    
+    if alignment.cigartuples is None or not alignment.has_tag("MD"):
+        # We can't tell where anything is
+        return False
+    
+    # Calculate the length of the original input read, including bases that
+    # were hard clipped.
+    input_length = 0
+    for (op, count) in alignment.cigartuples:
+        if op == 2 or op == 3 or op == 6:
+            # Skip deletions, reference skips, and padding
+            continue
         else:
+            input_length += count
+            
+    if input_length % 2 != 0:
+        # Only even-length reads get corrupted
+        return False
         
-            for (op, count) in read.cigartuples:
-                if op == 2 or op == 3 or op == 6:
-                    # Skip deletions, reference skips, and padding
-                    continue
-                else:
-                    input_length += count
-        
-        reference_name = sam.getrname(read.reference_id)
-        
-        if input_length is None:
-            print read
-        
-        if input_length % 2 == 0 and reference_name.endswith("_alt"):
-            # It could be corrupted.
-
-            # Work out the clipping offset from the CIGAR (4 = soft clip, 5 =
-            # hard clip)
-            first_cigar = read.cigartuples[0]
-            if (first_cigar[0] == 4 or
-                first_cigar[0] == 5):
-                offset = first_cigar[1]
-            else:
-                offset = 0
+    # Work out the clipping offset from the CIGAR (4 = soft clip, 5 = hard
+    # clip)
+    first_cigar = alignment.cigartuples[0]
+    if (first_cigar[0] == 4 or
+        first_cigar[0] == 5):
+        offset = first_cigar[1]
+    else:
+        offset = 0
 
-            # Work out what's up with every query base from the MD tag
-            status_per_base = parse_MD_tag(read.get_tag("MD"), offset,
-                input_length)
+    # Use truncating division to check around the center
+    return md_has_mismatch(alignment.get_tag("MD"), offset, input_length / 2,
+        input_length / 2 + 1)
 
+def parse_bam_reads(bam_filename, threads=1, reference=None, check_md=False):
+    """
+    Read Reads directly from the given BAM or CRAM file (or - for standard
+    input) with pysam, using the given number of decompression threads and the
+    given reference FASTA for CRAM, if any.
+    
+    If check_md is set, alt alignments are only suspect if they have a
+    mismatch in the middle of the read.
+    
+    """
+    
+    # Standard input has to be BAM, since we can't sniff it
+    mode = "rc" if bam_filename.endswith(".cram") else "rb"
+    
+    alignment_file = pysam.AlignmentFile(bam_filename, mode, threads=threads,
+        reference_filename=reference)
+    
+    # Look up contig names by reference ID once
+    contigs = list(alignment_file.references)
+    
+    for alignment in alignment_file:
+        if alignment.reference_id < 0:
+            contig = "*"
+        else:
+            contig = contigs[alignment.reference_id]
             
-                
-            print("Errors: {}: {} {}: {}".format(input_length / 2, 
-                status_per_base.has_key(input_length / 2),
-                input_length / 2 + 1, 
-                status_per_base.has_key(input_length / 2 + 1)))
-                
-            # Use truncating division to check around the center
-            if (status_per_base.has_key(input_length / 2) or
-                status_per_base.has_key(input_length / 2 + 1)):
-                
-                # There's a mismatch near the center
-                is_suspect = True
-        
-        # Re-parse with our code after fixing up the reference name.
-        # TODO ugly hack in need of redesign
-        parts = str(read).split("\t")
-        parts[2] = reference_name
-        our_read = Read("\t".join(parts))
+        read = Read.from_pysam(alignment, contig)
         
-        # Fix up the suspect flag
-        our_read.is_suspect = is_suspect
+        if check_md and read.is_suspect:
+            # Only suspect the alignment if it looks corrupted
+            read.is_suspect = has_central_mismatch(alignment)
+            
+        yield read
         
-        yield our_read
+    alignment_file.close()
+    
+def parse_sam_reads(sam_input):
+    """
+    Given a source of input SAM lines, yield a Read for each alignment line,
+    skipping the header.
+    
+    """
+    
+    for line in sam_input:
+        if not line.startswith("@"):
+            yield Read(line)
     
-        
 def parse_and_deduplicate_sam(sam_input):
     """
     Given a source of input SAM lines, parses lines into Read objects, and
-    deduplicates them, discarding suspect ones when non-suspect ones are
-    available.
+    deduplicates them with deduplicate_reads().
+    
+    """
+    
+    return deduplicate_reads(parse_sam_reads(sam_input))
+    
+def add_read(reads_by_end, read):
+    """
+    Add the given Read to the given dict from end number to the best Read so
+    far for each end of its template, if it is better than what's there.
+    
+    Raises RuntimeError if non-suspect alignments disagree about the read.
+    
+    """
+    
+    if not reads_by_end.has_key(read.end):
+        # This is the only read for this end so far
+        reads_by_end[read.end] = read
+    else:
+        if reads_by_end[read.end] < read:
+            # Replace the existing read
+            reads_by_end[read.end] = read
+        elif (not read.is_suspect and 
+            len(read) >= len(reads_by_end[read.end]) and 
+            read != reads_by_end[read.end]):
+            # We aren't suspect, we differ, and we can't replace the other
+            # read.
+            raise RuntimeError("Non-suspect alignments don't agree on end "
+                "{} of template {}:\n{}\n{}".format(read.end, read.template,
+                read, reads_by_end[read.end]))
+        
+def deduplicate_reads(reads):
+    """
+    Given an iterable of Read objects, grouped by template, deduplicates them,
+    discarding suspect ones when non-suspect ones are available.
     
     Yields dicts form end number to Read object for each template.
     
@@ -334,11 +634,7 @@ def parse_and_deduplicate_sam(sam_input):
     # For this template, we keep the best read for each end we find.
     reads_by_end = {}
     
-    for line in sam_input:
-        if line.startswith("@"):
-            continue
-            
-        read = Read(line)
+    for read in reads:
         
         # Work on the reads
         
@@ -352,64 +648,457 @@ def parse_and_deduplicate_sam(sam_input):
             last_template = read.template
             reads_by_end = {}
             
-        
-        if not reads_by_end.has_key(read.end):
-            # This is the only read for this end so far
-            reads_by_end[read.end] = read
-        else:
-            if reads_by_end[read.end] < read:
-                # Replace the existing read
-                reads_by_end[read.end] = read
-            elif (not read.is_suspect and 
-                len(read.sequence) >= len(reads_by_end[read.end].sequence) and 
-                read != reads_by_end[read.end]):
-                # We aren't suspect, we differ, and we can't replace the other
-                # read.
-                raise RuntimeError("Non-suspect alignments don't agree on end "
-                    "{} of template {}:\n{}\n{}".format(read.end, read.template,
-                    read.line, reads_by_end[read.end].line))
+        add_read(reads_by_end, read)
     
     # It's OK if we spit out suspect stuff as long as we got the best
     # suspect alignment
     yield reads_by_end
+    
+def spill_templates(templates, spill_files):
+    """
+    Write the Reads in the given dict from template name to dict from end
+    number to Read out to the given list of partition files, putting all the
+    reads for each template in the same partition.
+    
+    """
+    
+    for template, reads_by_end in templates.iteritems():
+        spill_file = spill_files[hash(template) % len(spill_files)]
+        for read in reads_by_end.itervalues():
+            spill_file.write(read.to_record())
+            
+def deduplicate_unsorted(reads, max_pending=1000000, spill_dir=None,
+    partitions=64):
+    """
+    Given an iterable of Read objects in any order, deduplicates them like
+    deduplicate_reads(), and yields dicts from end number to Read object for
+    each template, in no particular order.
+    
+    The best reads so far for each template are kept in a hash table until the
+    input runs out. If it ever holds more than max_pending reads, it is spilled
+    to the given number of partition files in spill_dir (or the system temp
+    directory), split by template, and each partition is deduplicated on its
+    own once all the input is read. So only about 1/partitions of the spilled
+    reads are ever in memory at once.
+    
+    """
+    
+    # This holds the best reads so far by end, by template name
+    pending = {}
+    # How many reads are in there?
+    pending_reads = 0
+    
+    # This holds the partition files, once we need them. They delete
+    # themselves when closed.
+    spill_files = None
+    
+    try:
+        for read in reads:
+            reads_by_end = pending.get(read.template)
+            if reads_by_end is None:
+                # This is a new template
+                reads_by_end = pending[read.template] = {}
+                
+            if not reads_by_end.has_key(read.end):
+                # We will be holding one more read
+                pending_reads += 1
+                
+            add_read(reads_by_end, read)
+            
+            if pending_reads > max_pending:
+                # Move everything we have to disk
+                if spill_files is None:
+                    spill_files = [tempfile.TemporaryFile(dir=spill_dir)
+                        for _ in xrange(partitions)]
+                spill_templates(pending, spill_files)
+                pending = {}
+                pending_reads = 0
+                
+        if spill_files is None:
+            # Everything fit in memory
+            for reads_by_end in pending.itervalues():
+                yield reads_by_end
+            return
+            
+        # Otherwise, finish each template from its partition
+        spill_templates(pending, spill_files)
+        pending = {}
+        
+        for spill_file in spill_files:
+            spill_file.seek(0)
+            
+            # Combine the best reads from each spill
+            partition = {}
+            for line in spill_file:
+                read = Read.from_record(line)
+                add_read(partition.setdefault(read.template, {}), read)
+                
+            for reads_by_end in partition.itervalues():
+                yield reads_by_end
+                
+            # Give back the disk space as we go
+            spill_file.close()
+    finally:
+        if spill_files is not None:
+            for spill_file in spill_files:
+                spill_file.close()
             
 def write_fastq(stream, read):
     """
     Write the given record as FASTQ to the given stream
     """
     
-    # Unpack and format the record
-    stream.write("@{}\n{}\n+\n{}\n".format(read.get_name(), read.sequence,
-        read.qualities))
+    # Unpack and format the record. % is a good bit faster than format() here.
+    sequence, qualities = read.orient()
+    stream.write("@%s\n%s\n+\n%s\n" % (read.get_name(), sequence, qualities))
+        
+# BGZF blocks can hold at most 64 KB, and need room for compression overhead
+BGZF_BLOCK_SIZE = 0xff00
+
+def gzip_member(data, level=6, extra=""):
+    """
+    Compress the given string into a complete gzip member, with the given raw
+    extra field data, if any. Members can be concatenated to make a gzip file.
     
-def main(args):
     """
-    Parses command line arguments and do the work of the program.
-    "args" specifies the program arguments, with args[0] being the executable
-    name. The return value should be used as the program's exit code.
+    
+    # Make a raw deflate stream, and wrap it in our own header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    
+    if len(extra) > 0:
+        # Set FEXTRA and say how long the extra data is
+        header = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" + struct.pack(
+            "<H", len(extra)) + extra
+    else:
+        header = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+        
+    return header + compressed + struct.pack("<II",
+        zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+        
+def bgzf_block(data, level=6):
     """
+    Compress at most BGZF_BLOCK_SIZE bytes of data into a BGZF block: a gzip
+    member that knows its own compressed size.
     
-    if len(args) == 2 and args[1] == "--test":
-        # Run the tests
-        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+    An empty block is the standard BGZF end-of-file marker:
     
-    options = parse_args(args) # This holds the nicely-parsed options object
+    >>> bgzf_block("").encode("hex")
+    '1f8b08040000000000ff0600424302001b0003000000000000000000'
+    
+    """
+    
+    # Compress once with a placeholder size, then fill in the real size
+    member = gzip_member(data, level, "BC\x02\x00\x00\x00")
+    return member[:16] + struct.pack("<H", len(member) - 1) + member[18:]
+    
+def compress_block(data, compression, level=6):
+    """
+    Compress the given string of output for the given kind of compression
+    ("gzip" or "bgzf"). Gzip data becomes one gzip member, and BGZF data
+    becomes as many BGZF blocks as it needs.
+    
+    """
+    
+    if compression == "gzip":
+        return gzip_member(data, level)
+    
+    return "".join(bgzf_block(data[i:i + BGZF_BLOCK_SIZE], level)
+        for i in xrange(0, len(data), BGZF_BLOCK_SIZE))
+
+class BlockWriter(object):
+    """
+    Write-only file-like object that buffers up lots of small writes and
+    passes them to an underlying stream in big blocks, optionally compressing
+    the blocks as gzip or BGZF. Blocks are compressed in parallel in a pool of
+    threads (zlib lets go of the GIL), and written out in order.
+    
+    Remember to close() it to get the last of the data out. The underlying
+    stream is flushed but not closed.
+    
+    """
+    
+    def __init__(self, stream, compression=None, threads=1,
+        buffer_size=4 * 1024 * 1024, level=6):
+        """
+        Make a writer that writes to the given stream, with the given
+        compression ("gzip", "bgzf", or None), using the given number of
+        threads, buffering the given number of bytes, and compressing at the
+        given zlib level.
+        
+        """
+        
+        self.stream = stream
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.level = level
+        self.threads = threads
+        
+        # This holds strings waiting to become a block
+        self.buffer = []
+        # And this is how many bytes are in there
+        self.buffered = 0
+        
+        # This holds AsyncResults for compressed blocks, in order
+        self.pending = collections.deque()
+        
+        if compression is not None:
+            self.pool = ThreadPool(threads)
+        else:
+            self.pool = None
+            
+    def write(self, data):
+        """
+        Write the given string.
+        
+        """
+        
+        self.buffer.append(data)
+        self.buffered += len(data)
+        
+        if self.buffered >= self.buffer_size:
+            self.flush_buffer()
+            
+    def flush_buffer(self):
+        """
+        Send off everything buffered as a block.
+        
+        """
+        
+        if self.buffered == 0:
+            return
+            
+        block = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        
+        if self.pool is None:
+            self.stream.write(block)
+            return
+            
+        self.pending.append(self.pool.apply_async(compress_block,
+            (block, self.compression, self.level)))
+            
+        while len(self.pending) > self.threads * 2:
+            # Don't get too far ahead of the stream
+            self.stream.write(self.pending.popleft().get())
+            
+    def close(self):
+        """
+        Write out everything, finish the compressed stream, and stop the
+        compression threads.
+        
+        """
+        
+        self.flush_buffer()
+        
+        while len(self.pending) > 0:
+            self.stream.write(self.pending.popleft().get())
+            
+        if self.compression == "bgzf":
+            # Say the file is complete
+            self.stream.write(bgzf_block(""))
+            
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            
+        self.stream.flush()
+
+def write_templates(templates, fq1, fq2, interleaved):
+    """
+    Given an iterable of dicts from end number to Read object, write out the
+    paired reads to the fq1 and fq2 streams, or just to fq1 if interleaved is
+    set.
     
-    for reads_by_end in parse_and_deduplicate_sam(options.input_sam):
+    """
+    
+    for reads_by_end in templates:
         if not (reads_by_end.has_key(1) and reads_by_end.has_key(2)):
             # Skip unpaired reads
             continue
             
         # Split up the reads to their files
-        write_fastq(options.fq1, reads_by_end[1])
+        write_fastq(fq1, reads_by_end[1])
         
-        if options.interleaved:
+        if interleaved:
             # Both go to the same file
-            write_fastq(options.fq1, reads_by_end[2])
+            write_fastq(fq1, reads_by_end[2])
         else:
-            write_fastq(options.fq2, reads_by_end[2])
+            write_fastq(fq2, reads_by_end[2])
+            
+def template_chunks(sam_input, chunk_lines):
+    """
+    Split the given name-sorted SAM lines into lists of about chunk_lines
+    lines, without splitting any template between lists. Header lines are
+    dropped.
+    
+    >>> list(template_chunks(["@HD\\n", "a\\t1\\n", "a\\t2\\n", "b\\t1\\n"], 1))
+    [['a\\t1\\n', 'a\\t2\\n'], ['b\\t1\\n']]
+    
+    """
+    
+    chunk = []
+    last_template = None
+    
+    for line in sam_input:
+        if line.startswith("@"):
+            continue
+            
+        template = line[:line.find("\t")]
+        
+        if len(chunk) >= chunk_lines and template != last_template:
+            # This is a good place to cut
+            yield chunk
+            chunk = []
+            
+        chunk.append(line)
+        last_template = template
         
+    if len(chunk) > 0:
+        yield chunk
+        
+def deduplicate_chunk(task):
+    """
+    Deduplicate a chunk of whole templates' SAM lines, in a worker process.
+    Takes a tuple of the lines and whether to interleave the output, and
+    returns the FASTQ data for fq1 and fq2.
+    
+    """
+    
+    lines, interleaved = task
+    
+    fq1 = cStringIO.StringIO()
+    fq2 = cStringIO.StringIO()
+    
+    write_templates(parse_and_deduplicate_sam(lines), fq1, fq2, interleaved)
+    
+    return fq1.getvalue(), fq2.getvalue()
+    
+def parallel_deduplicate(sam_input, fq1, fq2, interleaved, processes,
+    chunk_lines):
+    """
+    Deduplicate the name-sorted SAM lines from sam_input and write the FASTQ
+    reads to fq1 and fq2 (or just fq1 if interleaved), using the given number
+    of worker processes.
+    
+    Each worker gets chunks of whole templates, and results are written back
+    out in input order, so the output is the same as from a single process.
+    Only a few chunks are in flight at once, so memory use stays bounded.
+    
+    """
+    
+    pool = multiprocessing.Pool(processes)
+    
+    # This holds AsyncResults for chunks, in input order
+    pending = collections.deque()
+    
+    def write_next():
+        """
+        Wait for the oldest chunk and write it out.
+        
+        """
+        
+        fq1_data, fq2_data = pending.popleft().get()
+        fq1.write(fq1_data)
+        fq2.write(fq2_data)
+    
+    try:
+        for chunk in template_chunks(sam_input, chunk_lines):
+            pending.append(pool.apply_async(deduplicate_chunk,
+                ((chunk, interleaved),)))
+                
+            while len(pending) > processes * 2:
+                # Don't read too far ahead
+                write_next()
+                
+        while len(pending) > 0:
+            # Write the rest
+            write_next()
+            
+        pool.close()
+    except:
+        # Stop the workers if anything goes wrong
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    
+def convert(options, fq1, fq2, interleaved):
+    """
+    Read the input specified by the given options, and write deduplicated reads
+    to the fq1 and fq2 streams (or just fq1 if interleaved is set).
+    
+    """
+    
+    if options.processes > 1:
+        if options.input_bam is not None or options.unsorted:
+            raise RuntimeError("Multiple processes only work on name-sorted "
+                "SAM input; use --threads for BAM and CRAM")
+                
+        parallel_deduplicate(options.input_sam, fq1, fq2, interleaved,
+            options.processes, options.chunk_lines)
+        return
+        
+    if options.input_bam is not None:
+        reads = parse_bam_reads(options.input_bam, threads=options.threads,
+            reference=options.reference, check_md=options.check_md)
+    else:
+        reads = parse_sam_reads(options.input_sam)
+        
+    if options.unsorted:
+        # Hold templates until the input is done
+        templates = deduplicate_unsorted(reads,
+            max_pending=options.max_pending, spill_dir=options.spill_dir,
+            partitions=options.partitions)
+    else:
+        templates = deduplicate_reads(reads)
+        
+    write_templates(templates, fq1, fq2, interleaved)
+    
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+    
+    if len(args) == 2 and args[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+    
+    options = parse_args(args) # This holds the nicely-parsed options object
+    
+    # If both ends go to the same stream, they need to be in order
+    interleaved = options.interleaved or options.fq1 is options.fq2
+    
+    if options.compress is None:
+        # Guess from the file name
+        compression = ("bgzf" if getattr(options.fq1, "name",
+            "").endswith(".gz") else None)
+    elif options.compress == "none":
+        compression = None
+    else:
+        compression = options.compress
+    
+    # Buffer (and maybe compress) the output
+    fq1 = BlockWriter(options.fq1, compression=compression,
+        threads=options.compress_threads, buffer_size=options.buffer_size)
+    if interleaved:
+        # Everything goes to the one writer
+        fq2 = fq1
+    else:
+        fq2 = BlockWriter(options.fq2, compression=compression,
+            threads=options.compress_threads, buffer_size=options.buffer_size)
+    
+    convert(options, fq1, fq2, interleaved)
     
+    # Only finish the output if everything worked, so a failure never looks
+    # like a complete BGZF file.
+    fq1.close()
+    if fq2 is not fq1:
+        fq2.close()
     
     
 if __name__ == "__main__" :
@@ -9,7 +9,10 @@ The only problem is you can't use it since it won't be installed on your nodes
 
 
 import sys, os, os.path, json, collections, logging, logging.handlers
-import SocketServer, struct, socket, threading, tarfile, shutil
+import SocketServer, struct, socket, threading, tarfile, shutil, mmap
+import zipfile, fnmatch, tempfile, itertools, time, urllib
+
+from multiprocessing.pool import ThreadPool
 
 # We need some stuff in order to have Azure
 try:
@@ -241,6 +244,222 @@ def read_global_directory(file_store, directory_id, path):
             # We need to extract the whole thing into that new directory
             tar.extractall(path)
             
+# These kinds of files are already compressed, so directory archives store them
+# raw. That also means they can be memory-mapped straight out of the archive.
+ARCHIVE_RAW_PATTERNS = ["*.gz", "*.bgz", "*.bam", "*.cram", "*.gam", "*.sst",
+    "*.zip"]
+            
+def write_global_directory_archive(file_store, path, cleanup=False,
+    raw_patterns=ARCHIVE_RAW_PATTERNS):
+    """
+    Write the given directory into the file store as a random-access archive,
+    and return an ID that can be used to retrieve it with
+    read_global_directory_archive.
+    
+    The archive is a zip file, which has a central directory of member offsets,
+    and compresses each member independently. Files with names matching any of
+    the given fnmatch patterns are stored without compression. Unlike the tar
+    files made by write_global_directory, jobs can pull just the members they
+    need out of these archives, without decompressing everything else.
+    
+    Does not preserve the name of the given directory (only of its contents),
+    or any empty directories in it.
+
+    If cleanup is true, directory will be deleted from the file store when this
+    job and its follow-ons finish.
+    
+    """
+    
+    # Zip files need to be seekable while being written, so build it locally
+    archive_path = file_store.getLocalTempFile()
+    
+    with zipfile.ZipFile(archive_path, "w", allowZip64=True) as archive:
+        for dir_path, dir_names, file_names in os.walk(path):
+            # Archive everything in a consistent order
+            dir_names.sort()
+            
+            for file_name in sorted(file_names):
+                # Name each member relative to the directory we are archiving
+                file_path = os.path.join(dir_path, file_name)
+                member_name = os.path.relpath(file_path, path)
+                
+                if any(fnmatch.fnmatchcase(file_name, pattern)
+                    for pattern in raw_patterns):
+                    # Don't bother compressing this
+                    compression = zipfile.ZIP_STORED
+                else:
+                    compression = zipfile.ZIP_DEFLATED
+                    
+                archive.write(file_path, member_name, compression)
+                
+    # Spit back the ID to use to retrieve it
+    return file_store.writeGlobalFile(archive_path, cleanup=cleanup)
+    
+def extract_archive(open_archive, path, members=None, threads=1):
+    """
+    Extract a random-access directory archive to the given path.
+    
+    open_archive is a function that returns a new zipfile.ZipFile for the
+    archive each time it is called, so that each extraction thread can have its
+    own.
+    
+    If members is not None, only members with those names, or under directories
+    with those names, are extracted. Complains if any of them are missing.
+    
+    Permissions of extracted files are restored from the archive.
+    
+    """
+    
+    def matches(member_name, wanted):
+        """
+        Return True if the given archive member is or is under the given wanted
+        name.
+        """
+
+        return (member_name == wanted or
+            member_name.startswith(wanted.rstrip("/") + "/"))
+
+    with open_archive() as archive:
+        # Work out what we need from the central directory
+        to_extract = [info.filename for info in archive.infolist()
+            if members is None or
+            any(matches(info.filename, wanted) for wanted in members)]
+
+    for wanted in (members or []):
+        # Make sure we found everything we were asked for
+        if not any(matches(name, wanted) for name in to_extract):
+            raise RuntimeError("Archive has no member {}".format(wanted))
+    
+    robust_makedirs(path)
+    
+    def extract_some(member_names):
+        """
+        Extract the given members, using a private connection to the archive.
+        """
+        
+        with open_archive() as archive:
+            for member_name in member_names:
+                info = archive.getinfo(member_name)
+                extracted = archive.extract(info, path)
+                
+                # Zip keeps Unix permissions in the high bits
+                mode = (info.external_attr >> 16) & 0o777
+                if mode != 0:
+                    os.chmod(extracted, mode)
+                    
+    # Deal the members out to the threads
+    threads = max(1, min(threads, len(to_extract)))
+    batches = [to_extract[i::threads] for i in xrange(threads)]
+    
+    if threads == 1:
+        # No need for a pool
+        for batch in batches:
+            extract_some(batch)
+    else:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(extract_some, batches)
+        finally:
+            pool.close()
+            pool.join()
+    
+def read_global_directory_archive(file_store, directory_id, path, members=None,
+    threads=1):
+    """
+    Reads a directory archive with the given id from the global file store, and
+    recreates it, or just the given members of it, at the given path. Uses the
+    given number of threads to extract members in parallel.
+    
+    Also accepts tar files made by write_global_directory, for which all members
+    are extracted.
+    
+    Do not use to extract untrusted directories, since they could sneakily plant
+    files anywhere on the filesystem.
+    
+    """
+    
+    # Get a local copy, which the file store may be caching for us anyway
+    archive_path = file_store.readGlobalFile(directory_id)
+    
+    if not zipfile.is_zipfile(archive_path):
+        # This is an old-style tar. We have to unpack all of it.
+        RealTimeLogger.get().debug("Extracting entire tar {}".format(
+            directory_id))
+        robust_makedirs(path)
+        with tarfile.open(archive_path, mode="r:*") as tar:
+            tar.extractall(path)
+        return
+        
+    extract_archive(lambda: zipfile.ZipFile(archive_path, allowZip64=True),
+        path, members=members, threads=threads)
+        
+def read_store_directory_archive(store, archive_path, path, members=None,
+    threads=1):
+    """
+    Extract the given members (or everything) of the random-access directory
+    archive at the given path in the given IOStore to the given local path.
+    
+    Only the archive's central directory and the wanted members are downloaded,
+    using byte-range reads.
+    
+    """
+    
+    extract_archive(lambda: zipfile.ZipFile(IOStoreFile(store, archive_path),
+        allowZip64=True), path, members=members, threads=threads)
+        
+def archive_member_span(archive, member_name):
+    """
+    Given an open zipfile.ZipFile for a random-access directory archive, return
+    the (offset, length) of the data for the given member in the archive file.
+    
+    The member must have been stored without compression. Its data can then be
+    memory-mapped out of a local archive, or fetched from an IOStore with
+    read_input_range.
+    
+    """
+    
+    info = archive.getinfo(member_name)
+    
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise RuntimeError("Archive member {} is compressed".format(
+            member_name))
+            
+    # The central directory knows where the local header is, but the data
+    # starts after the local header's variable-length name and extra fields.
+    archive.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+        archive.fp.read(zipfile.sizeFileHeader))
+    
+    data_offset = (info.header_offset + zipfile.sizeFileHeader +
+        header[zipfile._FH_FILENAME_LENGTH] +
+        header[zipfile._FH_EXTRA_FIELD_LENGTH])
+        
+    return data_offset, info.file_size
+            
+def coalesce_ranges(ranges, max_gap=0):
+    """
+    Given an iterable of (offset, length) byte ranges, merge together ranges
+    that overlap or that are separated by no more than max_gap bytes.
+    
+    Returns a list of (offset, length, members) tuples in offset order, where
+    members is the list of original (offset, length) ranges that the merged
+    range covers.
+    
+    """
+    
+    # This holds the merged ranges as [offset, end, members] lists
+    merged = []
+    
+    for offset, length in sorted(set(tuple(r) for r in ranges)):
+        if merged and offset <= merged[-1][1] + max_gap:
+            # This range touches or overlaps the last merged range. Extend it.
+            merged[-1][1] = max(merged[-1][1], offset + length)
+            merged[-1][2].append((offset, length))
+        else:
+            # Start a new merged range
+            merged.append([offset, offset + length, [(offset, length)]])
+            
+    return [(start, end - start, members) for start, end, members in merged]
 
 class IOStore(object):
     """
@@ -253,6 +472,10 @@ class IOStore(object):
     
     """
     
+    # Byte ranges closer together than this get read with a single request.
+    # Stores where requests are expensive should make this bigger.
+    range_gap = 0
+    
     def __init__(self):
         """
         Make a new IOStore
@@ -269,6 +492,56 @@ class IOStore(object):
         
         raise NotImplementedError()
         
+    def read_input_range(self, input_path, offset, length):
+        """
+        Read length bytes from the given input file, starting at the given byte
+        offset, and return them as a string. If the range runs off the end of
+        the file, only the bytes that exist are returned.
+        
+        """
+        
+        raise NotImplementedError()
+        
+    def read_input_ranges(self, input_path, ranges, max_gap=None):
+        """
+        Read each of the given (offset, length) byte ranges from the given input
+        file, and return a list of strings holding their data, in the order the
+        ranges were given.
+        
+        Ranges that overlap or are no more than max_gap bytes apart are fetched
+        together with a single read_input_range call. If max_gap is None, the
+        store's own range_gap is used.
+        
+        """
+        
+        if max_gap is None:
+            # Use the gap that makes sense for this kind of store
+            max_gap = self.range_gap
+        
+        # This holds the data for each requested range
+        range_data = {}
+        
+        for merged_offset, merged_length, members in coalesce_ranges(ranges,
+            max_gap):
+            # Fetch each merged range in one go
+            data = self.read_input_range(input_path, merged_offset,
+                merged_length)
+                
+            for offset, length in members:
+                # Cut out each range that it covers
+                start = offset - merged_offset
+                range_data[(offset, length)] = data[start:start + length]
+                
+        return [range_data[tuple(r)] for r in ranges]
+        
+    def get_size(self, path):
+        """
+        Returns the size in bytes of the given input or output file.
+        
+        """
+        
+        raise NotImplementedError()
+        
     def list_input_directory(self, input_path, recursive=False):
         """
         Yields each of the subdirectories and files in the given input path.
@@ -283,6 +556,26 @@ class IOStore(object):
         """
         
         raise NotImplementedError()
+        
+    def list_input_page(self, key_prefix, marker=None, page_size=5000,
+        with_sizes=False):
+        """
+        Get one page of the names of all the input files whose paths start with
+        the given string. The prefix is not treated as a directory, so "a"
+        matches "a/b" and "apple".
+        
+        Returns a list of at most page_size relative file names, and a marker to
+        pass back in to get the next page, or None if there are no more pages.
+        Pass no marker to get the first page. If with_sizes is set, the list
+        holds (name, size in bytes) tuples instead, without any extra requests
+        where the store can manage it.
+        
+        Lets callers start work on a big listing before all of it is available,
+        and pick it up again somewhere else.
+        
+        """
+        
+        raise NotImplementedError()
     
     def write_output_file(self, local_path, output_path):
         """
@@ -293,6 +586,27 @@ class IOStore(object):
         
         raise NotImplementedError()
         
+    def write_output_stream(self, stream, output_path):
+        """
+        Save everything that can be read from the given file-like stream to the
+        given output path, without making a local copy first. No output
+        directory needs to exist already.
+        
+        """
+        
+        raise NotImplementedError()
+        
+    def copy_from_store(self, source_store, input_path, output_path):
+        """
+        Try to copy the given input file from the given other store to the given
+        output path in this store without the data going through this machine.
+        Returns True if it worked, and False if it can't be done between these
+        stores, in which case the caller has to move the data itself.
+        
+        """
+        
+        return False
+        
     def exists(self, path):
         """
         Returns true if the given input or output file exists in the store
@@ -302,6 +616,14 @@ class IOStore(object):
         
         raise NotImplementedError()
         
+    def remove_file(self, path):
+        """
+        Delete the given input or output file from the store.
+        
+        """
+        
+        raise NotImplementedError()
+        
     @staticmethod
     def get(store_string):
         """
@@ -393,6 +715,35 @@ class FileIOStore(IOStore):
         # Make a symlink to grab things
         os.symlink(os.path.abspath(os.path.join(self.path_prefix, input_path)),
             local_path)
+            
+    def read_input_range(self, input_path, offset, length):
+        """
+        Read part of a file from the filesystem.
+        """
+        
+        with open(os.path.join(self.path_prefix, input_path), "rb") as stream:
+            # Just seek to the right place and read
+            stream.seek(offset)
+            return stream.read(length)
+            
+    def read_input_ranges(self, input_path, ranges, max_gap=None):
+        """
+        Read several parts of a file from the filesystem, by memory-mapping it
+        once instead of opening it for each range.
+        """
+        
+        with open(os.path.join(self.path_prefix, input_path), "rb") as stream:
+            if os.fstat(stream.fileno()).st_size == 0:
+                # Empty files can't be mapped, and have nothing to read anyway
+                return ["" for r in ranges]
+                
+            mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # Slice out each range
+                return [mapped[offset:offset + length]
+                    for offset, length in ranges]
+            finally:
+                mapped.close()
         
     def list_input_directory(self, input_path, recursive=False):
         """
@@ -403,7 +754,8 @@ class FileIOStore(IOStore):
             "FileIOStore in {}".format(input_path, self.path_prefix))
         
         for item in os.listdir(os.path.join(self.path_prefix, input_path)):
-            if(recursive and os.isdir(item)):
+            if(recursive and os.path.isdir(os.path.join(self.path_prefix,
+                input_path, item))):
                 # Recurse on this
                 for subitem in self.list_input_directory(
                     os.path.join(input_path, item), recursive):
@@ -414,6 +766,89 @@ class FileIOStore(IOStore):
             else:
                 # This isn't a directory or we aren't being recursive
                 yield item
+                
+    def walk_keys(self, directory, key_prefix, marker=None):
+        """
+        Yield the paths of the files under the given relative directory that
+        start with the given prefix and come after the given marker (if any),
+        in sorted order. Directories that can't hold any such files are never
+        listed, so picking up after a marker doesn't walk everything before it.
+        """
+        
+        root = self.path_prefix or "."
+        
+        try:
+            names = os.listdir(os.path.join(root, directory))
+        except OSError:
+            # It's not there, so nothing is in it
+            return
+        
+        # This holds (sort key, path, is directory) for everything we want
+        entries = []
+        
+        for name in names:
+            path = os.path.join(directory, name)
+            
+            if marker is not None and not (path > marker or
+                marker.startswith(path)):
+                # Everything this could be or hold is at or before the marker
+                continue
+            
+            full_path = os.path.join(root, path)
+            
+            if os.path.isdir(full_path):
+                if os.path.islink(full_path):
+                    # Don't follow links to directories, like os.walk
+                    continue
+                    
+                # Everything in here sorts as if the name ended in a slash
+                key = path + "/"
+                if not (key.startswith(key_prefix) or
+                    key_prefix.startswith(key)):
+                    # Nothing in here can match
+                    continue
+                entries.append((key, path, True))
+            elif path.startswith(key_prefix) and (marker is None or
+                path > marker):
+                entries.append((path, path, False))
+                
+        entries.sort()
+        
+        for key, path, is_directory in entries:
+            if is_directory:
+                for found in self.walk_keys(path, key_prefix, marker):
+                    yield found
+            else:
+                yield path
+                
+    def list_input_page(self, key_prefix, marker=None, page_size=5000,
+        with_sizes=False):
+        """
+        Get a page of files on the filesystem with paths starting with the given
+        prefix. The marker is the last path on the previous page.
+        """
+        
+        if key_prefix.startswith("/"):
+            # No relative path looks like that, and we mustn't walk the whole
+            # filesystem looking.
+            return [], None
+        
+        # Start in the deepest directory the prefix names, and get one more
+        # file than we need, so we know if there are more pages.
+        paths = list(itertools.islice(self.walk_keys(
+            os.path.dirname(key_prefix), key_prefix, marker), page_size + 1))
+        
+        if len(paths) > page_size:
+            # There's more after this page
+            paths = paths[:page_size]
+            next_marker = paths[-1]
+        else:
+            next_marker = None
+            
+        if with_sizes:
+            paths = [(path, self.get_size(path)) for path in paths]
+            
+        return paths, next_marker
     
     def write_output_file(self, local_path, output_path):
         """
@@ -436,6 +871,37 @@ class FileIOStore(IOStore):
         # These are small so we just make copies
         shutil.copy2(local_path, real_output_path)
         
+    def write_output_stream(self, stream, output_path):
+        """
+        Write output to the filesystem from a stream
+        """
+        
+        RealTimeLogger.get().debug("Streaming {} to FileIOStore in {}".format(
+            output_path, self.path_prefix))
+            
+        # What's the real output path to write to?
+        real_output_path = os.path.join(self.path_prefix, output_path)
+        
+        # What directory should this go in?
+        parent_dir = os.path.split(real_output_path)[0]
+            
+        if parent_dir != "":
+            # Make sure the directory it goes in exists.
+            robust_makedirs(parent_dir)
+            
+        # Write to a temporary file next to the output and move it into place
+        # at the end, so nobody sees a partial file.
+        handle, temp_path = tempfile.mkstemp(dir=parent_dir or ".")
+        try:
+            with os.fdopen(handle, "wb") as output_file:
+                shutil.copyfileobj(stream, output_file)
+            # Temporary files are private, but outputs shouldn't be
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, real_output_path)
+        except:
+            os.unlink(temp_path)
+            raise
+        
     def exists(self, path):
         """
         Returns true if the given input or output file exists in the file system
@@ -444,6 +910,34 @@ class FileIOStore(IOStore):
         """
         
         return os.path.exists(os.path.join(self.path_prefix, path))
+        
+    def remove_file(self, path):
+        """
+        Delete the given file from the file system, along with any directories
+        that it leaves empty.
+        
+        """
+        
+        os.unlink(os.path.join(self.path_prefix, path))
+        
+        # Directories are only here to hold files, like on Azure, so clean up
+        # any we emptied.
+        parent = os.path.dirname(path)
+        while parent != "":
+            try:
+                os.rmdir(os.path.join(self.path_prefix, parent))
+            except OSError:
+                # It still has things in it
+                break
+            parent = os.path.dirname(parent)
+        
+    def get_size(self, path):
+        """
+        Returns the size of the given file on the filesystem.
+        
+        """
+        
+        return os.path.getsize(os.path.join(self.path_prefix, path))
             
 class AzureIOStore(IOStore):
     """
@@ -451,6 +945,10 @@ class AzureIOStore(IOStore):
     
     """
     
+    # Every ranged GET is a round trip, so it's worth fetching up to this many
+    # unneeded bytes to avoid one.
+    range_gap = 64 * 1024
+    
     def __init__(self, account_name, container_name, name_prefix=""):
         """
         Make a new AzureIOStore that reads from and writes to the given
@@ -535,6 +1033,43 @@ class AzureIOStore(IOStore):
         self.connection.get_blob_to_path(self.container_name,
             self.name_prefix + input_path, local_path)
             
+    def read_input_range(self, input_path, offset, length):
+        """
+        Get part of an input blob from Azure, with a ranged GET. Ranges that
+        start at or past the end of the blob come back empty.
+        """
+        
+        if length <= 0:
+            # Azure can't express an empty range
+            return ""
+        
+        self.__connect()
+        
+        RealTimeLogger.get().debug("Loading {} bytes at {} of {} from "
+            "AzureIOStore".format(length, offset, input_path))
+            
+        try:
+            # Azure ranges are inclusive on both ends
+            return self.connection.get_blob(self.container_name,
+                self.name_prefix + input_path, x_ms_range="bytes={}-{}".format(
+                offset, offset + length - 1))
+        except azure.WindowsAzureError:
+            # Keep the error in case it's real
+            error_info = sys.exc_info()
+            
+            try:
+                past_end = offset >= self.get_size(input_path)
+            except azure.WindowsAzureError:
+                # The blob probably isn't there at all
+                past_end = False
+                
+            if past_end:
+                # Azure says 416 for ranges that start at or past the end, but
+                # there's just nothing there to read.
+                return ""
+                
+            raise error_info[0], error_info[1], error_info[2]
+            
     def list_input_directory(self, input_path, recursive=False):
         """
         Loop over fake /-delimited directories on Azure. The prefix may or may
@@ -597,6 +1132,29 @@ class AzureIOStore(IOStore):
                 
             if not marker:
                 break 
+                
+    def list_input_page(self, key_prefix, marker=None, page_size=5000,
+        with_sizes=False):
+        """
+        Get a page of blobs on Azure with names starting with the given prefix,
+        using Azure's own continuation markers. Sizes come with the listing.
+        """
+        
+        self.__connect()
+        
+        # Azure won't take more than 5000 at a time
+        result = self.connection.list_blobs(self.container_name,
+            prefix=self.name_prefix + key_prefix, marker=marker,
+            maxresults=min(page_size, 5000))
+            
+        # Drop the store's prefix from the names
+        names = [blob.name[len(self.name_prefix):] for blob in result]
+        
+        if with_sizes:
+            names = [(name, int(blob.properties.content_length))
+                for name, blob in itertools.izip(names, result)]
+            
+        return names, result.next_marker or None
     
     def write_output_file(self, local_path, output_path):
         """
@@ -620,6 +1178,82 @@ class AzureIOStore(IOStore):
         self.connection.put_block_blob_from_path(self.container_name,
             self.name_prefix + output_path, local_path)
             
+    def write_output_stream(self, stream, output_path):
+        """
+        Write output to Azure from a stream, uploading it in blocks as it is
+        read. Will create the container if necessary.
+        """
+        
+        self.__connect()
+        
+        RealTimeLogger.get().debug("Streaming {} to AzureIOStore".format(
+            output_path))
+        
+        try:
+            # Make the container
+            self.connection.create_container(self.container_name)
+        except azure.WindowsAzureConflictError:
+            # The container probably already exists
+            pass
+            
+        # Upload the blob in chunks until the stream runs out
+        self.connection.put_block_blob_from_file(self.container_name,
+            self.name_prefix + output_path, stream)
+            
+    def copy_from_store(self, source_store, input_path, output_path):
+        """
+        Copy a blob on the Azure server, if it comes from another container or
+        prefix in the same account. Waits for the copy to finish.
+        """
+        
+        if (not isinstance(source_store, AzureIOStore) or
+            source_store.account_name != self.account_name):
+            # Azure can only do this for us within an account, since it needs
+            # our key to read the source.
+            return False
+            
+        self.__connect()
+        
+        RealTimeLogger.get().debug("Copying {} to {} in AzureIOStore".format(
+            input_path, output_path))
+        
+        try:
+            # Make the container
+            self.connection.create_container(self.container_name)
+        except azure.WindowsAzureConflictError:
+            # The container probably already exists
+            pass
+        
+        source_url = "https://{}.blob.core.windows.net/{}/{}".format(
+            source_store.account_name, source_store.container_name,
+            urllib.quote(source_store.name_prefix + input_path))
+            
+        status = self.connection.copy_blob(self.container_name,
+            self.name_prefix + output_path, source_url)["x-ms-copy-status"]
+            
+        while status == "pending":
+            # Big blobs copy in the background
+            time.sleep(1)
+            status = self.connection.get_blob_properties(self.container_name,
+                self.name_prefix + output_path)["x-ms-copy-status"]
+                
+        if status != "success":
+            raise RuntimeError("Azure copy of {} to {} ended with status "
+                "{}".format(input_path, output_path, status))
+                
+        return True
+        
+    def remove_file(self, path):
+        """
+        Delete the given blob from Azure.
+        
+        """
+        
+        self.__connect()
+        
+        self.connection.delete_blob(self.container_name,
+            self.name_prefix + path)
+        
     def exists(self, path):
         """
         Returns true if the given input or output file exists in Azure already.
@@ -650,26 +1284,263 @@ class AzureIOStore(IOStore):
                 break 
         
         return False
-
+        
+    def get_size(self, path):
+        """
+        Returns the size of the given blob in Azure.
+        
+        """
+        
+        self.__connect()
+        
+        properties = self.connection.get_blob_properties(self.container_name,
+            self.name_prefix + path)
+            
+        return int(properties["content-length"])
+        
+class IOStoreStream(object):
+    """
+    A read-only, sequential file-like object for a file in an IOStore, which
+    downloads the file in chunks in the background while it is being read.
     
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    Up to the given number of chunks are fetched ahead of the reader, by the
+    given number of threads, so an upload reading from this stream and the
+    download feeding it can run at the same time, with bounded memory.
+    
+    """
+    
+    def __init__(self, store, path, size=None, chunk_size=4 * 1024 * 1024,
+        threads=1, prefetch=4, digest=None):
+        """
+        Open the given path in the given IOStore for streaming. If the size is
+        not given, it is looked up. If a hashlib digest object is given, it is
+        updated with everything read.
+        
+        """
+        
+        self.store = store
+        self.digest = digest
+        self.path = path
+        self.size = size if size is not None else store.get_size(path)
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        
+        # These are the chunk offsets we still need to ask for
+        self.offsets = iter(xrange(0, self.size, chunk_size))
+        
+        # This holds AsyncResults for chunks we asked for, in order
+        self.pending = collections.deque()
+        
+        # This holds the data from the chunk we are reading now, and how far
+        # into it we have read. We don't slice off what we read, because small
+        # reads would copy the rest of the chunk every time.
+        self.buffer = ""
+        self.buffer_offset = 0
+        
+        self.pool = ThreadPool(threads)
+        
+        # Start downloading
+        self.fill()
+        
+    def fetch(self, offset):
+        """
+        Download the chunk at the given offset, in a worker thread.
+        
+        """
+        
+        length = min(self.chunk_size, self.size - offset)
+        data = self.store.read_input_range(self.path, offset, length)
+        
+        if len(data) != length:
+            raise IOError("Got {} bytes instead of {} at {} in {}".format(
+                len(data), length, offset, self.path))
+                
+        return data
+        
+    def fill(self):
+        """
+        Ask for chunks until enough are on the way.
+        
+        """
+        
+        while len(self.pending) < self.prefetch:
+            try:
+                offset = next(self.offsets)
+            except StopIteration:
+                # We asked for everything
+                return
+            self.pending.append(self.pool.apply_async(self.fetch, (offset,)))
+        
+    def read(self, length=-1):
+        """
+        Read up to the given number of bytes, or everything that is left. Raises
+        any error from downloading the data being read.
+        
+        """
+        
+        # This holds the pieces we are going to return
+        parts = []
+        # And how many bytes are in them
+        have = 0
+        
+        while length is None or length < 0 or have < length:
+            if self.buffer_offset == len(self.buffer):
+                if len(self.pending) == 0:
+                    # We're out of data
+                    break
+                    
+                # Wait for the next chunk, and ask for another
+                self.buffer = self.pending.popleft().get()
+                self.buffer_offset = 0
+                self.fill()
+                
+            if length is None or length < 0:
+                wanted = len(self.buffer) - self.buffer_offset
+            else:
+                wanted = length - have
+                
+            parts.append(self.buffer[self.buffer_offset:self.buffer_offset +
+                wanted])
+            have += len(parts[-1])
+            self.buffer_offset += len(parts[-1])
+            
+        data = "".join(parts)
+        
+        if self.digest is not None:
+            self.digest.update(data)
+            
+        return data
+        
+    def close(self):
+        """
+        Stop downloading.
+        
+        """
+        
+        self.pool.terminate()
+        self.pool.join()
+        self.pending.clear()
+        self.buffer = ""
+        self.buffer_offset = 0
+        
+def copy_store_file(in_store, input_path, out_store, output_path, size=None,
+    chunk_size=4 * 1024 * 1024, threads=1, prefetch=4, digest=None):
+    """
+    Copy the given file from one IOStore to another, without making a local
+    copy. If the destination store can copy it server-side, it does that.
+    Otherwise the file is downloaded in chunks by the given number of threads,
+    staying at most prefetch chunks ahead of the upload, which happens at the
+    same time.
+    
+    If a hashlib digest object is given, and the data comes through here, the
+    digest is updated with it, and its hex digest is returned. Otherwise,
+    returns None.
+    
+    """
+    
+    if out_store.copy_from_store(in_store, input_path, output_path):
+        # The servers did it for us
+        return None
+        
+    stream = IOStoreStream(in_store, input_path, size=size,
+        chunk_size=chunk_size, threads=threads, prefetch=prefetch,
+        digest=digest)
+    try:
+        out_store.write_output_stream(stream, output_path)
+    finally:
+        stream.close()
+        
+    return digest.hexdigest() if digest is not None else None
+        
+class IOStoreFile(object):
+    """
+    A read-only, seekable file-like object for a file in an IOStore, which only
+    downloads the byte ranges that are actually read.
+    
+    Small reads are served from a read-ahead buffer, so that things like zipfile
+    that do lots of little reads of headers don't make a request for each one.
+    
+    """
+    
+    def __init__(self, store, path, buffer_size=256 * 1024):
+        """
+        Open the given path in the given IOStore for reading.
+        
+        """
+        
+        self.store = store
+        self.path = path
+        self.buffer_size = buffer_size
+        
+        # We need to know where the end is to seek relative to it
+        self.size = store.get_size(path)
+        
+        # Where are we reading from next?
+        self.position = 0
+        
+        # What bytes do we have buffered, and where do they start?
+        self.buffer = ""
+        self.buffer_offset = 0
+        
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        Move to the given offset, relative to the start, the current position,
+        or the end.
+        
+        """
+        
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+            
+        if offset < 0:
+            raise IOError("Invalid seek to {} in {}".format(offset, self.path))
+            
+        self.position = offset
+        
+    def tell(self):
+        """
+        Return the current position.
+        
+        """
+        
+        return self.position
+        
+    def read(self, length=-1):
+        """
+        Read up to the given number of bytes, or everything to the end.
+        
+        """
+        
+        if length is None or length < 0:
+            length = self.size - self.position
+        
+        # Don't read off the end
+        length = max(0, min(length, self.size - self.position))
+        
+        buffer_start = self.position - self.buffer_offset
+        
+        if buffer_start >= 0 and buffer_start + length <= len(self.buffer):
+            # We already have all of this
+            data = self.buffer[buffer_start:buffer_start + length]
+        elif length >= self.buffer_size:
+            # This is a big read, so don't buffer it
+            data = self.store.read_input_range(self.path, self.position, length)
+        else:
+            # Refill the buffer starting here and read from it
+            self.buffer = self.store.read_input_range(self.path, self.position,
+                self.buffer_size)
+            self.buffer_offset = self.position
+            data = self.buffer[:length]
+            
+        self.position += len(data)
+        return data
+        
+    def close(self):
+        """
+        Stop using the file.
+        
+        """
+        
+        self.buffer = ""